@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+# Synthetic inventory generator
+#
+# Writes network, node, partition, nics and user csv files describing a
+# datacenter of the given number of machines, laid out in racks. Each rack
+# has its own vlan and subnet, with dynamic and reserved ranges, and its
+# machines get a static address from it. The files pass `terramaas validate`.
+import argparse
+import csv
+import ipaddress
+import os
+
+# Number of machines in a rack, each rack getting its own data subnet
+RACK_SIZE = 40
+# Vlan id of the data subnet of the first rack
+FIRST_RACK_VLAN = 100
+# Address space the rack subnets are carved from
+RACK_SUPERNET = ipaddress.ip_network("10.128.0.0/9")
+# Prefix length of the rack subnets
+RACK_PREFIX = 24
+# Number of users for every thousand machines, at least one
+USERS_PER_THOUSAND = 10
+
+CSV_FILES = {
+    "network-config": "network.csv",
+    "node-config": "nodes.csv",
+    "partition-config": "partitions.csv",
+    "nics-config": "nics.csv",
+    "user-config": "users.csv",
+}
+
+
+# Write rows to a csv file
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+# Format the mac address of a machine interface
+def mac_address(machine, interface):
+    value = (0x52 << 40) | (interface << 32) | machine
+    return ":".join(f"{(value >> shift) & 0xFF:02x}" for shift in range(40, -8, -8))
+
+
+# Rows of the network csv: a shared pxe subnet and one data subnet per rack
+def network_rows(racks):
+    rows = [
+        ["Network Plan", "", "", "", "", "", "", ""],
+        [
+            "",
+            "CIDR",
+            "Gateway",
+            "MTU",
+            "Dynamic Range",
+            "Reserved Range",
+            "VLAN",
+            "Fabric",
+        ],
+        [
+            "PXE",
+            "10.0.0.0/16",
+            "10.0.0.1",
+            "1500",
+            "10.0.0.10-10.0.63.255",
+            "10.0.64.0-10.0.64.255",
+            "0",
+            "fabric-pxe",
+        ],
+    ]
+    subnets = RACK_SUPERNET.subnets(new_prefix=RACK_PREFIX)
+    for rack in range(racks):
+        subnet = next(subnets)
+        hosts = subnet.network_address
+        rows.append(
+            [
+                f"Rack {rack}",
+                str(subnet),
+                str(hosts + 1),
+                "9000",
+                f"{hosts + 2}-{hosts + 20}",
+                f"{hosts + 21}-{hosts + 30}",
+                str(FIRST_RACK_VLAN + rack),
+                f"fabric-{rack // 100}",
+            ]
+        )
+    return rows
+
+
+def generate_inventory(directory, machines):
+    """
+    Writes the csv files of a synthetic inventory.
+
+    :param directory: The directory the csv files are written to.
+    :type directory: str
+    :param machines: The number of machines.
+    :type machines: int
+    :return: The csv file paths, keyed by configuration name.
+    :rtype: dict
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {
+        name: os.path.join(directory, file_name)
+        for name, file_name in CSV_FILES.items()
+    }
+    racks = -(-machines // RACK_SIZE)
+    if FIRST_RACK_VLAN + racks > 4094:
+        raise Exception(f"Too many racks for the vlan ids: {racks}")
+
+    write_csv(paths["network-config"], network_rows(racks))
+    write_csv(
+        paths["nics-config"],
+        [
+            [
+                "Resource Name",
+                "vlan id",
+                "tags",
+                "mode",
+                "Ip address",
+                "Default Gateway",
+                "Subnet Name",
+            ],
+            ["pxe", "0", "None", "DHCP", "", "false", "PXE"],
+            *(
+                [
+                    f"data-r{rack}",
+                    str(FIRST_RACK_VLAN + rack),
+                    "data,rack",
+                    "STATIC",
+                    "",
+                    "true",
+                    f"Rack-{rack}",
+                ]
+                for rack in range(racks)
+            ),
+        ],
+    )
+    write_csv(
+        paths["partition-config"],
+        [
+            ["Resource Name", "size gigabytes", "fs type", "label", "bootable"],
+            ["/boot", "1", "ext4", "boot", "true"],
+            ["/", "118", "ext4", "root", "false"],
+            ["/var/lib", "400", "xfs", "data", "false"],
+        ],
+    )
+    write_csv(
+        paths["node-config"],
+        [
+            [
+                "Resource Name",
+                "Power type",
+                "Power pass",
+                "Power address",
+                "pxe mac address",
+                "id path",
+                "nic name",
+                "mac address",
+                "partition schema",
+            ],
+            *(
+                [
+                    f"node{machine:06d}",
+                    "ipmi",
+                    f"Password{machine}+",
+                    str(ipaddress.ip_address("172.16.0.0") + machine),
+                    mac_address(machine, 0),
+                    "/dev/sda",
+                    f"pxe,data-r{machine // RACK_SIZE}",
+                    f"{mac_address(machine, 0)},{mac_address(machine, 1)}",
+                    "/boot,/,/var/lib",
+                ]
+                for machine in range(machines)
+            ),
+        ],
+    )
+    write_csv(
+        paths["user-config"],
+        [
+            ["Resource Name", "name", "Password", "Email", "is admin"],
+            *(
+                [
+                    f"user{user}",
+                    f"user{user}",
+                    f"Passw0rd{user}",
+                    f"user{user}@maas.local",
+                    str(user == 0).lower(),
+                ]
+                for user in range(max(1, machines * USERS_PER_THOUSAND // 1000))
+            ),
+        ],
+    )
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate the csv files of a synthetic terramaas inventory"
+    )
+    parser.add_argument(
+        "-m",
+        "--machines",
+        help="The number of machines, (default: %(default)s)",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="The directory the csv files are written to, (default: %(default)s)",
+        default="./inventory",
+    )
+    args = parser.parse_args()
+
+    for name, path in generate_inventory(args.output, args.machines).items():
+        print(f"{name:<18} {path}")
+
+
+if __name__ == "__main__":
+    main()
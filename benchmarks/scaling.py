@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+# Scaling benchmark of the terramaas render path
+#
+# Generates synthetic inventories of growing sizes and times each stage of a
+# run separately: reading and parsing the csv files, extracting the network
+# objects, validating, rendering each layer and writing the script. The peak
+# memory of each stage is measured in a second, traced, run. The baseline
+# stores the times in units of a calibration workload, so it can be compared
+# across hosts, and a render stage slower than the baseline fails the run.
+# Everything runs in process: terraform is never called.
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import inventory  # noqa: E402
+from src import dataExtractionFunctions as extract  # noqa: E402
+from src import generateFunctions as gf  # noqa: E402
+from src import validation  # noqa: E402
+from src.layers import machine as node  # noqa: E402
+from src.layers import network as net  # noqa: E402
+from src.layers import user  # noqa: E402
+
+DEFAULT_SCALES = [100, 1000, 10000]
+DEFAULT_BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+# Differences below this many seconds are noise and never fail the run
+MIN_DIFFERENCE = 0.005
+
+
+# Time a fixed pure python workload, used to compare hosts of different speeds
+def calibrate(repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sorted(str(i) for i in range(200000))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def stages(paths, output_path):
+    """
+    Lists the stages of a run on an inventory.
+
+    :param paths: The csv file paths, keyed by configuration name.
+    :type paths: dict
+    :param output_path: The file the script is written to.
+    :type output_path: str
+    :return: The (name, function, render stage) tuples, in run order.
+    :rtype: list
+    """
+    data = {name: extract.read_csv_data(path) for name, path in paths.items()}
+    network_data = data["network-config"]
+    script = list(
+        gf.generate_terraform_script("key", "http://maas:5240/MAAS", paths)
+    )
+
+    result = [
+        (
+            f"read_csv_data {os.path.basename(path)}",
+            lambda path=path: extract.read_csv_data(path),
+            False,
+        )
+        for path in paths.values()
+    ]
+    result.extend(
+        (
+            f"csv_to_object_list {os.path.basename(paths[name])}",
+            lambda rows=rows: extract.csv_to_object_list(rows),
+            False,
+        )
+        for name, rows in data.items()
+        if name != "network-config"
+    )
+    result.extend(
+        (
+            function.__name__,
+            lambda function=function: function(network_data),
+            False,
+        )
+        for function in (
+            extract.extract_spaces_list,
+            extract.extract_fabric_list,
+            extract.extract_vlan_list,
+            extract.extract_subnets_list,
+        )
+    )
+    result.extend(
+        [
+            ("validate", lambda: validation.validate(paths), False),
+            (
+                "generate_terraform_network_script",
+                lambda: list(
+                    net.generate_terraform_network_script(paths["network-config"])
+                ),
+                True,
+            ),
+            (
+                "generate_terraform_node_script",
+                lambda: list(
+                    node.generate_terraform_node_script(
+                        paths["node-config"],
+                        paths["partition-config"],
+                        paths["nics-config"],
+                        paths["network-config"],
+                    )
+                ),
+                True,
+            ),
+            (
+                "generate_terraform_user_script",
+                lambda: list(user.generate_terraform_user_script(paths["user-config"])),
+                True,
+            ),
+            (
+                "write_terraform_script",
+                lambda: gf.write_terraform_script(script, output_path),
+                True,
+            ),
+        ]
+    )
+    return result
+
+
+# Best wall time of a stage over several runs
+def measure_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Peak memory allocated while a stage runs
+def measure_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Compare a time with the baseline, given in units of the calibration workload
+def compare(elapsed, calibration, baseline, tolerance):
+    expected = baseline * calibration
+    change = elapsed / expected - 1 if expected else 0.0
+    regressed = change > tolerance and elapsed - expected > MIN_DIFFERENCE
+    return change, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how the terramaas render path scales with the inventory size"
+    )
+    parser.add_argument(
+        "-m",
+        "--machines",
+        help="The inventory sizes to run, (default: %(default)s)",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SCALES,
+    )
+    parser.add_argument(
+        "--repeat",
+        help="The number of timed runs per stage, the best one is kept, (default: %(default)s)",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--baseline",
+        help="The baseline file, (default: benchmarks/baseline.json)",
+        default=DEFAULT_BASELINE,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="The slowdown over the baseline failing a render stage, (default: %(default)s)",
+        type=float,
+        default=0.25,
+    )
+    parser.add_argument(
+        "--save-baseline",
+        help="Write the measured times to the baseline file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-memory",
+        help="Skip the traced runs measuring the peak memory",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    calibration = calibrate(args.repeat)
+    results = baseline.get("scales", {})
+    regressions = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for machines in args.machines:
+            paths = inventory.generate_inventory(
+                os.path.join(directory, str(machines)), machines
+            )
+            output_path = os.path.join(directory, f"{machines}.tf")
+            scale_baseline = results.get(str(machines), {})
+            results[str(machines)] = {}
+
+            print(f"{machines} machines")
+            print(f"  {'stage':<40} {'time':>10} {'peak memory':>12} {'baseline':>9}")
+            for name, function, render_stage in stages(paths, output_path):
+                elapsed = measure_time(function, args.repeat)
+                results[str(machines)][name] = elapsed / calibration
+                memory = ""
+                if not args.no_memory:
+                    memory = f"{measure_memory(function) / 1e6:9.1f} MB"
+                status = ""
+                if name in scale_baseline:
+                    change, regressed = compare(
+                        elapsed, calibration, scale_baseline[name], args.tolerance
+                    )
+                    status = f"{change:+8.0%}"
+                    if regressed and render_stage:
+                        status += " slower"
+                        regressions.append(f"{name} with {machines} machines")
+                print(f"  {name:<40} {elapsed * 1000:8.1f} ms {memory:>12} {status}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"scales": results}, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+
+    if regressions:
+        print("Slower than the baseline: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+# Startup time budget of the terramaas CLI
+#
+# Runs `terramaas --help` and `terramaas destroy` in fresh interpreters and
+# fails when the median wall time goes over the budget, or when one of the
+# modules only needed to render scripts is imported at startup.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be loaded by --help or destroy
+LAZY_MODULES = [
+    "yaml",
+    "src.generateFunctions",
+    "src.dataExtractionFunctions",
+    "src.layers",
+    "src.cache",
+    "src.resources",
+    "src.providers",
+    "src.hcl",
+    "src.tfjson",
+    "src.graph",
+    "src.blocks",
+    "src.validation",
+    "src.plans",
+    "src.maas",
+    "src.drift",
+    "src.state",
+    "src.sites",
+    "src.shards",
+    "src.applied",
+    "src.waves",
+    "src.progress",
+]
+
+COMMANDS = {
+    "help": ["--help"],
+    "destroy": ["destroy", "-d", "./"],
+}
+
+
+# Run the CLI once in a fresh interpreter and return its wall time
+def run_cli(arguments, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "src", *arguments],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+# List the lazy modules imported when running the CLI with the given arguments
+def loaded_lazy_modules(arguments, cwd):
+    script = (
+        "import sys, runpy\n"
+        f"sys.argv = ['terramaas', *{arguments!r}]\n"
+        "try:\n"
+        "    runpy.run_module('src', run_name='__main__')\n"
+        "except BaseException:\n"
+        "    pass\n"
+        f"print('loaded:' + ','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))\n"
+    )
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    last_line = result.stdout.strip().split("\n")[-1]
+    modules = last_line[len("loaded:") :]
+    return [module for module in modules.split(",") if module]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the startup time budget of the terramaas CLI"
+    )
+    parser.add_argument(
+        "--budget",
+        help="The maximum median startup time in milliseconds, (default: %(default)s)",
+        type=float,
+        default=250,
+    )
+    parser.add_argument(
+        "--runs",
+        help="The number of runs per command, (default: %(default)s)",
+        type=int,
+        default=10,
+    )
+    args = parser.parse_args()
+
+    failed = False
+    # Run from an empty directory so destroy stops before calling terraform
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, arguments in COMMANDS.items():
+            times = [run_cli(arguments, cwd) for _ in range(args.runs)]
+            median = statistics.median(times) * 1000
+            status = "ok" if median <= args.budget else "over budget"
+            print(f"{name:<10} {median:8.1f} ms  (budget {args.budget:.0f} ms) {status}")
+            failed = failed or median > args.budget
+
+            modules = loaded_lazy_modules(arguments, cwd)
+            if modules:
+                print(f"{name:<10} imports {', '.join(modules)} at startup")
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
 import argparse
 from src import commands
+from src import tracing
 
 
 def main():
@@ -61,13 +62,119 @@ def main():
     create_parser.add_argument(
         "-o",
         "--output",
-        help="The output file, (default: %(default)s)",
+        help="The output file, or the shards directory with --shard-by or --shard-size, (default: ./terraform_script.tf, or ./terraform_script.tf.json with --format json, ./shards for shards)",
         metavar="",
-        default="./terraform_script.tf",
+    )
+    create_parser.add_argument(
+        "-f",
+        "--format",
+        help="The output format, hcl or json, (default: %(default)s)",
+        metavar="",
+        choices=["hcl", "json"],
+        default="hcl",
     )
     create_parser.add_argument(
         "-y", "--yes", help="Skip the prompt to apply the changes", action="store_true"
     )
+    create_parser.add_argument(
+        "-j",
+        "--jobs",
+        help="The number of processes used to render the machines, (default: %(default)s)",
+        metavar="",
+        type=int,
+        default=1,
+    )
+    create_parser.add_argument(
+        "--plugin-cache-dir",
+        help="The shared terraform plugin cache directory, (default: $TF_PLUGIN_CACHE_DIR or ~/.terraform.d/plugin-cache)",
+        metavar="",
+    )
+    create_parser.add_argument(
+        "--plugin-mirror",
+        help="A local filesystem mirror to install the terraform providers from",
+        metavar="",
+    )
+    create_parser.add_argument(
+        "--check-format",
+        help="Check with terraform fmt that the generated file is canonically formatted",
+        action="store_true",
+    )
+    create_parser.add_argument(
+        "--timings",
+        help="Print the time spent in each phase, and the slowest machines to render",
+        action="store_true",
+    )
+    create_parser.add_argument(
+        "--trace-file",
+        help="Write the phases to a Chrome trace event file",
+        metavar="",
+    )
+    create_parser.add_argument(
+        "--plan-only",
+        help="Save the terraform plan and print its summary as JSON without applying it",
+        action="store_true",
+    )
+    create_parser.add_argument(
+        "--render-only",
+        help="Print the generated Terraform script to stdout without running terraform",
+        action="store_true",
+    )
+    create_parser.add_argument(
+        "--shard-by",
+        help="Split the machines in root modules by vlan, or by a column of the node csv such as a rack column",
+        metavar="",
+    )
+    create_parser.add_argument(
+        "--shard-size",
+        help="Split the machines in root modules of at most this many machines",
+        metavar="",
+        type=int,
+    )
+    create_parser.add_argument(
+        "--shard-jobs",
+        help="The number of shards planned and applied at the same time, (default: %(default)s)",
+        metavar="",
+        type=int,
+        default=4,
+    )
+    create_parser.add_argument(
+        "--wave-by",
+        help="Apply the network layer first, then the machines in waves by count, vlan, power-subnet or a column of the node csv such as a rack column",
+        metavar="",
+    )
+    create_parser.add_argument(
+        "--wave-size",
+        help="The number of machines applied in each wave, (default: whole groups)",
+        metavar="",
+        type=int,
+    )
+    create_parser.add_argument(
+        "--wave-parallelism",
+        help="The terraform -parallelism of each wave, (default: %(default)s)",
+        metavar="",
+        type=int,
+        default=10,
+    )
+    create_parser.add_argument(
+        "--adaptive-waves",
+        help="Shrink the waves after errors or slow waves, and grow them while they are fast",
+        action="store_true",
+    )
+    create_parser.add_argument(
+        "--progress",
+        help="Show a live progress line of the resources applied by terraform, read from its JSON output",
+        action="store_true",
+    )
+    create_parser.add_argument(
+        "--metrics-file",
+        help="Write the latency histograms of the applied resources to a Prometheus textfile",
+        metavar="",
+    )
+    create_parser.add_argument(
+        "--report-file",
+        help="Write the latency histograms and the start and finish time of each applied resource to a JSON file",
+        metavar="",
+    )
 
     update_parser = subparsers.add_parser(
         "update", help="Update a created MAAS network configuration"
@@ -127,13 +234,418 @@ def main():
     update_parser.add_argument(
         "-o",
         "--output",
-        help="The output file, (default: %(default)s)",
+        help="The output file, or the shards directory with --shard-by or --shard-size, (default: ./terraform_script.tf, or ./terraform_script.tf.json with --format json, ./shards for shards)",
+        metavar="",
+    )
+    update_parser.add_argument(
+        "-f",
+        "--format",
+        help="The output format, hcl or json, (default: %(default)s)",
         metavar="",
-        default="./terraform_script.tf",
+        choices=["hcl", "json"],
+        default="hcl",
     )
     update_parser.add_argument(
         "-y", "--yes", help="Skip the prompt to apply the changes", action="store_true"
     )
+    update_parser.add_argument(
+        "--full",
+        help="Plan and apply every resource instead of only the changed ones",
+        action="store_true",
+    )
+    update_parser.add_argument(
+        "-j",
+        "--jobs",
+        help="The number of processes used to render the machines, (default: %(default)s)",
+        metavar="",
+        type=int,
+        default=1,
+    )
+    update_parser.add_argument(
+        "--plugin-cache-dir",
+        help="The shared terraform plugin cache directory, (default: $TF_PLUGIN_CACHE_DIR or ~/.terraform.d/plugin-cache)",
+        metavar="",
+    )
+    update_parser.add_argument(
+        "--plugin-mirror",
+        help="A local filesystem mirror to install the terraform providers from",
+        metavar="",
+    )
+    update_parser.add_argument(
+        "--check-format",
+        help="Check with terraform fmt that the generated file is canonically formatted",
+        action="store_true",
+    )
+    update_parser.add_argument(
+        "--timings",
+        help="Print the time spent in each phase, and the slowest machines to render",
+        action="store_true",
+    )
+    update_parser.add_argument(
+        "--trace-file",
+        help="Write the phases to a Chrome trace event file",
+        metavar="",
+    )
+    update_parser.add_argument(
+        "--plan-only",
+        help="Save the terraform plan and print its summary as JSON without applying it",
+        action="store_true",
+    )
+    update_parser.add_argument(
+        "--render-only",
+        help="Print the generated Terraform script to stdout without running terraform",
+        action="store_true",
+    )
+    update_parser.add_argument(
+        "--shard-by",
+        help="Split the machines in root modules by vlan, or by a column of the node csv such as a rack column",
+        metavar="",
+    )
+    update_parser.add_argument(
+        "--shard-size",
+        help="Split the machines in root modules of at most this many machines",
+        metavar="",
+        type=int,
+    )
+    update_parser.add_argument(
+        "--shard-jobs",
+        help="The number of shards planned and applied at the same time, (default: %(default)s)",
+        metavar="",
+        type=int,
+        default=4,
+    )
+    update_parser.add_argument(
+        "--wave-by",
+        help="Apply the network layer first, then the machines in waves by count, vlan, power-subnet or a column of the node csv such as a rack column",
+        metavar="",
+    )
+    update_parser.add_argument(
+        "--wave-size",
+        help="The number of machines applied in each wave, (default: whole groups)",
+        metavar="",
+        type=int,
+    )
+    update_parser.add_argument(
+        "--wave-parallelism",
+        help="The terraform -parallelism of each wave, (default: %(default)s)",
+        metavar="",
+        type=int,
+        default=10,
+    )
+    update_parser.add_argument(
+        "--adaptive-waves",
+        help="Shrink the waves after errors or slow waves, and grow them while they are fast",
+        action="store_true",
+    )
+    update_parser.add_argument(
+        "--progress",
+        help="Show a live progress line of the resources applied by terraform, read from its JSON output",
+        action="store_true",
+    )
+    update_parser.add_argument(
+        "--metrics-file",
+        help="Write the latency histograms of the applied resources to a Prometheus textfile",
+        metavar="",
+    )
+    update_parser.add_argument(
+        "--report-file",
+        help="Write the latency histograms and the start and finish time of each applied resource to a JSON file",
+        metavar="",
+    )
+
+    watch_parser = subparsers.add_parser(
+        "watch", help="Render the Terraform file again each time a csv file changes"
+    )
+    watch_parser.add_argument(
+        "-n",
+        "--network-config",
+        help="The csv file containing the network configuration",
+        metavar="FILE",
+        required=True,
+    )
+    watch_parser.add_argument(
+        "-p",
+        "--partition-config",
+        help="The csv file containing the partition configuration",
+        metavar="FILE",
+        required=True,
+    )
+    watch_parser.add_argument(
+        "-b",
+        "--node-config",
+        help="The csv file containing the node configuration",
+        metavar="FILE",
+        required=True,
+    )
+    watch_parser.add_argument(
+        "-i",
+        "--nics-config",
+        help="The csv file containing the nics configuration",
+        metavar="FILE",
+        required=True,
+    )
+    watch_parser.add_argument(
+        "-u",
+        "--user-config",
+        help="The csv file containing the user configuration",
+        metavar="FILE",
+        required=False,
+    )
+    watch_parser.add_argument("--api-key", help="The MAAS API key", metavar="KEY")
+    watch_parser.add_argument("--api-url", help="The MAAS API url", metavar="URL")
+    watch_parser.add_argument(
+        "-a",
+        "--api-config",
+        help="The YAML configuration file with MAAS API key and url",
+        metavar="FILE",
+    )
+    watch_parser.add_argument(
+        "-o",
+        "--output",
+        help="The output file, (default: ./terraform_script.tf, or ./terraform_script.tf.json with --format json)",
+        metavar="FILE",
+    )
+    watch_parser.add_argument(
+        "-f",
+        "--format",
+        help="The output format, hcl or json, (default: %(default)s)",
+        choices=["hcl", "json"],
+        default="hcl",
+    )
+    watch_parser.add_argument(
+        "-j",
+        "--jobs",
+        help="The number of processes used to render the machines, (default: %(default)s)",
+        metavar="N",
+        type=int,
+        default=1,
+    )
+    watch_parser.add_argument(
+        "--interval",
+        help="The number of seconds between two checks of the csv files, (default: %(default)s)",
+        metavar="SECONDS",
+        type=float,
+        default=0.5,
+    )
+    watch_parser.add_argument(
+        "--plan",
+        help="Run terraform plan on the changed resources after each render, without applying it",
+        action="store_true",
+    )
+    watch_parser.add_argument(
+        "--plugin-cache-dir",
+        help="The shared terraform plugin cache directory, (default: $TF_PLUGIN_CACHE_DIR or ~/.terraform.d/plugin-cache)",
+        metavar="DIR",
+    )
+    watch_parser.add_argument(
+        "--plugin-mirror",
+        help="A local filesystem mirror to install the terraform providers from",
+        metavar="DIR",
+    )
+
+    validate_parser = subparsers.add_parser(
+        "validate", help="Check the network and nics configuration without running terraform"
+    )
+    validate_parser.add_argument(
+        "-n",
+        "--network-config",
+        help="The csv file containing the network configuration",
+        metavar="FILE",
+        required=True,
+    )
+    validate_parser.add_argument(
+        "-b",
+        "--node-config",
+        help="The csv file containing the node configuration",
+        metavar="FILE",
+        required=True,
+    )
+    validate_parser.add_argument(
+        "-i",
+        "--nics-config",
+        help="The csv file containing the nics configuration",
+        metavar="FILE",
+        required=True,
+    )
+
+    sites_parser = subparsers.add_parser(
+        "sites", help="Run create or update on every site of a manifest concurrently"
+    )
+    sites_parser.add_argument(
+        "-m",
+        "--manifest",
+        help="The YAML manifest listing the sites with their csv files and API configuration",
+        metavar="FILE",
+        required=True,
+    )
+    sites_parser.add_argument(
+        "-c",
+        "--command",
+        help="The command run on each site, create or update, (default: %(default)s)",
+        choices=["create", "update"],
+        default="update",
+    )
+    sites_parser.add_argument(
+        "-w",
+        "--workers",
+        help="The number of sites run at the same time, (default: %(default)s)",
+        type=int,
+        default=4,
+        metavar="N",
+    )
+    sites_parser.add_argument(
+        "-y", "--yes", help="Apply the changes of every site without prompting", action="store_true"
+    )
+    sites_parser.add_argument(
+        "--plan-only",
+        help="Save the plan of every site and log its summary as JSON without applying it",
+        action="store_true",
+    )
+    sites_parser.add_argument(
+        "--timings",
+        help="Print the time spent in each phase",
+        action="store_true",
+    )
+    sites_parser.add_argument(
+        "--trace-file",
+        help="Write the phases to a Chrome trace event file",
+        metavar="FILE",
+    )
+
+    diff_parser = subparsers.add_parser(
+        "diff",
+        help="Compare the csv configuration with the terraform state without running terraform",
+    )
+    diff_parser.add_argument(
+        "-n",
+        "--network-config",
+        help="The csv file containing the network configuration",
+        metavar="FILE",
+        required=True,
+    )
+    diff_parser.add_argument(
+        "-p",
+        "--partition-config",
+        help="The csv file containing the partition configuration",
+        metavar="FILE",
+        required=True,
+    )
+    diff_parser.add_argument(
+        "-u",
+        "--user-config",
+        help="The csv file containing the user configuration",
+        metavar="FILE",
+        required=False,
+    )
+    diff_parser.add_argument(
+        "-b",
+        "--node-config",
+        help="The csv file containing the node configuration",
+        metavar="FILE",
+        required=True,
+    )
+    diff_parser.add_argument(
+        "-i",
+        "--nics-config",
+        help="The csv file containing the nics configuration",
+        metavar="FILE",
+        required=True,
+    )
+    diff_parser.add_argument(
+        "-d",
+        "--directory",
+        help="The directory containing the terraform state, (default: current directory)",
+        metavar="DIR",
+        default="./",
+    )
+    diff_parser.add_argument(
+        "--timings",
+        help="Print the time spent in each phase",
+        action="store_true",
+    )
+    diff_parser.add_argument(
+        "--trace-file",
+        help="Write the phases to a Chrome trace event file",
+        metavar="FILE",
+    )
+
+    drift_parser = subparsers.add_parser(
+        "drift", help="Compare the csv configuration with the live MAAS inventory"
+    )
+    drift_parser.add_argument(
+        "-n",
+        "--network-config",
+        help="The csv file containing the network configuration",
+        metavar="FILE",
+        required=True,
+    )
+    drift_parser.add_argument(
+        "-b",
+        "--node-config",
+        help="The csv file containing the node configuration",
+        metavar="FILE",
+        required=True,
+    )
+    drift_parser.add_argument(
+        "-i",
+        "--nics-config",
+        help="The csv file containing the nics configuration",
+        metavar="FILE",
+        required=True,
+    )
+    drift_parser.add_argument(
+        "-u",
+        "--user-config",
+        help="The csv file containing the user configuration",
+        metavar="FILE",
+        required=False,
+    )
+    drift_parser.add_argument("--api-key", help="The MAAS API key", metavar="KEY")
+    drift_parser.add_argument("--api-url", help="The MAAS API url", metavar="URL")
+    drift_parser.add_argument(
+        "-a",
+        "--api-config",
+        help="The YAML configuration file with MAAS API key and url",
+        metavar="FILE",
+    )
+    drift_parser.add_argument(
+        "--concurrency",
+        help="The maximum number of MAAS API requests in flight, (default: %(default)s)",
+        type=int,
+        default=8,
+        metavar="N",
+    )
+    drift_parser.add_argument(
+        "--rate",
+        help="The maximum number of MAAS API requests per second, 0 for no limit, (default: %(default)s)",
+        type=float,
+        default=50,
+        metavar="N",
+    )
+    drift_parser.add_argument(
+        "--timeout",
+        help="The timeout of each MAAS API request in seconds, (default: %(default)s)",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+    )
+    drift_parser.add_argument(
+        "-d",
+        "--directory",
+        help="The terraform workspace holding the allocated ip addresses, (default: current directory)",
+        metavar="DIR",
+        default="./",
+    )
+    drift_parser.add_argument(
+        "--timings",
+        help="Print the time spent in each phase",
+        action="store_true",
+    )
+    drift_parser.add_argument(
+        "--trace-file",
+        help="Write the phases to a Chrome trace event file",
+        metavar="FILE",
+    )
 
     destroy_parser = subparsers.add_parser(
         "destroy", help="Destroy a created MAAS network configuration"
@@ -145,17 +657,73 @@ def main():
         metavar="",
         default="./",
     )
+    destroy_parser.add_argument(
+        "-y",
+        "--yes",
+        help="Skip the prompt to destroy, with shards or with --progress, --metrics-file or --report-file",
+        action="store_true",
+    )
+    destroy_parser.add_argument(
+        "--shard-jobs",
+        help="The number of shards destroyed at the same time, (default: %(default)s)",
+        metavar="",
+        type=int,
+        default=4,
+    )
+    destroy_parser.add_argument(
+        "--progress",
+        help="Show a live progress line of the resources destroyed by terraform, read from its JSON output",
+        action="store_true",
+    )
+    destroy_parser.add_argument(
+        "--metrics-file",
+        help="Write the latency histograms of the destroyed resources to a Prometheus textfile",
+        metavar="",
+    )
+    destroy_parser.add_argument(
+        "--report-file",
+        help="Write the latency histograms and the start and finish time of each destroyed resource to a JSON file",
+        metavar="",
+    )
+    destroy_parser.add_argument(
+        "--timings",
+        help="Print the time spent in each phase to stderr",
+        action="store_true",
+    )
+    destroy_parser.add_argument(
+        "--trace-file",
+        help="Write the phases to a Chrome trace event file",
+        metavar="",
+    )
 
     args = parser.parse_args()
 
-    if args.commands == "create":
-        commands.create(args)
-    elif args.commands == "update":
-        commands.update(args)
-    elif args.commands == "destroy":
-        commands.destroy(args)
-    else:
-        parser.print_help()
+    timings = getattr(args, "timings", False)
+    trace_file = getattr(args, "trace_file", None)
+    if timings or trace_file:
+        tracing.start()
+
+    try:
+        if args.commands == "create":
+            commands.create(args)
+        elif args.commands == "update":
+            commands.update(args)
+        elif args.commands == "destroy":
+            commands.destroy(args)
+        elif args.commands == "validate":
+            commands.validate(args)
+        elif args.commands == "watch":
+            commands.watch(args)
+        elif args.commands == "sites":
+            commands.sites(args)
+        elif args.commands == "diff":
+            commands.diff(args)
+        elif args.commands == "drift":
+            commands.drift(args)
+        else:
+            parser.print_help()
+    finally:
+        tracing.stop(timings, trace_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,335 @@
+# Description: Allocation of the static ip addresses left empty in the nics configuration
+import bisect
+import hashlib
+import json
+import os
+import re
+import socket
+from src import dataExtractionFunctions as extract
+from src import validation
+
+# Each bitmap page tracks 2**PAGE_BITS addresses in 128 bytes
+PAGE_BITS = 10
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+FULL_BYTE = b"\xff"
+# Finds the next byte of a bitmap page with a free address
+NOT_FULL_BYTE = re.compile(b"[^\xff]")
+# File of the allocated addresses, kept in the terraform workspace
+ADDRESSES_FILE = "terramaas-addresses.json"
+
+
+class AddressPool:
+    """
+    The addresses of a subnet that can be handed to static nics.
+
+    Used addresses are marked in a bitmap split into pages of 2**PAGE_BITS
+    addresses, created on first use, so an IPv6 subnet costs no more than an
+    IPv4 one. The gateway, the dynamic and reserved ranges and the network
+    addresses are kept as sorted intervals and marked in each page as it is
+    created, so looking for a free address only scans the bitmap.
+
+    Args:
+        name (str): The subnet name, used in error messages.
+        version (int): The ip version of the subnet, 4 or 6.
+        first (int): The first address of the subnet.
+        last (int): The last address of the subnet.
+        excluded (list): The (start, end) addresses that are never allocated.
+    """
+
+    __slots__ = (
+        "name",
+        "version",
+        "first",
+        "size",
+        "starts",
+        "ends",
+        "pages",
+        "free",
+    )
+
+    def __init__(self, name, version, first, last, excluded):
+        self.name = name
+        self.version = version
+        self.first = first
+        self.size = last - first + 1
+        self.pages = {}
+
+        # Merge the excluded intervals, as offsets from the first address
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(excluded):
+            start = max(start, first) - first
+            end = min(end, last) - first
+            if start > end:
+                continue
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+        self.free = self.size - sum(
+            end - start + 1 for start, end in zip(self.starts, self.ends)
+        )
+
+    # Last offset of the excluded interval holding an offset, None if it is not excluded
+    def excluded_end(self, offset):
+        index = bisect.bisect_right(self.starts, offset) - 1
+        if index >= 0 and offset <= self.ends[index]:
+            return self.ends[index]
+        return None
+
+    # Create a bitmap page with its excluded addresses already marked
+    def page(self, number):
+        page = self.pages.get(number)
+        if page is not None:
+            return page
+        first = number << PAGE_BITS
+        last = min(first + PAGE_SIZE, self.size) - 1
+        page = self.pages[number] = bytearray((last - first + 8) >> 3)
+        # Addresses past the end of the subnet in the last byte
+        page[-1] |= 0xFF ^ ((1 << ((last - first) % 8 + 1)) - 1)
+        index = max(bisect.bisect_right(self.starts, first) - 1, 0)
+        for start, end in zip(self.starts[index:], self.ends[index:]):
+            if start > last:
+                break
+            start = max(start, first) - first
+            end = min(end, last) - first
+            if start > end:
+                continue
+            # Partial bytes at both ends, full bytes in between
+            while start <= end and start & 7:
+                page[start >> 3] |= 1 << (start & 7)
+                start += 1
+            while start <= end and (end + 1) & 7:
+                page[end >> 3] |= 1 << (end & 7)
+                end -= 1
+            if start <= end:
+                count = (end - start + 1) >> 3
+                page[start >> 3 : (start >> 3) + count] = FULL_BYTE * count
+        return page
+
+    def is_used(self, offset):
+        page = self.page(offset >> PAGE_BITS)
+        return page[(offset & PAGE_MASK) >> 3] >> (offset & 7) & 1
+
+    def mark(self, offset):
+        page = self.page(offset >> PAGE_BITS)
+        page[(offset & PAGE_MASK) >> 3] |= 1 << (offset & 7)
+        self.free -= 1
+
+    def reserve(self, address):
+        """
+        Marks an address typed in the nics configuration as used.
+        Addresses outside the pool or already excluded are ignored.
+
+        :return: Whether the address was free and is now marked.
+        :rtype: bool
+        """
+        offset = address - self.first
+        if 0 <= offset < self.size and not self.is_used(offset):
+            self.mark(offset)
+            return True
+        return False
+
+    def allocate(self, key):
+        """
+        Allocates the address of a nic.
+
+        The search starts at an offset hashed from the key and moves up to
+        the next free address.
+
+        :param key: The machine and nic the address is allocated for.
+        :type key: str
+        :return: The allocated address.
+        :rtype: int
+        """
+        if self.free <= 0:
+            raise Exception(
+                f"Subnet {self.name} has no free ip address left for {key}"
+            )
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        offset = int.from_bytes(digest, "big") % self.size
+        while True:
+            if offset >= self.size:
+                offset = 0
+            # Jump over excluded intervals covering whole pages without creating them
+            end = self.excluded_end(offset)
+            if end is not None and end - offset >= PAGE_SIZE:
+                offset = end + 1
+                continue
+
+            page = self.page(offset >> PAGE_BITS)
+            index = (offset & PAGE_MASK) >> 3
+            # Ignore the addresses below the offset in its byte
+            byte = page[index] | ((1 << (offset & 7)) - 1)
+            if byte == 0xFF:
+                free_byte = NOT_FULL_BYTE.search(page, index + 1)
+                if free_byte is None:
+                    offset = ((offset >> PAGE_BITS) + 1) << PAGE_BITS
+                    continue
+                index = free_byte.start()
+                byte = page[index]
+            # Lowest clear bit of the byte
+            bit = (~byte & (byte + 1)).bit_length() - 1
+            page[index] |= 1 << bit
+            self.free -= 1
+            return self.first + ((offset >> PAGE_BITS) << PAGE_BITS) + (index << 3) + bit
+
+    def format(self, address):
+        if self.version == 4:
+            return socket.inet_ntop(socket.AF_INET, address.to_bytes(4, "big"))
+        return socket.inet_ntop(socket.AF_INET6, address.to_bytes(16, "big"))
+
+
+# Build the address pool of a subnet, None if its CIDR is invalid
+def subnet_pool(subnet):
+    cidr = validation.parse_cidr(subnet["attributes"]["cidr"])
+    if cidr is None:
+        return None
+    version, first, last = cidr
+
+    excluded = []
+    if version == 4 and last - first > 1:
+        # Network and broadcast addresses
+        excluded.extend([(first, first), (last, last)])
+    elif version == 6:
+        # Subnet-router anycast address
+        excluded.append((first, first))
+    gateway = validation.parse_ip(subnet["attributes"]["gateway_ip"])
+    if gateway is not None and gateway[0] == version:
+        excluded.append((gateway[1], gateway[1]))
+    for ip_range in subnet["ip_ranges"]:
+        if ip_range is None:
+            continue
+        start = validation.parse_ip(ip_range["start_ip"])
+        end = validation.parse_ip(ip_range["end_ip"])
+        if start is not None and end is not None and start[0] == end[0] == version:
+            excluded.append((start[1], end[1]))
+
+    return AddressPool(subnet["subnet_name"], version, first, last, excluded)
+
+
+# Check if a nic needs an address to be allocated
+def needs_address(nic):
+    return nic.mode.upper() == "STATIC" and not nic.ip_address
+
+
+class AddressBook:
+    """
+    The addresses allocated to the static nics by the previous runs.
+
+    A nic keeps the address it was given as long as it is still free in its
+    subnet, so adding or removing rows never moves the address of another
+    nic. The book is saved in the terraform workspace, next to the state.
+    Without a path it starts empty and is never written.
+
+    Args:
+        path (str): The file the book is loaded from and saved to.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.addresses = {}
+        self.changed = False
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.addresses = json.load(f)["addresses"]
+            except (ValueError, KeyError, TypeError):
+                self.addresses = {}
+
+    def get(self, machine_name, nic_name):
+        return self.addresses.get(f"{machine_name}/{nic_name}")
+
+    def replace(self, addresses):
+        """
+        Keeps the given addresses, keyed by (machine name, nic name), and
+        forgets the nics that no longer need one.
+        """
+        addresses = {
+            f"{machine_name}/{nic_name}": address
+            for (machine_name, nic_name), address in addresses.items()
+        }
+        if addresses != self.addresses:
+            self.addresses = addresses
+            self.changed = True
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump({"addresses": self.addresses}, f, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.path)
+        self.changed = False
+
+
+def allocate_addresses(subnets, machines, nic_index, book=None):
+    """
+    Allocates an address to every static nic left without an ip address.
+
+    The addresses typed in the nics configuration are reserved first, then
+    the nics of the book keep their address while it is still free in their
+    subnet, and the other nics get an address from their subnet, in csv
+    order. A nic row shared by several machines gets a different address on
+    each of them.
+
+    :param subnets: The subnets of the network configuration.
+    :type subnets: list
+    :param machines: The machine rows.
+    :type machines: list
+    :param nic_index: The nic rows indexed by resource name.
+    :type nic_index: dict
+    :param book: The addresses allocated by the previous runs, updated with
+        the addresses of this one.
+    :type book: AddressBook
+    :return: The allocated addresses keyed by (machine name, nic name).
+    :rtype: dict
+    """
+    addresses = {}
+    if not any(needs_address(nic) for nic in nic_index.values()):
+        if book is not None:
+            book.replace(addresses)
+        return addresses
+
+    pools = {subnet["subnet_name"]: subnet_pool(subnet) for subnet in subnets}
+    for nic in nic_index.values():
+        pool = pools.get(nic.subnet_name)
+        if pool is None or nic.mode.upper() != "STATIC" or not nic.ip_address:
+            continue
+        address = validation.parse_ip(nic.ip_address)
+        if address is not None and address[0] == pool.version:
+            pool.reserve(address[1])
+
+    # The nics of the book claim their address before any new nic is allocated
+    pending = []
+    for machine in machines:
+        for name in extract.split_cell(machine.nic_name):
+            nic = nic_index.get(name)
+            if nic is None or not needs_address(nic):
+                continue
+            pool = pools.get(nic.subnet_name)
+            if pool is None:
+                raise Exception(
+                    f"Cannot allocate an ip address to nic {name} of machine "
+                    f"{machine.resource_name}: subnet {nic.subnet_name} has no valid CIDR"
+                )
+            previous = book.get(machine.resource_name, name) if book else None
+            address = validation.parse_ip(previous) if previous else None
+            if (
+                address is not None
+                and address[0] == pool.version
+                and pool.reserve(address[1])
+            ):
+                addresses[machine.resource_name, name] = previous
+            else:
+                pending.append((machine.resource_name, name, pool))
+
+    for machine_name, name, pool in pending:
+        addresses[machine_name, name] = pool.format(
+            pool.allocate(f"{machine_name}/{name}")
+        )
+    if book is not None:
+        book.replace(addresses)
+    return addresses
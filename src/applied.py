@@ -0,0 +1,171 @@
+# Description: Fingerprint of the last successful apply, letting update skip terraform when nothing changed
+import hashlib
+import json
+import os
+from src import resources
+from src import state
+from src.cache import CACHE_VERSION
+
+# Suffix of the fingerprint file stored next to the output file
+APPLIED_SUFFIX = ".applied"
+# Size of the chunks the csv and output files are hashed by
+CHUNK_SIZE = 1024 * 1024
+
+
+# Hash a file by chunks, None if it doesn't exist
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def input_fingerprint(csv_files, settings):
+    """
+    Fingerprints what the scripts are rendered from: the content of the csv
+    files, the settings changing the rendered scripts, such as the api
+    configuration and the output format, and the version of the templates.
+
+    :param csv_files: The csv file paths, keyed by configuration name.
+    :type csv_files: dict
+    :param settings: The settings the scripts depend on.
+    :type settings: list
+    :return: The fingerprint of the inputs.
+    :rtype: str
+    """
+    source = [
+        CACHE_VERSION,
+        list(settings),
+        [(name, file_digest(path)) for name, path in sorted(csv_files.items())],
+    ]
+    return hashlib.blake2b(repr(source).encode(), digest_size=16).hexdigest()
+
+
+def workspace_fingerprint(workspaces):
+    """
+    Fingerprints the scripts of the workspaces and their terraform state,
+    through the serial and the lineage terraform changes on every write.
+
+    :param workspaces: The (script path, state path) of each workspace.
+    :type workspaces: list
+    :return: The fingerprint of the workspaces.
+    :rtype: list
+    """
+    return [
+        [file_digest(output_path), state.state_version(state_path)]
+        for output_path, state_path in workspaces
+    ]
+
+
+def is_current(path, inputs, workspaces):
+    """
+    Tells whether the inputs, the scripts and the states are the ones recorded
+    after the last successful apply, in which case there is nothing to do.
+    """
+    recorded = load(path)
+    # The scripts and the states are only read when the inputs match
+    return recorded.get("inputs") == inputs and recorded.get(
+        "workspaces"
+    ) == workspace_fingerprint(workspaces)
+
+
+# Recorded fingerprints and resources, empty when nothing was recorded
+def load(path):
+    try:
+        with open(path) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return recorded if isinstance(recorded, dict) else {}
+
+
+def applied_resources(path, output_paths):
+    """
+    Returns the digests of the resources of each script as it was last
+    applied successfully, None for a script whose apply was not recorded.
+
+    :param path: The fingerprint file.
+    :type path: str
+    :param output_paths: The scripts, some of the recorded workspaces.
+    :type output_paths: list
+    :return: The digest of each resource block, keyed by address, for each
+        script, keyed by script path.
+    :rtype: dict
+    """
+    recorded = load(path).get("resources", {})
+    return {
+        output_path: recorded.get(script_key(path, output_path))
+        for output_path in output_paths
+    }
+
+
+# Key of a script in the recorded resources, relative to the fingerprint file
+def script_key(path, output_path):
+    return os.path.relpath(output_path, os.path.dirname(path))
+
+
+def record(path, inputs, workspaces, digests=None):
+    """
+    Records the fingerprints once the workspaces match the inputs, with the
+    digests of the resources of each script, the ones the next update
+    compares its scripts with.
+
+    :param digests: The digests of the resources of some of the scripts,
+        keyed by script path. The other scripts are indexed again.
+    :type digests: dict
+    """
+    digests = digests or {}
+    applied = {
+        script_key(path, output_path): digests.get(output_path)
+        or resources.digest_resources(
+            resources.index_resources(output_path)
+        )
+        for output_path, _ in workspaces
+    }
+    write(
+        path,
+        {
+            "inputs": inputs,
+            "workspaces": workspace_fingerprint(workspaces),
+            "resources": applied,
+        },
+    )
+
+
+def record_resources(path, digests):
+    """
+    Records the resources of the scripts applied successfully so far, while
+    the fingerprints wait for every workspace to match the inputs.
+
+    :param path: The fingerprint file.
+    :type path: str
+    :param digests: The digests of the resources of the applied scripts,
+        keyed by script path.
+    :type digests: dict
+    """
+    recorded = load(path)
+    recorded.setdefault("resources", {}).update(
+        (script_key(path, output_path), digest)
+        for output_path, digest in digests.items()
+    )
+    write(path, recorded)
+
+
+# Forget the fingerprints, so the next update runs terraform. The resources of
+# the last successful apply are kept, the next update compares its scripts with them
+def discard(path):
+    recorded = load(path)
+    if "inputs" not in recorded:
+        return
+    write(path, {"resources": recorded.get("resources", {})})
+
+
+def write(path, recorded):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(recorded, f)
+    os.replace(temporary_path, path)
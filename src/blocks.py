@@ -0,0 +1,14 @@
+# Description: Provider and resource blocks shared by the layers and the shards
+from src import hcl
+
+
+# PROVIDER BLOCK
+def generate_terraform_provider(provider_name, provider_attributes):
+    return hcl.Block("provider", [provider_name], provider_attributes.items())
+
+
+# RESOURCE BLOCKS
+def generate_terraform_resource(resource_type, resource_name, resource_attributes):
+    return hcl.Block(
+        "resource", [resource_type, resource_name], resource_attributes.items()
+    )
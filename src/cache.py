@@ -0,0 +1,128 @@
+# Description: Cache of the rendered resource blocks, reused between runs
+import contextlib
+import hashlib
+import json
+import os
+
+# Bump when the rendered templates change, so older caches are discarded
+CACHE_VERSION = 5
+
+
+class RenderCache:
+    """
+    Rendered resource blocks keyed by resource address.
+
+    Each entry stores a fingerprint of the csv rows the block was rendered
+    from next to the block itself, so a block is reused only while its rows
+    are unchanged. Entries that are not looked up during a run are evicted
+    when the cache is saved, and, when the cache is kept in memory across
+    renders, at the end of each render started with next_render. Without a
+    path the cache starts empty and is never written.
+
+    The file starts with a JSON line listing the key, the fingerprint and
+    the length of the strings of each entry, followed by the strings
+    themselves, so the rendered blocks are written and read back without
+    being escaped.
+
+    Args:
+        path (str): The file the cache is loaded from and saved to.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.live = {}
+        self.changed = False
+        if path and os.path.isfile(path):
+            try:
+                self.entries = self.load(path)
+            except (ValueError, KeyError, TypeError):
+                self.entries = {}
+
+    @staticmethod
+    def load(path):
+        # Decoding the whole file at once is faster than reading it as text
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != CACHE_VERSION:
+                return {}
+            content = f.read().decode()
+        entries = {}
+        position = 0
+        for key, fingerprint, lengths in header["entries"]:
+            strings = []
+            for length in lengths:
+                strings.append(content[position : position + length])
+                position += length
+            entries[key] = [fingerprint, strings]
+        if position != len(content):
+            raise ValueError(f"Truncated render cache: {path}")
+        return entries
+
+    @staticmethod
+    def fingerprint(source):
+        return hashlib.blake2b(repr(source).encode(), digest_size=16).hexdigest()
+
+    def get(self, key, fingerprint):
+        """
+        Returns the cached block of a resource if its fingerprint matches, None otherwise.
+        The resource is kept in the cache either way.
+        """
+        self.live[key] = fingerprint
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1]
+        return None
+
+    def put(self, key, fingerprint, block):
+        self.live[key] = fingerprint
+        self.entries[key] = [fingerprint, block]
+        self.changed = True
+
+    def render(self, key, source, render, *args):
+        """
+        Returns the block of a resource, calling render(*args) only if source changed.
+        """
+        fingerprint = self.fingerprint(source)
+        block = self.get(key, fingerprint)
+        if block is None:
+            block = render(*args)
+            self.put(key, fingerprint, block)
+        return block
+
+    @contextlib.contextmanager
+    def next_render(self):
+        """
+        Renders again over the same cache, evicting the entries the render doesn't look up.
+        If the render fails, the entries of the previous one are kept instead.
+        """
+        previous = self.live
+        self.live = {}
+        try:
+            yield
+        except BaseException:
+            self.live = previous
+            raise
+        evicted = self.entries.keys() - self.live.keys()
+        for key in evicted:
+            del self.entries[key]
+        if evicted:
+            self.changed = True
+
+    def save(self):
+        # Nothing to write if every block was reused and none was evicted
+        if not self.path or (not self.changed and len(self.live) == len(self.entries)):
+            return
+        header = []
+        strings = []
+        for key, fingerprint in self.live.items():
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == fingerprint:
+                header.append([key, fingerprint, [len(string) for string in entry[1]]])
+                strings.extend(entry[1])
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(json.dumps({"version": CACHE_VERSION, "entries": header}).encode())
+            f.write(b"\n")
+            f.write("".join(strings).encode())
+        os.replace(temporary_path, self.path)
@@ -1,17 +1,46 @@
 # Definition of the routines associated with the subcommands
-from src import generateFunctions as gf
+# The modules needed to render the scripts are imported by the subcommands
+# using them, so that --help and destroy start without loading them
+import contextlib
+import functools
+import json
 import os
-import yaml
+import shutil
 import subprocess
+import sys
+from src import tracing
 
-TERRAFORM_PATH = (
-    subprocess.run(["which", "terraform"], capture_output=True, text=True)
-    .stdout.strip()
-    .split("\n")[0]
-)
+# Output file name, without the extension of the output format
+DEFAULT_OUTPUT = "./terraform_script"
+# Directory of the shards, one root module per subdirectory
+DEFAULT_SHARDS_DIR = "./shards"
+# Manifest of a shards directory, the MANIFEST_FILE of src.shards, which destroy
+# looks for without loading the module
+SHARDS_MANIFEST = "terramaas-shards.json"
+# Suffix of the render cache file stored next to the output file
+CACHE_SUFFIX = ".cache"
+# Time given to an editor to finish saving a csv file before it is read
+WATCH_SETTLE_TIME = 0.05
+
+
+# Locate the terraform executable the first time it is needed
+@functools.lru_cache(maxsize=None)
+def terraform_path():
+    path = shutil.which("terraform")
+    if path is None:
+        raise Exception("terraform executable not found in PATH")
+    return path
 
 
 def create(args):
+    from src import applied
+    from src import dataExtractionFunctions as extract
+    from src import generateFunctions as gf
+    from src import hcl
+    from src import providers
+    from src import state
+    from src.cache import RenderCache
+
     # Get absolute paths
     csv_path = {}
     csv_path.update({"network-config": os.path.abspath(args.network_config)})
@@ -20,13 +49,39 @@ def create(args):
     csv_path.update({"nics-config": os.path.abspath(args.nics_config)})
     if args.user_config:
         csv_path.update({"user-config": os.path.abspath(args.user_config)})
-    output_path = os.path.abspath(args.output)
+    output_format = gf.OUTPUT_FORMATS[args.format]
+    output_path = os.path.abspath(
+        args.output or DEFAULT_OUTPUT + output_format.EXTENSION
+    )
 
     # Get api key and url from config file or arguments
-    api_key, api_url = api_config(args)
+    with tracing.span("configuration"):
+        api_key, api_url = api_config(args)
+    schedule = wave_schedule(args, csv_path, output_path)
+
+    # Parse each csv file once, for the validation and the render
+    extract.keep_tables()
+    # Check the csv files before running terraform
+    with tracing.span("validate"):
+        check_csv_files(csv_path)
+
+    # Split the configuration in root modules planned and applied separately
+    if args.shard_by or args.shard_size:
+        create_shards(args, csv_path, output_format, api_key, api_url)
+        return
+
+    # Generate Terraform script, reusing the blocks cached next to the output
+    cache = RenderCache(output_path + CACHE_SUFFIX)
+    book = address_book(os.path.dirname(output_path))
+    terraform_script = gf.generate_terraform_script(
+        api_key, api_url, csv_path, args.jobs, cache, output_format, book
+    )
 
-    # Generate Terraform script
-    terraform_script = gf.generate_terraform_script(api_key, api_url, csv_path)
+    # Only print the script when running in render only mode
+    if args.render_only:
+        with tracing.span("render"):
+            gf.write_terraform_script(terraform_script)
+        return
 
     # Write the script to a file show error if file already exists of terraform.tfstate exists
     if os.path.isfile(output_path) or os.path.isfile("terraform.tfstate"):
@@ -34,85 +89,914 @@ def create(args):
             "Terraform file already exists, please run destroy first, or use command update"
         )
     else:
-        with open(output_path, "w") as f:
-            f.write(terraform_script)
+        with tracing.span("render"):
+            write_atomically(terraform_script, output_path)
+            cache.save()
+            book.save()
 
-    subprocess.run([TERRAFORM_PATH, "fmt"], cwd=os.path.dirname(output_path))
-    # Apply terraform script using the command terraform apply
-    subprocess.run([TERRAFORM_PATH, "init"], cwd=os.path.dirname(output_path))
-    # Run terraform plan to preview changes
-    subprocess.run([TERRAFORM_PATH, "plan"], cwd=os.path.dirname(output_path))
-
-    # Prompt the user to continue or abort
-    if args.yes:
-        subprocess.run(
-            [TERRAFORM_PATH, "apply", "-auto-approve"], cwd=os.path.dirname(output_path)
+    if args.check_format and args.format == "hcl":
+        with tracing.span("check format"):
+            check_format(output_path)
+    # Install the providers, unless the workspace is already initialized
+    with tracing.span("init"):
+        providers.init(
+            terraform_path(),
+            os.path.dirname(output_path),
+            hcl.render_block(gf.TERRAFORM_BLOCK),
+            args.plugin_cache_dir,
+            args.plugin_mirror,
         )
-    else:
-        user_input = input("Do you want to apply the changes? (yes/no): ")
-        if user_input.lower() == "yes":
-            subprocess.run(
-                [TERRAFORM_PATH, "apply", "-auto-approve"],
-                cwd=os.path.dirname(output_path),
-            )
-        else:
-            print("Aborted.")
+    # Run terraform plan to preview changes, then apply them
+    with monitoring(args) as monitor:
+        reconciled = plan_and_apply(
+            os.path.dirname(output_path),
+            args.yes,
+            plan_only=args.plan_only,
+            schedule=schedule,
+            monitor=monitor,
+        )
+    if reconciled:
+        # Let the next update skip terraform while nothing changes
+        applied_path, inputs = applied_fingerprint(
+            args, csv_path, api_key, api_url, output_path
+        )
+        state_path = os.path.join(os.path.dirname(output_path), state.STATE_FILE)
+        applied.record(applied_path, inputs, [(output_path, state_path)])
 
 
 # Update the network configuration if terraform exists in current directory
 def update(args):
+    from src import applied
+    from src import dataExtractionFunctions as extract
+    from src import generateFunctions as gf
+    from src import hcl
+    from src import providers
+    from src import resources
+    from src import state
+    from src.cache import RenderCache
+
     # Get absolute paths
     csv_path = {}
     csv_path.update({"network-config": os.path.abspath(args.network_config)})
     csv_path.update({"partition-config": os.path.abspath(args.partition_config)})
     csv_path.update({"node-config": os.path.abspath(args.node_config)})
     csv_path.update({"nics-config": os.path.abspath(args.nics_config)})
-    csv_path.update({"user-config": os.path.abspath(args.user_config)})
-    output_path = os.path.abspath(args.output)
+    if args.user_config:
+        csv_path.update({"user-config": os.path.abspath(args.user_config)})
+    output_format = gf.OUTPUT_FORMATS[args.format]
+    output_path = os.path.abspath(
+        args.output or DEFAULT_OUTPUT + output_format.EXTENSION
+    )
 
     # Get api key and url from config file or arguments
-    api_key, api_url = api_config(args)
+    with tracing.span("configuration"):
+        api_key, api_url = api_config(args)
+    schedule = wave_schedule(args, csv_path, output_path)
+    # Parse each csv file once, for the validation and the render
+    extract.keep_tables()
+
+    # Split the configuration in root modules planned and applied separately,
+    # the shards checking the csv files after their own fingerprints
+    if args.shard_by or args.shard_size:
+        update_shards(args, csv_path, output_format, api_key, api_url)
+        return
 
-    # Generate Terraform script
-    terraform_script = gf.generate_terraform_script(api_key, api_url, csv_path)
+    # Nothing to do when the inputs, the script and the state are the ones of the last apply
+    cwd = os.path.dirname(args.directory)
+    applied_path, inputs = applied_fingerprint(
+        args, csv_path, api_key, api_url, output_path
+    )
+    workspaces = [(output_path, os.path.join(cwd, state.STATE_FILE))]
+    if not args.render_only and not args.full:
+        with tracing.span("fingerprint"):
+            current = applied.is_current(applied_path, inputs, workspaces)
+        if current:
+            report_no_changes(args.plan_only)
+            return
+
+    # Check the csv files before running terraform
+    with tracing.span("validate"):
+        check_csv_files(csv_path)
+
+    # Generate Terraform script, reusing the blocks cached next to the output
+    cache = RenderCache(output_path + CACHE_SUFFIX)
+    book = address_book(os.path.dirname(output_path))
+    terraform_script = gf.generate_terraform_script(
+        api_key, api_url, csv_path, args.jobs, cache, output_format, book
+    )
+
+    # Only print the script when running in render only mode
+    if args.render_only:
+        with tracing.span("render"):
+            gf.write_terraform_script(terraform_script)
+        return
 
     if not os.path.isfile(output_path):
         raise Exception("File doesn't exist exists, please run create command")
     else:
-        with open(output_path, "w") as f:
-            f.write(terraform_script)
+        with tracing.span("render"):
+            write_atomically(terraform_script, output_path)
+            cache.save()
+            book.save()
 
-    subprocess.run([TERRAFORM_PATH, "fmt"], cwd=os.path.dirname(output_path))
+    if args.check_format and args.format == "hcl":
+        with tracing.span("check format"):
+            check_format(output_path)
 
     if os.path.isfile("terraform.tfstate"):
-        subprocess.run([TERRAFORM_PATH, "plan"], cwd=os.path.dirname(args.directory))
-        # Prompt the user to continue or abort
-        if args.yes:
-            subprocess.run(
-                [TERRAFORM_PATH, "apply", "-auto-approve"],
-                cwd=os.path.dirname(args.directory),
+        # The fingerprints are recorded again once the state matches the script
+        applied.discard(applied_path)
+        with tracing.span("init"):
+            providers.init(
+                terraform_path(),
+                os.path.dirname(output_path),
+                hcl.render_block(gf.TERRAFORM_BLOCK),
+                args.plugin_cache_dir,
+                args.plugin_mirror,
+            )
+        # Limit the plan to the resources changed since the last successful apply
+        # and their direct dependents, the script on disk may come from an update
+        # that was aborted or failed. Without a recorded apply the plan is full
+        with tracing.span("targets"):
+            new_resources = resources.index_resources(output_path)
+            old_digests = applied.applied_resources(applied_path, [output_path])
+        options = []
+        if not args.full and old_digests[output_path] is not None:
+            targets = resources.plan_targets(old_digests[output_path], new_resources)
+            # Nothing was planned, so the fingerprints are left unrecorded
+            if not targets:
+                report_no_changes(args.plan_only)
+                return
+            options = [f"-target={target}" for target in targets]
+        with monitoring(args) as monitor:
+            reconciled = plan_and_apply(
+                cwd, args.yes, options, args.plan_only, schedule, monitor
+            )
+        if reconciled:
+            applied.record(
+                applied_path,
+                inputs,
+                workspaces,
+                {output_path: resources.digest_resources(new_resources)},
             )
-        else:
-            user_input = input("Do you want to apply the changes? (yes/no): ")
-            if user_input.lower() == "yes":
-                subprocess.run(
-                    [TERRAFORM_PATH, "apply", "-auto-approve"],
-                    cwd=os.path.dirname(args.directory),
-                )
-            else:
-                print("Aborted.")
     else:
         raise Exception("No terraform file found")
 
 
+# Create the shards of the configuration, the network shard first then the others in parallel
+def create_shards(args, csv_path, output_format, api_key, api_url):
+    from src import applied
+    from src import shards
+
+    root = os.path.abspath(args.output or DEFAULT_SHARDS_DIR)
+    if not args.render_only and shards.load_manifest(root) is not None:
+        raise Exception(
+            f"Shards already exist in {root}, please run destroy first, or use command update"
+        )
+    documents, machine_names = render_shards(
+        args, csv_path, output_format, api_key, api_url, root
+    )
+    if args.render_only:
+        print_shards(documents, output_format)
+        return
+    write_shards(root, documents, machine_names, output_format)
+    if args.check_format and args.format == "hcl":
+        with tracing.span("check format"):
+            for name in documents:
+                check_format(shards.shard_path(root, name, output_format))
+
+    options = {name: [] for name in documents}
+    init_shards(args, root, list(options))
+    with monitoring(args) as monitor:
+        reconciled = apply_shard_stages(
+            root, options, args.yes, args.plan_only, args.shard_jobs, monitor
+        )
+    if reconciled:
+        # Let the next update skip terraform while nothing changes
+        applied_path, inputs = applied_fingerprint(
+            args, csv_path, api_key, api_url, shards_script(root, output_format)
+        )
+        applied.record(
+            applied_path, inputs, shard_workspaces(root, documents, output_format)
+        )
+
+
+# Update the shards whose script changed, limiting their plans to the changed resources
+def update_shards(args, csv_path, output_format, api_key, api_url):
+    from src import applied
+    from src import resources
+    from src import shards
+
+    root = os.path.abspath(args.output or DEFAULT_SHARDS_DIR)
+    manifest = shards.load_manifest(root)
+    if manifest is None:
+        raise Exception(f"No shards found in {root}, please run create command")
+
+    # Nothing to do when the inputs, the scripts and the states are the ones of the last apply
+    applied_path, inputs = applied_fingerprint(
+        args, csv_path, api_key, api_url, shards_script(root, output_format)
+    )
+    if not args.render_only and not args.full:
+        with tracing.span("fingerprint"):
+            current = applied.is_current(
+                applied_path,
+                inputs,
+                shard_workspaces(root, manifest["shards"], output_format),
+            )
+        if current:
+            report_no_changes(args.plan_only)
+            return
+
+    with tracing.span("validate"):
+        check_csv_files(csv_path)
+    documents, machine_names = render_shards(
+        args, csv_path, output_format, api_key, api_url, root, list(manifest["shards"])
+    )
+    if args.render_only:
+        print_shards(documents, output_format)
+        return
+    moved = shards.moved_machines(manifest, machine_names)
+    if moved:
+        raise Exception(
+            "Machines can't move to another shard:\n"
+            + "\n".join(f"{machine}: {old} -> {new}" for machine, old, new in moved)
+        )
+
+    # The fingerprints are recorded again once the states match the scripts
+    applied.discard(applied_path)
+    write_shards(root, documents, machine_names, output_format)
+
+    # Compare each shard with its resources as last applied successfully, the
+    # scripts on disk may come from an update that was aborted or failed. A
+    # shard without a recorded apply is planned in full, marked by None
+    with tracing.span("targets"):
+        paths = {
+            name: shards.shard_path(root, name, output_format) for name in documents
+        }
+        new_resources = {
+            name: resources.index_resources(path) for name, path in paths.items()
+        }
+        old_digests = applied.applied_resources(applied_path, list(paths.values()))
+        targets = {}
+        for name, path in paths.items():
+            targets[name] = (
+                None
+                if old_digests[path] is None
+                else resources.plan_targets(old_digests[path], new_resources[name])
+            )
+        # The machine shards reading a changed network resource are planned in full
+        network_targets = targets.get(shards.NETWORK_SHARD, [])
+        remote = (
+            [shards.REMOTE_PREFIX]
+            if network_targets is None
+            else [shards.REMOTE_PREFIX + address + "." for address in network_targets]
+        )
+        for name, document in documents.items():
+            if targets[name] == [] and any(prefix in document for prefix in remote):
+                targets[name] = None
+    options = {
+        name: []
+        if args.full or targets[name] is None
+        else [f"-target={target}" for target in targets[name]]
+        for name in documents
+        if targets[name] != []
+    }
+    if args.check_format and args.format == "hcl":
+        with tracing.span("check format"):
+            for name in options:
+                check_format(paths[name])
+    if not options:
+        report_no_changes(args.plan_only)
+        return
+
+    # Each stage applied moves the baseline of its shards, so a later stage
+    # failing doesn't plan them again
+    def record_shards(names):
+        applied.record_resources(
+            applied_path,
+            {
+                paths[name]: resources.digest_resources(new_resources[name])
+                for name in names
+            },
+        )
+
+    init_shards(args, root, list(options))
+    with monitoring(args) as monitor:
+        reconciled = apply_shard_stages(
+            root,
+            options,
+            args.yes,
+            args.plan_only,
+            args.shard_jobs,
+            monitor,
+            record_shards,
+        )
+    if reconciled:
+        applied.record(
+            applied_path,
+            inputs,
+            shard_workspaces(root, documents, output_format),
+            {
+                paths[name]: resources.digest_resources(new_resources[name])
+                for name in documents
+            },
+        )
+
+
+# Addresses allocated to the static nics of a terraform workspace
+def address_book(directory):
+    from src import allocation
+
+    return allocation.AddressBook(os.path.join(directory, allocation.ADDRESSES_FILE))
+
+
+# Path the files kept for the whole shards directory are named after
+def shards_script(root, output_format):
+    from src import shards
+
+    return os.path.join(root, shards.SCRIPT_NAME + output_format.EXTENSION)
+
+
+# Fingerprint file of an output and fingerprint of the inputs it is rendered from
+def applied_fingerprint(args, csv_path, api_key, api_url, output_path):
+    from src import applied
+
+    settings = [api_key, api_url, args.format, args.shard_by, args.shard_size]
+    return (
+        output_path + applied.APPLIED_SUFFIX,
+        applied.input_fingerprint(csv_path, settings),
+    )
+
+
+# Script and state paths of each shard
+def shard_workspaces(root, names, output_format):
+    from src import shards
+    from src import state
+
+    return [
+        (
+            shards.shard_path(root, name, output_format),
+            os.path.join(root, name, state.STATE_FILE),
+        )
+        for name in names
+    ]
+
+
+# Render every shard in one pass, sharing the render cache stored in the shards directory
+def render_shards(args, csv_path, output_format, api_key, api_url, root, keep=()):
+    from src import shards
+    from src.cache import RenderCache
+
+    cache = RenderCache(shards_script(root, output_format) + CACHE_SUFFIX)
+    book = address_book(root)
+    with tracing.span("render"):
+        documents, machine_names = shards.render_shards(
+            api_key,
+            api_url,
+            csv_path,
+            args.shard_by,
+            args.shard_size,
+            args.jobs,
+            cache,
+            output_format,
+            keep,
+            book,
+        )
+    # Like the single script, the cache is only kept next to written shards
+    if not args.render_only:
+        os.makedirs(root, exist_ok=True)
+        cache.save()
+        book.save()
+    return documents, machine_names
+
+
+# Write the script of each shard and the manifest listing their machines
+def write_shards(root, documents, machine_names, output_format):
+    from src import shards
+
+    with tracing.span("write shards", shards=len(documents)):
+        for name, document in documents.items():
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+            write_atomically([document], shards.shard_path(root, name, output_format))
+        shards.save_manifest(root, output_format, machine_names)
+    print(f"{len(documents)} shards written to {root}", file=sys.stderr)
+
+
+# Print the script of each shard, after a line naming its file
+def print_shards(documents, output_format):
+    from src import shards
+
+    for name, document in documents.items():
+        sys.stdout.write(
+            f"==> {shards.shard_path('', name, output_format)} <==\n{document}"
+        )
+    sys.stdout.flush()
+
+
+# Install the providers in the shards, the network shard filling the plugin cache first
+def init_shards(args, root, names):
+    from src import generateFunctions as gf
+    from src import hcl
+    from src import shards
+
+    terraform_block = hcl.render_block(gf.TERRAFORM_BLOCK)
+    with tracing.span("init", shards=len(names)):
+        for group in shards.stages(names):
+            shards.init_shards(
+                terraform_path(),
+                root,
+                group,
+                terraform_block,
+                args.plugin_cache_dir,
+                args.plugin_mirror,
+                args.shard_jobs,
+            )
+
+
+# Plan, summarize and apply the shards stage by stage, with one prompt per stage,
+# calling on_applied with the shards of each stage once their states match their
+# scripts. Returns True once every state matches its script
+def apply_shard_stages(
+    root, options, yes, plan_only, workers, monitor=None, on_applied=None
+):
+    from src import plans
+    from src import shards
+
+    applied_any = False
+    for group in shards.stages(list(options)):
+        with tracing.span("plan", shards=len(group)):
+            changed = shards.plan_shards(
+                terraform_path(), root, {name: options[name] for name in group}, workers
+            )
+        if not changed:
+            # The states of the stage already match the scripts
+            if on_applied:
+                on_applied(group)
+            continue
+        with tracing.span("summarize plan"):
+            summary = shards.summarize_shards(terraform_path(), root, changed)
+        # The next stages read the state of this one, they can only be planned once it is applied
+        if plan_only:
+            summary["shards"] = changed
+            print(json.dumps(summary, indent=2))
+            return False
+        print(f"Shards: {', '.join(changed)}")
+        plans.print_summary(summary)
+
+        if not yes:
+            with tracing.span("prompt"):
+                user_input = input("Do you want to apply the changes? (yes/no): ")
+            if user_input.lower() != "yes":
+                shards.discard_plans(root, changed)
+                print("Aborted.")
+                return False
+        with tracing.span("apply", shards=len(changed)):
+            shards.apply_shards(terraform_path(), root, changed, workers, monitor)
+        if on_applied:
+            on_applied(group)
+        applied_any = True
+    if not applied_any:
+        report_no_changes(plan_only)
+    return True
+
+
+# Render the output again each time one of the csv files changes, until interrupted
+def watch(args):
+    import time
+    from src import dataExtractionFunctions as extract
+    from src import generateFunctions as gf
+    from src import hcl
+    from src import providers
+    from src import resources
+    from src.cache import RenderCache
+
+    # Get absolute paths
+    csv_path = {}
+    csv_path.update({"network-config": os.path.abspath(args.network_config)})
+    csv_path.update({"partition-config": os.path.abspath(args.partition_config)})
+    csv_path.update({"node-config": os.path.abspath(args.node_config)})
+    csv_path.update({"nics-config": os.path.abspath(args.nics_config)})
+    if args.user_config:
+        csv_path.update({"user-config": os.path.abspath(args.user_config)})
+    output_format = gf.OUTPUT_FORMATS[args.format]
+    output_path = os.path.abspath(
+        args.output or DEFAULT_OUTPUT + output_format.EXTENSION
+    )
+    cwd = os.path.dirname(output_path)
+    api_key, api_url = api_config(args)
+
+    if args.plan:
+        if not os.path.isfile(os.path.join(cwd, "terraform.tfstate")):
+            raise Exception("No terraform file found, run create before watch --plan")
+        providers.init(
+            terraform_path(),
+            cwd,
+            hcl.render_block(gf.TERRAFORM_BLOCK),
+            args.plugin_cache_dir,
+            args.plugin_mirror,
+        )
+
+    # The parsed csv files and the rendered blocks stay in memory between renders
+    extract.keep_tables()
+    cache = RenderCache(output_path + CACHE_SUFFIX)
+    book = address_book(cwd)
+    previous_digests = (
+        resources.digest_resources(resources.index_resources(output_path))
+        if args.plan
+        else None
+    )
+
+    print(
+        f"Watching {len(csv_path)} csv files, rendering {output_path}, "
+        "press Ctrl+C to stop",
+        file=sys.stderr,
+    )
+    signatures = None
+    try:
+        while True:
+            current = file_signatures(csv_path)
+            if current == signatures:
+                time.sleep(args.interval)
+                continue
+            # Let the editor finish saving before reading the files
+            time.sleep(WATCH_SETTLE_TIME)
+            if file_signatures(csv_path) != current:
+                continue
+            signatures = current
+
+            start = time.perf_counter()
+            try:
+                check_csv_files(csv_path)
+                with cache.next_render():
+                    write_atomically(
+                        gf.generate_terraform_script(
+                            api_key,
+                            api_url,
+                            csv_path,
+                            args.jobs,
+                            cache,
+                            output_format,
+                            book,
+                        ),
+                        output_path,
+                    )
+                book.save()
+            except Exception as error:
+                print(f"{time.strftime('%H:%M:%S')} {error}", file=sys.stderr)
+                continue
+            print(
+                f"{time.strftime('%H:%M:%S')} {os.path.basename(output_path)} "
+                f"updated in {(time.perf_counter() - start) * 1000:.0f} ms",
+                file=sys.stderr,
+            )
+
+            if args.plan:
+                new_resources = resources.index_resources(output_path)
+                targets = resources.plan_targets(previous_digests, new_resources)
+                previous_digests = resources.digest_resources(new_resources)
+                if targets:
+                    watch_plan(cwd, targets)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cache.save()
+
+
+# Modification time and size of each csv file, None for a file being replaced
+def file_signatures(csv_path):
+    signatures = []
+    for path in csv_path.values():
+        try:
+            stat = os.stat(path)
+            signatures.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signatures.append(None)
+    return signatures
+
+
+# Write the script to a temporary file then move it over the output in one step.
+# An unchanged output is left untouched, keeping its modification time
+def write_atomically(terraform_script, output_path):
+    import filecmp
+    from src import generateFunctions as gf
+
+    temporary_path = output_path + ".tmp"
+    try:
+        gf.write_terraform_script(terraform_script, temporary_path)
+    except BaseException:
+        if os.path.isfile(temporary_path):
+            os.remove(temporary_path)
+        raise
+    if os.path.isfile(output_path) and filecmp.cmp(
+        temporary_path, output_path, shallow=False
+    ):
+        os.remove(temporary_path)
+        return False
+    os.replace(temporary_path, output_path)
+    return True
+
+
+# Preview the changes of the watched output, limited to the changed resources
+def watch_plan(cwd, targets):
+    from src import plans
+
+    try:
+        plans.plan(terraform_path(), cwd, [f"-target={target}" for target in targets])
+    except Exception as error:
+        print(error, file=sys.stderr)
+        return
+    # The plan is only a preview, it is never applied
+    os.remove(os.path.join(cwd, plans.PLAN_FILE))
+
+
+# Raise an error listing every mistake found in the csv files
+def check_csv_files(csv_path):
+    from src import validation
+
+    errors = validation.validate(csv_path)
+    if errors:
+        raise Exception(
+            "Invalid configuration:\n" + "\n".join(str(error) for error in errors)
+        )
+
+
+# Validate the csv files without running terraform
+def validate(args):
+    from src import validation
+
+    csv_path = {}
+    csv_path.update({"network-config": os.path.abspath(args.network_config)})
+    csv_path.update({"node-config": os.path.abspath(args.node_config)})
+    csv_path.update({"nics-config": os.path.abspath(args.nics_config)})
+
+    errors = validation.validate(csv_path)
+    for error in errors:
+        print(error)
+    if errors:
+        raise SystemExit(1)
+    print("Configuration is valid.")
+
+
+# Compare the csv files with the live MAAS inventory without running terraform
+def drift(args):
+    import asyncio
+    from src import drift as inventory_drift
+
+    csv_path = {}
+    csv_path.update({"network-config": os.path.abspath(args.network_config)})
+    csv_path.update({"node-config": os.path.abspath(args.node_config)})
+    csv_path.update({"nics-config": os.path.abspath(args.nics_config)})
+    if args.user_config:
+        csv_path.update({"user-config": os.path.abspath(args.user_config)})
+
+    with tracing.span("configuration"):
+        api_key, api_url = api_config(args)
+    with tracing.span("validate"):
+        check_csv_files(csv_path)
+
+    with tracing.span("drift scan"):
+        differences, requests, elapsed = asyncio.run(
+            inventory_drift.scan(
+                csv_path,
+                api_url,
+                api_key,
+                args.concurrency,
+                args.rate,
+                args.timeout,
+                address_book(os.path.abspath(args.directory)),
+            )
+        )
+    for difference in differences:
+        print(difference)
+    print(
+        f"{len(differences)} differences found with {requests} requests "
+        f"in {elapsed:.1f}s",
+        file=sys.stderr,
+    )
+    if differences:
+        raise SystemExit(1)
+    print("No drift.")
+
+
+# Compare the resources of the csv files with the terraform state without running terraform
+def diff(args):
+    from src import state
+    from src import tfjson
+    from src.cache import RenderCache
+
+    csv_path = {}
+    csv_path.update({"network-config": os.path.abspath(args.network_config)})
+    csv_path.update({"partition-config": os.path.abspath(args.partition_config)})
+    csv_path.update({"node-config": os.path.abspath(args.node_config)})
+    csv_path.update({"nics-config": os.path.abspath(args.nics_config)})
+    if args.user_config:
+        csv_path.update({"user-config": os.path.abspath(args.user_config)})
+    directory = os.path.abspath(args.directory)
+    state_path = os.path.join(directory, state.STATE_FILE)
+    if not os.path.isfile(state_path):
+        raise Exception(f"No terraform state found in {directory}")
+
+    with tracing.span("validate"):
+        check_csv_files(csv_path)
+
+    # Reuse the render cache of the JSON output when there is one, without
+    # saving it, so the workspace is left as it was
+    cache = RenderCache(
+        os.path.join(
+            directory,
+            os.path.basename(DEFAULT_OUTPUT) + tfjson.EXTENSION + CACHE_SUFFIX,
+        )
+    )
+    with tracing.span("render"):
+        desired, references = state.desired_resources(
+            csv_path, cache, address_book(directory)
+        )
+
+    with tracing.span("read state"):
+        changes = state.diff_state(
+            desired, references, state.iter_state_resources(state_path)
+        )
+    if not changes:
+        print("No changes.")
+        return
+    print(state.format_diff(changes))
+    raise SystemExit(1)
+
+
+# Run create or update on every site of a manifest, a bounded number at a time
+def sites(args):
+    from src import sites as manifest
+
+    site_list = manifest.load_manifest(args.manifest)
+    # The sites run unattended, nothing can answer the prompt
+    if not args.yes and not args.plan_only:
+        raise Exception("The sites can't be prompted, use --yes or --plan-only")
+    options = ["--plan-only"] if args.plan_only else ["--yes"]
+
+    with tracing.span("sites", sites=len(site_list)):
+        results = manifest.run_sites(site_list, args.command, options, args.workers)
+    print(manifest.format_results(results))
+    if not all(succeeded for _, succeeded, _, _ in results):
+        raise SystemExit(1)
+
+
+# Check that the generated file is already formatted the way terraform fmt would
+def check_format(output_path):
+    result = subprocess.run([terraform_path(), "fmt", "-check", "-diff", output_path])
+    if result.returncode != 0:
+        raise Exception(f"{output_path} is not in the canonical terraform format")
+
+
+# Save a terraform plan, summarize it, then apply exactly that plan after confirmation,
+# or its changes wave by wave with a wave schedule. Returns True once the state matches the script
+def plan_and_apply(cwd, yes, options=(), plan_only=False, schedule=None, monitor=None):
+    from src import plans
+
+    # In plan only mode stdout is kept for the JSON summary
+    with tracing.span("plan"):
+        has_changes = plans.plan(
+            terraform_path(), cwd, options, sys.stderr if plan_only else None
+        )
+    if not has_changes:
+        os.remove(os.path.join(cwd, plans.PLAN_FILE))
+        report_no_changes(plan_only)
+        return True
+
+    # The waves target the changed resources of the plan
+    addresses = []
+
+    def collect(resource_changes):
+        for change in resource_changes:
+            if plans.change_action(change["change"]["actions"]) != "no-op":
+                addresses.append(change["address"])
+            yield change
+
+    with tracing.span("summarize plan"):
+        resource_changes = plans.iter_resource_changes(terraform_path(), cwd)
+        if schedule is not None:
+            resource_changes = collect(resource_changes)
+        summary = plans.summarize(resource_changes)
+    if plan_only:
+        print(json.dumps(summary, indent=2))
+        return False
+    plans.print_summary(summary)
+
+    # Prompt the user to continue or abort
+    if not yes:
+        with tracing.span("prompt"):
+            user_input = input("Do you want to apply the changes? (yes/no): ")
+        if user_input.lower() != "yes":
+            os.remove(os.path.join(cwd, plans.PLAN_FILE))
+            print("Aborted.")
+            return False
+    if schedule is not None:
+        from src import waves
+
+        # Each wave saves, checks and applies its own plan
+        os.remove(os.path.join(cwd, plans.PLAN_FILE))
+        with tracing.span("apply waves"):
+            applied = waves.apply_waves(
+                terraform_path(), cwd, addresses, schedule, yes, monitor
+            )
+        if not applied:
+            print("Aborted.")
+        return applied
+    with tracing.span("apply"):
+        plans.apply(terraform_path(), cwd, monitor=monitor)
+    return True
+
+
+# Wave schedule of the apply, None to apply the whole plan at once
+def wave_schedule(args, csv_path, output_path):
+    if args.wave_by is None:
+        return None
+    if args.shard_by or args.shard_size:
+        raise Exception("Waves can't be combined with shards, use --shard-jobs instead")
+    from src import waves
+
+    return waves.WaveSchedule(
+        args.wave_by,
+        args.wave_size,
+        args.wave_parallelism,
+        args.adaptive_waves,
+        csv_path,
+        output_path,
+    )
+
+
+# Follow the resources applied by terraform when a progress line or metrics are asked for,
+# writing the metrics files at the end, even when terraform failed
+@contextlib.contextmanager
+def monitoring(args):
+    if not (args.progress or args.metrics_file or args.report_file):
+        yield None
+        return
+    from src import progress
+
+    monitor = progress.ApplyMonitor(args.progress, args.metrics_file, args.report_file)
+    try:
+        yield monitor
+    finally:
+        monitor.finish()
+
+
+# Tell there is nothing to apply, as an empty JSON summary in plan only mode
+def report_no_changes(plan_only):
+    if plan_only:
+        from src import plans
+
+        print(json.dumps(plans.summarize(()), indent=2))
+    else:
+        print("No changes to apply.")
+
+
 # call terraform destroy to destroy the network configuration if terraform exists in current directory
 def destroy(args):
-    if os.path.isfile("terraform.tfstate"):
-        subprocess.run([TERRAFORM_PATH, "destroy"], cwd=os.path.dirname(args.directory))
+    if os.path.isfile(os.path.join(args.directory, SHARDS_MANIFEST)):
+        destroy_shards(args)
+    elif os.path.isfile("terraform.tfstate"):
+        with monitoring(args) as monitor:
+            if monitor is None:
+                with tracing.span("destroy"):
+                    subprocess.run(
+                        [terraform_path(), "destroy"],
+                        cwd=os.path.dirname(args.directory),
+                    )
+                return
+            # The JSON UI stream can't prompt, the confirmation is asked here
+            if not args.yes:
+                user_input = input("Do you want to destroy every resource? (yes/no): ")
+                if user_input.lower() != "yes":
+                    print("Aborted.")
+                    return
+            command = [terraform_path(), "destroy", "-input=false", "-auto-approve"]
+            with tracing.span("destroy"):
+                returncode = monitor.run(
+                    command + ["-json"], os.path.dirname(args.directory)
+                )
+            if returncode != 0:
+                raise Exception("terraform destroy failed")
     else:
         raise Exception("No terraform file found")
 
 
+# Destroy the machine and user shards in parallel, then the network shard they read
+def destroy_shards(args):
+    from src import shards
+
+    root = os.path.abspath(args.directory)
+    names = list(shards.load_manifest(root)["shards"])
+    if not args.yes:
+        user_input = input(
+            f"Do you want to destroy the {len(names)} shards in {root}? (yes/no): "
+        )
+        if user_input.lower() != "yes":
+            print("Aborted.")
+            return
+    with tracing.span("destroy", shards=len(names)), monitoring(args) as monitor:
+        shards.destroy_shards(terraform_path(), root, names, args.shard_jobs, monitor)
+
+
 # Function to handle api configuration
 def api_config(args):
     # Check if api key and url are provided or in a config file
@@ -122,6 +1006,8 @@ def api_config(args):
 
     # Get api key and url from config file or arguments
     if args.api_config:
+        import yaml
+
         try:
             with open(os.path.abspath(args.api_config)) as f:
                 config = yaml.load(f, Loader=yaml.SafeLoader)
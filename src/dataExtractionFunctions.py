@@ -1,5 +1,7 @@
 import csv
-import re
+import os
+import sys
+from src import tracing
 
 CIDR_COLUMN = "CIDR"
 GATEWAY_COLUMN = "Gateway"
@@ -9,31 +11,186 @@ RESERVED_RANGE_COLUMN = "Reserved Range"
 VLAN_COLUMN = "VLAN"
 FABRIC_COLUMN = "Fabric"
 
+# Parsed csv files kept between renders by watch mode, keyed by path and
+# kind, None when the files are read again on every call
+kept_tables = None
+
+
+# Normalize a csv header cell into an attribute name
+def normalize_header(header):
+    return header.lower().strip().replace(" ", "_")
+
+
+# Normalize a csv cell value
+def normalize_value(value):
+    return value.strip().replace('"', "")
+
 
 def csv_to_object_list(data):
-    headers = [header.lower().strip().replace(" ", "_") for header in data[0]]
-    obj_list = []
-    for row in data[1:]:
-        row = [r.strip() for r in row]
-        row = ",".join(row)
-        comma_outside_quotes = re.compile(r",(?=(?:[^\"']*[\"'][^\"']*[\"'])*[^\"']*$)")
-        row = comma_outside_quotes.split(row)
-        obj = dict(zip(headers, row))
-        for key, value in obj.items():
-            obj[key] = value.replace('"', "")
-        obj_list.append(obj)
-    return obj_list
+    headers = [normalize_header(header) for header in data[0]]
+    return [
+        dict(zip(headers, (normalize_value(value) for value in row)))
+        for row in data[1:]
+    ]
+
+
+class Record:
+    """
+    Base class for the rows of the machine, partition, nic and user csv files.
+
+    Subclasses list their columns in __slots__, using the normalized header
+    names, and the columns whose values repeat across rows in interned. The
+    row attribute holds the csv row number the record was read from.
+    """
+
+    __slots__ = ("row",)
+    interned = ()
+
+    def __init__(self, values, row=None):
+        self.row = row
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        values = ", ".join(
+            f"{name}={getattr(self, name)!r}" for name in self.__slots__
+        )
+        return f"{type(self).__name__}({values})"
+
+
+class NodeRecord(Record):
+    __slots__ = (
+        "resource_name",
+        "power_type",
+        "power_pass",
+        "power_address",
+        "pxe_mac_address",
+        "id_path",
+        "nic_name",
+        "mac_address",
+        "partition_schema",
+    )
+    interned = ("power_type", "nic_name", "partition_schema")
+
+
+class PartitionRecord(Record):
+    __slots__ = ("resource_name", "size_gigabytes", "fs_type", "label", "bootable")
+    interned = ("size_gigabytes", "fs_type", "bootable")
+
+
+class NicRecord(Record):
+    __slots__ = (
+        "resource_name",
+        "vlan_id",
+        "tags",
+        "mode",
+        "ip_address",
+        "default_gateway",
+        "subnet_name",
+    )
+    interned = ("vlan_id", "tags", "mode", "default_gateway", "subnet_name")
+
+
+class UserRecord(Record):
+    __slots__ = ("resource_name", "name", "password", "email", "is_admin")
+    interned = ("is_admin",)
+
+
+# Build records of the given type from csv rows, the first row being the header
+def iter_records(rows, record_type):
+    rows = iter(rows)
+    headers = [normalize_header(header) for header in next(rows, [])]
+    positions = [
+        headers.index(name) if name in headers else None
+        for name in record_type.__slots__
+    ]
+    interned = [
+        index
+        for index, name in enumerate(record_type.__slots__)
+        if name in record_type.interned
+    ]
+    # Missing columns read from an empty cell past the end of the padded row
+    width = len(headers)
+    positions = [width if position is None else position for position in positions]
+    padding = [""] * (width + 1)
+
+    # The header is the first row
+    for row_number, row in enumerate(rows, start=2):
+        # Skip empty lines
+        if not any(row):
+            continue
+        row = row + padding[len(row) :]
+        values = [row[position].strip().replace('"', "") for position in positions]
+        for index in interned:
+            values[index] = sys.intern(values[index])
+        yield record_type(values, row_number)
+
+
+# Keep the parsed csv files in memory, reusing them until their file changes
+def keep_tables():
+    global kept_tables
+    kept_tables = {}
+
+
+# Return the parsed content of a csv file, calling load() unless it is kept
+def kept_table(csv_file, kind, load):
+    if kept_tables is None:
+        return load()
+    stat = os.stat(csv_file)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    entry = kept_tables.get((csv_file, kind))
+    if entry is None or entry[0] != signature:
+        entry = (signature, load())
+        kept_tables[(csv_file, kind)] = entry
+    return entry[1]
+
+
+# Load the records of the given type from a csv file
+def load_records(csv_file, record_type):
+    def load():
+        with tracing.span(f"load {os.path.basename(csv_file)}", "csv"):
+            with open(csv_file, newline="") as csvfile:
+                return list(iter_records(csv.reader(csvfile), record_type))
+
+    return kept_table(csv_file, record_type, load)
+
+
+# Index records by resource name
+def index_records(records, kind):
+    index = {}
+    for record in records:
+        if record.resource_name in index:
+            raise Exception(f"Duplicate {kind} resource name: {record.resource_name}")
+        index[record.resource_name] = record
+    return index
+
+
+# Split a comma separated cell into its stripped values
+def split_cell(cell):
+    return [value.strip() for value in cell.split(",") if value.strip()]
+
+
+# Parse a true/false cell, anything but true is false
+def parse_bool(cell):
+    return cell.strip().lower() == "true"
 
 
 # Function to extract data from a csv file
 def read_csv_data(csv_file):
-    data = []
-    with open(csv_file, newline="") as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            data.append(row)
+    def load():
+        data = []
+        with tracing.span(f"read {os.path.basename(csv_file)}", "csv"):
+            with open(csv_file, newline="") as csvfile:
+                reader = csv.reader(csvfile)
+                for row in reader:
+                    data.append(row)
+
+        return data
 
-    return data
+    return kept_table(csv_file, "rows", load)
 
 
 # extract network data from a csv file
@@ -67,89 +224,102 @@ def extract_space_name(space_name_cell):
     return space_name
 
 
+# Network configuration parsed in a single scan of the csv data
+class NetworkTable:
+    """
+    Fabrics, spaces, vlans and subnets extracted from the network csv data.
+
+    The header row is located once and every data row is visited a single
+    time; each collection keeps the order in which its items first appear.
+
+    Args:
+        data (list): The rows returned by read_csv_data.
+    """
+
+    def __init__(self, data):
+        self.columns = extract_column_names(data)
+        self.fabrics = []
+        self.spaces = []
+        self.vlans = []
+        self.subnets = []
+        if not self.columns:
+            return
+
+        fabrics = {}
+        spaces = {}
+        vlans = {}
+        fabric_index = self.columns[FABRIC_COLUMN]
+        vlan_index = self.columns[VLAN_COLUMN]
+        rows = extract_network_data(data)
+        first_row = len(data) - len(rows) + 1
+        for row_number, row in enumerate(rows, start=first_row):
+            fabric_cell = row[fabric_index]
+            if fabric_cell != "":
+                fabrics[fabric_cell] = None
+            if row[0] != "":
+                spaces[extract_space_name(row[0])] = None
+
+            vlan_cell = row[vlan_index]
+            if not is_valid_vlan(vlan_cell):
+                continue
+            vlans[vlan_cell] = {
+                "vlan_id": vlan_cell,
+                "vlan_name": "vlan-" + vlan_cell,
+                "space_name": extract_space_name(row[0]),
+                "fabric_name": fabric_cell,
+                "mtu": row[self.columns[MTU_COLUMN]],
+            }
+            # Skip rows with empty fields
+            if not all(field.strip() == "" for field in row[1:]):
+                self.subnets.append(self._subnet(row, row_number))
+
+        self.fabrics = list(fabrics)
+        self.spaces = list(spaces)
+        self.vlans = list(vlans.values())
+
+    def _subnet(self, row, row_number):
+        columns = self.columns
+        # Create a list of dictionaries to store the ip ranges
+        ip_ranges = []
+        # Append the dynamic range to the ip range list
+        ip_ranges.extend(
+            extract_ip_ranges(row[columns[DYNAMIC_RANGE_COLUMN]], "dynamic")
+        )
+        # Append the reserved range to the ip range list
+        ip_ranges.extend(
+            extract_ip_ranges(row[columns[RESERVED_RANGE_COLUMN]], "reserved")
+        )
+        return {
+            "subnet_name": row[0].replace(" ", "-"),
+            "fabric_name": row[columns[FABRIC_COLUMN]],
+            "attributes": {
+                "cidr": row[columns[CIDR_COLUMN]],
+                "gateway_ip": row[columns[GATEWAY_COLUMN]],
+            },
+            "ip_ranges": ip_ranges,
+            "vlan_name": "vlan-" + row[columns[VLAN_COLUMN]],
+            "row": row_number,
+        }
+
+
 # Extract space info from the extracted data
 def extract_spaces_list(data):
-    spaces = []
-    data = extract_network_data(data)
-    # Create a list of dictionaries to store the space data
-    for line in data:
-        if line[0] != "":
-            spaces.append(extract_space_name(line[0]))
-
-    return list(set(spaces))
+    return NetworkTable(data).spaces
 
 
 # Extract fabric info from the extracted data
 def extract_fabric_list(data):
-    fabrics = []
-    columns = extract_column_names(data)
-    data = extract_network_data(data)
-    # Create a list of dictionaries to store the fabric data
-    for line in data:
-        if line[columns[FABRIC_COLUMN]] != "":
-            fabrics.append(line[columns[FABRIC_COLUMN]])
-
-    return list(set(fabrics))
+    return NetworkTable(data).fabrics
 
 
 # Extract vlan info from the extracted data
 def extract_vlan_list(data):
-    vlans = []
-    columns = extract_column_names(data)
-    data = extract_network_data(data)
-    # Create a list of dictionaries to store the vlan data
-    for row in data:
-        vlan_cell = row[columns[VLAN_COLUMN]]
-        if is_valid_vlan(vlan_cell):
-            vlan = {
-                "vlan_id": vlan_cell,
-                "vlan_name": "vlan-" + vlan_cell,
-                "space_name": extract_space_name(row[0]),
-                "fabric_name": row[columns[FABRIC_COLUMN]],
-                "mtu": row[columns[MTU_COLUMN]],
-            }
-            vlans.append(vlan)
-
-    return list({vlan["vlan_id"]: vlan for vlan in vlans}.values())
+    return NetworkTable(data).vlans
 
 
 # Extract subnet info from the extracted data
 def extract_subnets_list(data):
-    # Create a list of dictionaries to store the subnet data
-    subnets = []
-    columns = extract_column_names(data)
-    for subnet in data:
-        # Skip rows with empty fields
-        if not all(field.strip() == "" for field in subnet[1:]) and is_valid_vlan(
-            subnet[columns[VLAN_COLUMN]]
-        ):
-            subnet_name = subnet[0].replace(" ", "-")
-            attributes = {
-                "cidr": subnet[columns[CIDR_COLUMN]],
-                "gateway_ip": subnet[columns[GATEWAY_COLUMN]],
-            }
-
-            # Create a list of dictionaries to store the ip ranges
-            ip_ranges = []
-            dynamic_range = subnet[columns[DYNAMIC_RANGE_COLUMN]]
-            # Append the dynamic range to the ip range list
-            ip_ranges.extend(extract_ip_ranges(dynamic_range, "dynamic"))
-
-            # Append the reserved range to the ip range list
-            reserved_range = subnet[columns[RESERVED_RANGE_COLUMN]]
-            ip_ranges.extend(extract_ip_ranges(reserved_range, "reserved"))
-
-            subnets.append(
-                {
-                    "subnet_name": subnet_name,
-                    "fabric_name": subnet[columns[FABRIC_COLUMN]],
-                    "attributes": attributes,
-                    "ip_ranges": ip_ranges,
-                    "vlan_name": "vlan-" + subnet[columns[VLAN_COLUMN]],
-                }
-            )
-
-    return subnets
+    return NetworkTable(data).subnets
 
 
 # Extract ip ranges from the extracted data
@@ -0,0 +1,447 @@
+# Description: Differences between the csv configuration and the live MAAS inventory
+import asyncio
+import ipaddress
+import time
+from src import allocation
+from src import dataExtractionFunctions as extract
+from src.layers import machine as node
+from src.layers.network import UNMANAGED_FABRICS
+from src.maas import MaasClient
+
+# Users MAAS creates for itself, never declared in the csv files
+SYSTEM_USERS = ("MAAS", "maas-init-node")
+
+
+# Normalize an ip address or a cidr so equal values compare equal
+def normalize_address(value):
+    value = (value or "").strip()
+    try:
+        if "/" in value:
+            return str(ipaddress.ip_network(value, strict=False))
+        return str(ipaddress.ip_address(value))
+    except ValueError:
+        return value
+
+
+def normalize_mac(value):
+    return (value or "").strip().lower()
+
+
+# Return the normalized pxe mac address of a MAAS machine
+def boot_mac_address(machine):
+    return normalize_mac((machine.get("boot_interface") or {}).get("mac_address"))
+
+
+# Convert an mtu cell to an integer, None when it is left to MAAS
+def parse_mtu(cell):
+    cell = str(cell).strip()
+    return int(cell) if cell.isdigit() else None
+
+
+def expected_inventory(csv_files, address_book=None):
+    """
+    Builds the inventory the csv files describe, keyed the way MAAS objects are matched.
+
+    :param csv_files: The csv file paths, keyed by configuration name.
+    :type csv_files: dict
+    :param address_book: The addresses allocated to the static nics.
+    :type address_book: AddressBook
+    :return: The fabrics, spaces, vlans, subnets, machines and users, the
+        users being None without a user csv file.
+    :rtype: dict
+    """
+    table = extract.NetworkTable(extract.read_csv_data(csv_files["network-config"]))
+    inventory = {
+        "fabrics": {
+            fabric for fabric in table.fabrics if fabric not in UNMANAGED_FABRICS
+        },
+        "spaces": set(table.spaces),
+        "vlans": {
+            (vlan["fabric_name"], int(vlan["vlan_id"])): {
+                "mtu": parse_mtu(vlan["mtu"]),
+                "space": vlan["space_name"],
+            }
+            for vlan in table.vlans
+        },
+        "subnets": {},
+        "machines": {},
+        "users": None,
+    }
+    subnet_cidrs = {}
+    for subnet in table.subnets:
+        cidr = normalize_address(subnet["attributes"]["cidr"])
+        subnet_cidrs[subnet["subnet_name"]] = cidr
+        inventory["subnets"][cidr] = {
+            "name": subnet["subnet_name"],
+            "gateway_ip": normalize_address(subnet["attributes"]["gateway_ip"]),
+            "vid": int(subnet["vlan_name"][len("vlan-") :]),
+            "fabric": subnet["fabric_name"],
+            "ip_ranges": sorted(
+                (
+                    ip_range["type"],
+                    normalize_address(ip_range["start_ip"]),
+                    normalize_address(ip_range["end_ip"]),
+                )
+                for ip_range in subnet["ip_ranges"]
+                if ip_range is not None
+            ),
+        }
+
+    machines = extract.load_records(csv_files["node-config"], extract.NodeRecord)
+    nic_index = extract.index_records(
+        extract.load_records(csv_files["nics-config"], extract.NicRecord), "nic"
+    )
+    addresses = allocation.allocate_addresses(
+        table.subnets, machines, nic_index, address_book
+    )
+    for machine in machines:
+        interfaces = {}
+        for nic, mac_address, ip_address in node.resolve_nics(
+            machine, nic_index, addresses
+        ):
+            tags = extract.split_cell(nic.tags)
+            interfaces[normalize_mac(mac_address)] = {
+                "name": nic.resource_name,
+                "vid": int(nic.vlan_id),
+                "tags": sorted(tags) if tags and nic.tags != "None" else [],
+                "mode": nic.mode.lower(),
+                "ip_address": normalize_address(ip_address or nic.ip_address)
+                if nic.mode.upper() == "STATIC"
+                else "",
+                "subnet": subnet_cidrs.get(nic.subnet_name, nic.subnet_name),
+            }
+        inventory["machines"][normalize_mac(machine.pxe_mac_address)] = {
+            "name": machine.resource_name,
+            "power_type": machine.power_type,
+            "interfaces": interfaces,
+        }
+
+    if "user-config" in csv_files:
+        inventory["users"] = {}
+        for user in extract.load_records(csv_files["user-config"], extract.UserRecord):
+            inventory["users"][user.resource_name] = {
+                "email": user.email,
+                "is_admin": extract.parse_bool(user.is_admin),
+            }
+    return inventory
+
+
+async def fetch_inventory(client, machine_macs):
+    """
+    Fetches the MAAS objects concurrently.
+
+    The vlans of each fabric are requested as soon as the fabrics are read,
+    and the interfaces of each machine managed by the csv files as soon as
+    the machines are read, while the other endpoints are still loading. The
+    machines the csv files don't declare are returned without their interfaces.
+
+    :param client: The MAAS API client.
+    :type client: MaasClient
+    :param machine_macs: The pxe mac addresses of the machines in the csv files.
+    :type machine_macs: set
+    :return: The fabrics, vlans, spaces, subnets, ip ranges, machines, other
+        machines and users.
+    :rtype: dict
+    """
+
+    async def fabrics_and_vlans():
+        fabrics = await client.get("fabrics/")
+        vlans = await asyncio.gather(
+            *(client.get(f"fabrics/{fabric['id']}/vlans/") for fabric in fabrics)
+        )
+        return fabrics, [vlan for fabric_vlans in vlans for vlan in fabric_vlans]
+
+    async def machines_and_interfaces():
+        machines = []
+        other_machines = []
+        for machine in await client.get("machines/"):
+            if boot_mac_address(machine) in machine_macs:
+                machines.append(machine)
+            else:
+                other_machines.append(machine)
+        interfaces = await asyncio.gather(
+            *(
+                client.get(f"nodes/{machine['system_id']}/interfaces/")
+                for machine in machines
+            )
+        )
+        return list(zip(machines, interfaces)), other_machines
+
+    (
+        (fabrics, vlans),
+        spaces,
+        subnets,
+        ip_ranges,
+        (machines, other_machines),
+        users,
+    ) = (
+        await asyncio.gather(
+            fabrics_and_vlans(),
+            client.get("spaces/"),
+            client.get("subnets/"),
+            client.get("ipranges/"),
+            machines_and_interfaces(),
+            client.get("users/"),
+        )
+    )
+    return {
+        "fabrics": fabrics,
+        "vlans": vlans,
+        "spaces": spaces,
+        "subnets": subnets,
+        "ip_ranges": ip_ranges,
+        "machines": machines,
+        "other_machines": other_machines,
+        "users": users,
+    }
+
+
+# Add a difference for each object found in MAAS but not in the csv files
+def report_undeclared(differences, labels):
+    differences.extend(f"{label}: not in the csv" for label in sorted(labels))
+
+
+# Compare the attributes of an object, adding a difference for each mismatch
+def compare_fields(differences, label, expected, actual, fields):
+    for field in fields:
+        if expected[field] != actual.get(field):
+            differences.append(
+                f"{label}: {field} is {actual.get(field)!r} in MAAS, "
+                f"{expected[field]!r} in the csv"
+            )
+
+
+def compare_inventories(expected, live):
+    """
+    Lists the differences between the csv inventory and the MAAS inventory.
+
+    Objects missing in MAAS, objects MAAS holds that the csv files don't
+    declare and mismatching attributes are all reported. The fabrics MAAS
+    creates by itself, the untagged vlan of each fabric and the MAAS system
+    users are left out, as are the users when the csv files have none.
+
+    :param expected: The inventory built by expected_inventory.
+    :type expected: dict
+    :param live: The inventory returned by fetch_inventory.
+    :type live: dict
+    :return: A description of each difference.
+    :rtype: list
+    """
+    differences = []
+
+    fabrics = {fabric["name"] for fabric in live["fabrics"]}
+    differences.extend(
+        f"fabric {name}: missing in MAAS"
+        for name in sorted(expected["fabrics"] - fabrics)
+    )
+    spaces = {space["name"] for space in live["spaces"]}
+    differences.extend(
+        f"space {name}: missing in MAAS" for name in sorted(expected["spaces"] - spaces)
+    )
+    report_undeclared(
+        differences, (f"space {name}" for name in spaces - expected["spaces"])
+    )
+
+    vlans = {(vlan["fabric"], vlan["vid"]): vlan for vlan in live["vlans"]}
+    matched_vlans = set()
+    for (fabric, vid), vlan in expected["vlans"].items():
+        label = f"vlan {vid} on fabric {fabric}"
+        if fabric in UNMANAGED_FABRICS:
+            # The vlans of the unmanaged fabrics are matched by vid alone
+            key = next((key for key in vlans if key[1] == vid), None)
+        else:
+            key = (fabric, vid)
+        actual = vlans.get(key)
+        if actual is None:
+            differences.append(f"{label}: missing in MAAS")
+            continue
+        matched_vlans.add(key)
+        if vlan["mtu"] is not None and vlan["mtu"] != actual.get("mtu"):
+            differences.append(
+                f"{label}: mtu is {actual.get('mtu')} in MAAS, {vlan['mtu']} in the csv"
+            )
+        if vlan["space"] and vlan["space"] != actual.get("space"):
+            differences.append(
+                f"{label}: space is {actual.get('space')!r} in MAAS, "
+                f"{vlan['space']!r} in the csv"
+            )
+    # A fabric holding a matched vlan is declared, whatever MAAS named it, and
+    # the vlans of an undeclared fabric are covered by the fabric itself
+    declared_fabrics = expected["fabrics"] | {fabric for fabric, _ in matched_vlans}
+    report_undeclared(
+        differences,
+        (
+            f"fabric {name}"
+            for name in fabrics - declared_fabrics
+            if name not in UNMANAGED_FABRICS
+        ),
+    )
+    report_undeclared(
+        differences,
+        (
+            f"vlan {vid} on fabric {fabric}"
+            for fabric, vid in set(vlans) - matched_vlans
+            if vid != 0
+            and (fabric in declared_fabrics or fabric in UNMANAGED_FABRICS)
+        ),
+    )
+
+    ip_ranges = {}
+    for ip_range in live["ip_ranges"]:
+        cidr = normalize_address((ip_range.get("subnet") or {}).get("cidr"))
+        ip_ranges.setdefault(cidr, []).append(
+            (
+                ip_range["type"],
+                normalize_address(ip_range["start_ip"]),
+                normalize_address(ip_range["end_ip"]),
+            )
+        )
+    subnets = {normalize_address(subnet["cidr"]): subnet for subnet in live["subnets"]}
+    for cidr, subnet in expected["subnets"].items():
+        label = f"subnet {subnet['name']} ({cidr})"
+        actual = subnets.get(cidr)
+        if actual is None:
+            differences.append(f"{label}: missing in MAAS")
+            continue
+        vlan = actual.get("vlan") or {}
+        compare_fields(
+            differences,
+            label,
+            subnet,
+            {
+                "gateway_ip": normalize_address(actual.get("gateway_ip")),
+                "vid": vlan.get("vid"),
+                "fabric": vlan.get("fabric"),
+                "ip_ranges": sorted(ip_ranges.get(cidr, [])),
+            },
+            ["gateway_ip", "vid", "ip_ranges"]
+            + ([] if subnet["fabric"] in UNMANAGED_FABRICS else ["fabric"]),
+        )
+    report_undeclared(
+        differences,
+        (f"subnet {cidr}" for cidr in set(subnets) - set(expected["subnets"])),
+    )
+
+    machines = {
+        boot_mac_address(machine): (machine, interfaces)
+        for machine, interfaces in live["machines"]
+    }
+    for mac_address, machine in expected["machines"].items():
+        label = f"machine {machine['name']} ({mac_address})"
+        if mac_address not in machines:
+            differences.append(f"{label}: missing in MAAS")
+            continue
+        actual, interfaces = machines[mac_address]
+        compare_fields(differences, label, machine, actual, ["power_type"])
+
+        interfaces = {
+            normalize_mac(interface["mac_address"]): interface
+            for interface in interfaces
+        }
+        for interface_mac, interface in machine["interfaces"].items():
+            interface_label = f"{label} interface {interface['name']} ({interface_mac})"
+            found = interfaces.get(interface_mac)
+            if found is None:
+                differences.append(f"{interface_label}: missing in MAAS")
+                continue
+            link = (found.get("links") or [{}])[0]
+            compare_fields(
+                differences,
+                interface_label,
+                interface,
+                {
+                    "name": found.get("name"),
+                    "vid": (found.get("vlan") or {}).get("vid"),
+                    "tags": sorted(found.get("tags") or []),
+                    "mode": (link.get("mode") or "").lower(),
+                    "ip_address": normalize_address(link.get("ip_address"))
+                    if interface["mode"] == "static"
+                    else "",
+                    "subnet": normalize_address(
+                        (link.get("subnet") or {}).get("cidr")
+                    ),
+                },
+                ["name", "vid", "tags", "mode", "ip_address", "subnet"],
+            )
+        report_undeclared(
+            differences,
+            (
+                f"{label} interface {found.get('name')} ({interface_mac})"
+                for interface_mac, found in interfaces.items()
+                if interface_mac not in machine["interfaces"]
+                and found.get("type", "physical") == "physical"
+            ),
+        )
+    report_undeclared(
+        differences,
+        (
+            f"machine {machine.get('hostname')} ({boot_mac_address(machine)})"
+            for machine in live["other_machines"]
+        ),
+    )
+
+    if expected["users"] is None:
+        return differences
+    users = {user["username"]: user for user in live["users"]}
+    for name, user in expected["users"].items():
+        label = f"user {name}"
+        if name not in users:
+            differences.append(f"{label}: missing in MAAS")
+            continue
+        compare_fields(
+            differences,
+            label,
+            user,
+            {
+                "email": users[name].get("email"),
+                "is_admin": users[name].get("is_superuser"),
+            },
+            ["email", "is_admin"],
+        )
+    report_undeclared(
+        differences,
+        (
+            f"user {name}"
+            for name in set(users) - set(expected["users"])
+            if name not in SYSTEM_USERS
+        ),
+    )
+
+    return differences
+
+
+async def scan(
+    csv_files,
+    api_url,
+    api_key,
+    concurrency=8,
+    rate=50,
+    timeout=30,
+    address_book=None,
+):
+    """
+    Compares the csv files with the live MAAS inventory.
+
+    :param csv_files: The csv file paths, keyed by configuration name.
+    :type csv_files: dict
+    :param api_url: The MAAS url.
+    :type api_url: str
+    :param api_key: The MAAS API key.
+    :type api_key: str
+    :param concurrency: The maximum number of requests in flight.
+    :type concurrency: int
+    :param rate: The maximum number of requests per second, 0 for no limit.
+    :type rate: float
+    :param timeout: The timeout of each request in seconds.
+    :type timeout: float
+    :param address_book: The addresses allocated to the static nics.
+    :type address_book: AddressBook
+    :return: The differences, the number of requests sent and the elapsed seconds.
+    :rtype: tuple
+    """
+    start = time.perf_counter()
+    expected = expected_inventory(csv_files, address_book)
+    async with MaasClient(api_url, api_key, concurrency, rate, timeout) as client:
+        live = await fetch_inventory(client, set(expected["machines"]))
+    differences = compare_inventories(expected, live)
+    return differences, client.requests, time.perf_counter() - start
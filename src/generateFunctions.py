@@ -1,78 +1,106 @@
+import itertools
+import sys
+from src import hcl
+from src import tfjson
+from src import tracing
+from src.blocks import generate_terraform_provider
+from src.graph import ResourceGraph
 from src.layers import network as net
 from src.layers import machine as node
 from src.layers import user
 
+# Size of the write buffer used when streaming the script to disk
+WRITE_BUFFER_SIZE = 1024 * 1024
 
-# PROVIDER BLOCK
-def generate_terraform_provider(provider_name, provider_attributes):
-    # Define the basic template for the provider block
-    provider_template = """provider "{provider_name}" {{
-{attributes}
-}}\n\n"""
-
-    # Format the attributes
-    formatted_attributes = "\n".join(
-        f'  {key} = "{value}"' for key, value in provider_attributes.items()
-    )
-
-    # Combine the template and attributes to create the provider block
-    provider_block = provider_template.format(
-        provider_name=provider_name, attributes=formatted_attributes
-    )
-
-    return provider_block
-
-
-# RESOURCE BLOCKS
-def generate_terraform_resource(resource_type, resource_name, resource_attributes):
-    # Define the basic template for the resource block
-    resource_template = """resource "{resource_type}" "{resource_name}" {{
-{attributes}
-}}\n\n"""
-
-    # Format the attributes
-    formatted_attributes = "\n".join(
-        f'  {key} = "{value}"' for key, value in resource_attributes.items()
-    )
-
-    # Combine the template and attributes to create the resource block
-    resource_block = resource_template.format(
-        resource_type=resource_type,
-        resource_name=resource_name,
-        attributes=formatted_attributes,
+# Terraform settings block with the provider requirements
+TERRAFORM_BLOCK = hcl.Block(
+    "terraform",
+    body=[
+        hcl.Block(
+            "required_providers",
+            body=[("maas", {"source": "maas/maas", "version": "~>1.0"})],
+        )
+    ],
+)
+
+# Modules rendering the blocks for each output format
+OUTPUT_FORMATS = {"hcl": hcl, "json": tfjson}
+
+
+# Generate complete terraform script, yielding it block by block. The document is
+# only closed once every reference between the resources has been checked
+def generate_terraform_script(
+    api_key,
+    api_url,
+    csv_files,
+    jobs=1,
+    cache=None,
+    output_format=hcl,
+    address_book=None,
+):
+    yield output_format.open_document(
+        [
+            TERRAFORM_BLOCK,
+            generate_terraform_provider(
+                "maas", {"api_version": "2.0", "api_key": api_key, "api_url": api_url}
+            ),
+        ]
     )
 
-    return resource_block
+    graph = ResourceGraph()
+    blocks = [
+        tracing.iterate(
+            "network layer",
+            net.generate_terraform_network_script(
+                csv_files["network-config"], cache, output_format, graph
+            ),
+            "resources",
+        ),
+        tracing.iterate(
+            "machine layer",
+            node.generate_terraform_node_script(
+                csv_files["node-config"],
+                csv_files["partition-config"],
+                csv_files["nics-config"],
+                csv_files["network-config"],
+                jobs,
+                cache,
+                output_format,
+                graph,
+                address_book,
+            ),
+            "machines",
+        ),
+    ]
+    if "user-config" in csv_files:
+        blocks.append(
+            tracing.iterate(
+                "user layer",
+                user.generate_terraform_user_script(
+                    csv_files["user-config"], cache, output_format, graph
+                ),
+                "users",
+            )
+        )
 
+    # Separate the resource blocks
+    first = True
+    for block in itertools.chain.from_iterable(blocks):
+        if not first:
+            yield output_format.SEPARATOR
+        first = False
+        yield block
 
-# Generate complete terraform script
-def generate_terraform_script(api_key, api_url, csv_files):
-    terraform_script = """terraform {
-      required_providers {
-        maas = {
-          source  = "maas/maas"
-          version = "~>1.0"
-        }
-      }
-    }\n\n"""
+    graph.check()
+    yield output_format.close_document()
 
-    # Add provider block
-    terraform_script += generate_terraform_provider(
-        "maas", {"api_version": "2.0", "api_key": api_key, "api_url": api_url}
-    )
 
-    terraform_script += net.generate_terraform_network_script(
-        csv_files["network-config"]
-    )
-    terraform_script += node.generate_terraform_node_script(
-        csv_files["node-config"],
-        csv_files["partition-config"],
-        csv_files["nics-config"],
-    )
-
-    if "user-config" in csv_files:
-        terraform_script += user.generate_terraform_user_script(
-            csv_files["user-config"],
-        )
+# Write the generated blocks to the output file, or to stdout if no file is given
+def write_terraform_script(blocks, output_path=None):
+    if output_path is None:
+        sys.stdout.writelines(blocks)
+        sys.stdout.flush()
+        return
 
-    return terraform_script
+    with open(output_path, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        f.writelines(blocks)
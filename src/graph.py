@@ -0,0 +1,190 @@
+# Description: Resource graph of the generated configuration, with its reference edges
+import collections
+from src import hcl
+
+
+class Reference(hcl.Expression):
+    """
+    A reference to an attribute of another resource, e.g. maas_vlan.vlan-412.vid.
+
+    It is written as an expression by every output format and tells the
+    graph which resource it points to.
+
+    Args:
+        resource_type (str): The type of the referenced resource.
+        name (str): The name of the referenced resource.
+        attribute (str): The referenced attribute.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, resource_type, name, attribute):
+        return str.__new__(cls, f"{resource_type}.{name}.{attribute}")
+
+    def __getnewargs__(self):
+        resource_type, rest = self.split(".", 1)
+        return (resource_type, *rest.rsplit(".", 1))
+
+    @property
+    def address(self):
+        return self.rsplit(".", 1)[0]
+
+
+# Add the addresses referenced by a block body, nested blocks included
+def link(body, references):
+    for item in body:
+        if item.__class__ is tuple:
+            if item[1].__class__ is Reference:
+                references.append(item[1].rpartition(".")[0])
+        else:
+            link(item.body, references)
+    return references
+
+
+def render_blocks(blocks, render, separator):
+    """
+    Renders resource blocks together, as one cache entry.
+
+    :param blocks: The resource blocks.
+    :type blocks: Iterator[Block]
+    :param render: The function rendering a block.
+    :type render: function
+    :param separator: The text written between two rendered blocks.
+    :type separator: str
+    :return: The rendered blocks and their resources, one line per block
+        with its address followed by the addresses it references.
+    :rtype: list
+    """
+    blocks = list(blocks)
+    return [
+        separator.join(render(block) for block in blocks),
+        "\n".join(
+            " ".join([".".join(block.labels), *link(block.body, [])])
+            for block in blocks
+        ),
+    ]
+
+
+class Resource(collections.namedtuple("Resource", "type name references")):
+    """
+    A resource of the graph.
+
+    Args:
+        type (str): The resource type, e.g. maas_vlan.
+        name (str): The resource name.
+        references (tuple): The addresses of the resources it references.
+    """
+
+    __slots__ = ()
+
+    @property
+    def address(self):
+        return f"{self.type}.{self.name}"
+
+    @classmethod
+    def parse(cls, line):
+        """
+        Returns the resource of a line written by render_blocks.
+        """
+        address, *references = line.split(" ")
+        resource_type, _, name = address.partition(".")
+        return cls(resource_type, name, tuple(references))
+
+
+class ResourceGraph:
+    """
+    The resources of a configuration and the references between them.
+
+    The graph is filled while the layers render, one entry at a time, and
+    indexes each resource by address, so every reference is checked with
+    one lookup. Entries reused from the cache bring their resources cached
+    with them, so no block is generated only to be checked.
+    """
+
+    def __init__(self):
+        self.resources = {}
+        self.duplicates = collections.Counter()
+        self.external = set()
+
+    def __len__(self):
+        return len(self.resources) + sum(self.duplicates.values())
+
+    def add(self, resource):
+        address = resource.address
+        if address in self.resources:
+            self.duplicates[address] += 1
+        self.resources[address] = resource
+
+    def add_entry(self, resources):
+        """
+        Adds the resources of a cache entry, as written by render_blocks.
+        """
+        for line in resources.split("\n") if resources else ():
+            self.add(Resource.parse(line))
+
+    def add_external(self, address):
+        """
+        Declares a resource that exists outside the configuration, such as a
+        fabric MAAS creates by itself, so references to it are valid.
+        """
+        self.external.add(address)
+
+    def render(self, cache, key, source, render_entry, *args):
+        """
+        Returns the rendered blocks of a cache entry and adds their resources to the graph.
+
+        render_entry(*args) is only called when source changed since the
+        entry was cached, and returns what render_blocks does.
+        """
+        text, resources = cache.render(key, source, render_entry, *args)
+        self.add_entry(resources)
+        return text
+
+    def missing_references(self):
+        """
+        Lists the resources defined twice and the references to resources that
+        are neither in the graph nor external.
+
+        :return: A description of each mistake.
+        :rtype: list
+        """
+        errors = [
+            f"{address} is defined {count + 1} times"
+            for address, count in self.duplicates.items()
+        ]
+        resources = self.resources
+        external = self.external
+        for resource in resources.values():
+            for reference in resource.references:
+                if reference not in resources and reference not in external:
+                    errors.append(
+                        f"{resource.address}: {reference} is referenced but not defined"
+                    )
+        return errors
+
+    def check(self):
+        """
+        Raises an exception listing the duplicate resources and dangling references, if any.
+        """
+        errors = self.missing_references()
+        if errors:
+            raise Exception("Invalid configuration:\n" + "\n".join(errors))
+
+    def output_blocks(self, resource_types):
+        """
+        Generates an output block per resource type, mapping the name of each
+        resource of the type in the graph to the resource.
+
+        :param resource_types: The resource types, e.g. maas_vlan.
+        :type resource_types: Iterable[str]
+        :return: The output blocks.
+        :rtype: list
+        """
+        names = {resource_type: {} for resource_type in resource_types}
+        for resource in self.resources.values():
+            if resource.type in names:
+                names[resource.type][resource.name] = hcl.Expression(resource.address)
+        return [
+            hcl.Block("output", [resource_type], [("value", values)])
+            for resource_type, values in names.items()
+        ]
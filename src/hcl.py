@@ -0,0 +1,118 @@
+# Description: Emitter of terraform fmt canonical HCL
+INDENT = "  "
+EXTENSION = ".tf"
+
+
+class Expression(str):
+    """
+    An HCL expression written as is, such as a reference to another resource.
+    Plain strings are written as quoted and escaped string literals.
+    """
+
+    __slots__ = ()
+
+
+class Block:
+    """
+    An HCL block such as a resource, a provider or a nested block.
+
+    Args:
+        type (str): The block type, e.g. "resource" or "partitions".
+        labels (list): The block labels, e.g. the resource type and name.
+        body (list): The (name, value) attribute pairs and the nested Block
+            objects, in the order they are written.
+    """
+
+    __slots__ = ("type", "labels", "body")
+
+    def __init__(self, type, labels=(), body=()):
+        self.type = type
+        self.labels = list(labels)
+        self.body = list(body)
+
+
+# Escape a string literal
+def quote(value):
+    value = (
+        value.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\t", "\\t")
+        .replace("${", "$${")
+        .replace("%{", "%%{")
+    )
+    return f'"{value}"'
+
+
+# Render a value written on a single line
+def render_value(value):
+    if isinstance(value, Expression):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(render_value(item) for item in value) + "]"
+    return quote(str(value))
+
+
+# Render attributes and nested blocks, aligning the = of consecutive single line attributes
+def render_body(body, indent):
+    lines = []
+    padding = INDENT * indent
+    group = []
+
+    def close_group():
+        width = max(len(name) for name, _ in group)
+        lines.extend(
+            f"{padding}{name.ljust(width)} = {render_value(value)}"
+            for name, value in group
+        )
+        group.clear()
+
+    for item in body:
+        if isinstance(item, tuple) and not isinstance(item[1], dict):
+            group.append(item)
+            continue
+        if group:
+            close_group()
+        if isinstance(item, Block):
+            lines.extend(render_block_lines(item, indent))
+        else:
+            # Objects span several lines and are not aligned with their neighbours
+            name, value = item
+            lines.append(f"{padding}{name} = {{")
+            lines.extend(render_body(list(value.items()), indent + 1))
+            lines.append(f"{padding}}}")
+    if group:
+        close_group()
+    return lines
+
+
+def render_block_lines(block, indent=0):
+    padding = INDENT * indent
+    header = " ".join([block.type, *(quote(label) for label in block.labels)])
+    lines = [f"{padding}{header} {{"]
+    lines.extend(render_body(block.body, indent + 1))
+    lines.append(f"{padding}}}")
+    return lines
+
+
+# Render a top level block
+def render_block(block):
+    return "\n".join(render_block_lines(block)) + "\n"
+
+
+# Written between two top level blocks
+SEPARATOR = "\n"
+
+
+# Start of the document, holding the settings and provider blocks
+def open_document(blocks):
+    return "".join(render_block(block) + SEPARATOR for block in blocks)
+
+
+def close_document():
+    return ""
@@ -1,4 +1,19 @@
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from src import allocation
 from src import dataExtractionFunctions as extract
+from src import hcl
+from src import tracing
+from src.cache import RenderCache
+from src.graph import Reference
+from src.graph import ResourceGraph
+from src.graph import render_blocks
+
+# Below this number of machines the rendering is done serially, as starting
+# the worker processes costs more than it saves
+PARALLEL_MIN_MACHINES = 1000
+# Number of chunks handed to each worker process
+CHUNKS_PER_JOB = 4
 
 
 def generate_terraform_resource_machine(data):
@@ -6,179 +21,462 @@ def generate_terraform_resource_machine(data):
     Generates a Terraform resource block for a machine.
 
     Args:
-        data (dict): A dictionary containing the data for the resource block.
-            - "resource_name" (str): The name of the resource.
-            - "power_type" (str): The type of power for the machine.
-            - "power_pass" (str): The password for the power.
-            - "power_address" (str): The address for the power.
-            - "pxe_mac_address" (str): The PXE MAC address for the machine.
+        data (NodeRecord): The machine row for the resource block.
+            - resource_name (str): The name of the resource.
+            - power_type (str): The type of power for the machine.
+            - power_pass (str): The password for the power.
+            - power_address (str): The address for the power.
+            - pxe_mac_address (str): The PXE MAC address for the machine.
 
     Returns:
-        str: The generated Terraform resource block for the machine.
-    """
-    resource_template = """resource "maas_machine" "{resource_name}" {{
-    power_type = "{power_type}"
-    power_parameters = {{
-        power_pass = "{power_pass}"
-        power_address = "{power_address}"
-    }}
-    pxe_mac_address = "{pxe_mac_address}"
-    }}\n\n"""
-
-    resource_block = resource_template.format(
-        resource_name=data["resource_name"],
-        power_type=data["power_type"],
-        power_pass=data["power_pass"],
-        power_address=data["power_address"],
-        pxe_mac_address=data["pxe_mac_address"],
+        Block: The generated Terraform resource block for the machine.
+    """
+    return hcl.Block(
+        "resource",
+        ["maas_machine", data.resource_name],
+        [
+            ("power_type", data.power_type),
+            (
+                "power_parameters",
+                {
+                    "power_pass": data.power_pass,
+                    "power_address": data.power_address,
+                },
+            ),
+            ("pxe_mac_address", data.pxe_mac_address),
+        ],
     )
-    return resource_block
 
 
 def generate_partition(partition):
     """
-    Generate the partition resource template based on the given partition information.
+    Generate the partitions block based on the given partition information.
 
     Args:
-        partition (dict): A dictionary containing the partition information.
+        partition (PartitionRecord): The partition information.
 
     Returns:
-        str: The formatted partition resource template.
-
-    """
-    resource_template = """partitions {{
-     size_gigabytes = "{size_gigabytes}"
-     fs_type        = "{fs_type}"
-     label          = "{label}"
-     bootable       = "{bootable}"
-     mount_point    = "{mount_point}"
-    }}\n\n
-    """
-    return resource_template.format(
-        size_gigabytes=partition["size_gigabytes"],
-        fs_type=partition["fs_type"],
-        label=partition["label"],
-        bootable=partition["bootable"],
-        mount_point=partition["resource_name"],
+        Block: The partitions block of the block device.
+
+    """
+    return hcl.Block(
+        "partitions",
+        body=[
+            ("size_gigabytes", partition.size_gigabytes),
+            ("fs_type", partition.fs_type),
+            ("label", partition.label),
+            ("bootable", partition.bootable),
+            ("mount_point", partition.resource_name),
+        ],
     )
 
 
-def generate_nic(machine_name, data, mac_address):
+def generate_nic(machine_name, data, mac_address, ip_address=None):
     """
-    Generates a resource template for a physical network interface.
+    Generates the physical network interface and link resource blocks of a machine nic.
 
     Parameters:
-        data (dict): A dictionary containing the following keys:
-            - nic_name (str): The name of the network interface.
-            - mac_address (str): The MAC address of the network interface.
-            - resource_name (str): The name of the resource.
+        machine_name (str): The name of the machine resource.
+        data (NicRecord): The nic row, with the following attributes:
+            - resource_name (str): The name of the network interface.
             - vlan_id (number): The vlan id associated.
-            - tags (Set of String): A set of tag names to be assigned to the physical network interface
+            - tags (str): Comma separated tag names to be assigned to the physical network interface
+            - mode (str): The link mode, e.g. DHCP or STATIC.
+            - ip_address (str): The static ip address typed in the csv, if any.
+            - default_gateway (str): Whether the link is the default gateway.
+            - subnet_name (str): The name of the subnet resource.
+        mac_address (str): The MAC address of the network interface.
+        ip_address (str): The static ip address of the link, typed in the csv
+            or allocated from the subnet.
 
     Returns:
-        str: The generated resource template.
-    """
-    ip_address = ""
-    if data["ip_address"] and data["mode"].upper() == "STATIC":
-        ip_address = f'ip_address = "{data["ip_address"]}"'
-    tags = ""
-    if data["tags"] != "None":
-        tags = '","'.join(("tag1,tag2,tag3".split(",")))
-        tags = f'tags = ["{tags}"]'
-
-    resource_template = """resource "maas_network_interface_physical" "{resource_name}-{nic_name}"{{
-        machine     = maas_machine.{resource_name}.id
-        mac_address = "{mac_address}"
-        name        = "{nic_name}"
-        vlan        = maas_vlan.vlan-{vlan_id}.vid
-        {tags}
-}}\n\n
-
-resource "maas_network_interface_link" "{resource_name}-{nic_name}" {{
-  machine = maas_machine.{resource_name}.id
-  network_interface = maas_network_interface_physical.{resource_name}-{nic_name}.id
-  mode = "{mode}"
-  {ip_address}
-  default_gateway = {default_gateway}
-  subnet = maas_subnet.{subnet}.id
-}}
-    """
-    return resource_template.format(
-        nic_name=data["resource_name"],
-        mac_address=mac_address,
-        resource_name=machine_name,
-        vlan_id=data["vlan_id"],
-        tags=tags,
-        mode=data["mode"].upper(),
-        ip_address=ip_address,
-        default_gateway=data["default_gateway"] or False,
-        subnet=data["subnet_name"],
-    )
+        list: The generated physical interface and link resource blocks.
+    """
+    resource_name = f"{machine_name}-{data.resource_name}"
+    physical = [
+        ("machine", Reference("maas_machine", machine_name, "id")),
+        ("mac_address", mac_address),
+        ("name", data.resource_name),
+        ("vlan", Reference("maas_vlan", f"vlan-{data.vlan_id}", "vid")),
+    ]
+    tags = extract.split_cell(data.tags)
+    if tags and data.tags != "None":
+        physical.append(("tags", tags))
+
+    mode = data.mode.upper()
+    link = [
+        ("machine", Reference("maas_machine", machine_name, "id")),
+        (
+            "network_interface",
+            Reference("maas_network_interface_physical", resource_name, "id"),
+        ),
+        ("mode", mode),
+    ]
+    ip_address = ip_address or data.ip_address
+    if ip_address and mode == "STATIC":
+        link.append(("ip_address", ip_address))
+    link.append(("default_gateway", extract.parse_bool(data.default_gateway)))
+    link.append(("subnet", Reference("maas_subnet", data.subnet_name, "id")))
+
+    return [
+        hcl.Block(
+            "resource", ["maas_network_interface_physical", resource_name], physical
+        ),
+        hcl.Block("resource", ["maas_network_interface_link", resource_name], link),
+    ]
 
 
 def generate_block_device(data, partition_csv):
     """
-    Generates a block device resource template based on the provided data and partition CSV.
+    Generates a block device resource block based on the provided data and partition CSV.
 
-    :param data: A dictionary containing the data for generating the resource template.
-    :type data: dict
-    :param partition_csv: A list of dictionaries representing the partition CSV.
+    :param data: The machine row for generating the resource block.
+    :type data: NodeRecord
+    :param partition_csv: The partition rows of the machine.
     :type partition_csv: list
-    :return: The generated resource template as a string.
-    :rtype: str
+    :return: The generated resource block.
+    :rtype: Block
     """
-    resource_template = """resource "maas_block_device" "{resource_name}-block-device" {{
-  machine = maas_machine.{resource_name}.id
-  name = "{name}"
-  id_path = "{id_path}"
-  size_gigabytes = "{size}"
-  {partitions}
-}}\n\n
-"""
-    partitions = ""
+    partitions = []
     total_size = 0
     for p in partition_csv:
-        partitions += generate_partition(p)
-        total_size += int(p["size_gigabytes"])
-    return resource_template.format(
-        resource_name=data["resource_name"],
-        name=data["resource_name"]+data["id_path"],
-        id_path=data["id_path"],
-        size=total_size,
-        partitions=partitions,
+        partitions.append(generate_partition(p))
+        total_size += int(p.size_gigabytes)
+    return hcl.Block(
+        "resource",
+        ["maas_block_device", f"{data.resource_name}-block-device"],
+        [
+            ("machine", Reference("maas_machine", data.resource_name, "id")),
+            ("name", data.resource_name + data.id_path),
+            ("id_path", data.id_path),
+            ("size_gigabytes", str(total_size)),
+            *partitions,
+        ],
+    )
+
+
+def resolve_machine(machine, partition_index, nic_index, addresses=None):
+    """
+    Resolves the partitions and nics referenced by a machine through the indexes.
+
+    :param machine: The machine row.
+    :type machine: NodeRecord
+    :param partition_index: The partition rows indexed by resource name.
+    :type partition_index: dict
+    :param nic_index: The nic rows indexed by resource name.
+    :type nic_index: dict
+    :param addresses: The allocated ip addresses keyed by (machine name, nic name).
+    :type addresses: dict
+    :return: The machine partitions, in schema order, and the (nic, mac address, ip address) tuples.
+    :rtype: tuple
+    """
+    return (
+        resolve_partitions(machine, partition_index),
+        resolve_nics(machine, nic_index, addresses),
+    )
+
+
+# Resolve the partitions of a machine, in schema order
+def resolve_partitions(machine, partition_index):
+    partitions = []
+    for name in extract.split_cell(machine.partition_schema):
+        if name not in partition_index:
+            raise Exception(
+                f"Machine {machine.resource_name} references unknown partition: {name}"
+            )
+        partitions.append(partition_index[name])
+    return partitions
+
+
+def resolve_nics(machine, nic_index, addresses=None):
+    """
+    Resolves the nics referenced by a machine, paired with their mac and ip address.
+
+    :param machine: The machine row.
+    :type machine: NodeRecord
+    :param nic_index: The nic rows indexed by resource name.
+    :type nic_index: dict
+    :param addresses: The allocated ip addresses keyed by (machine name, nic name).
+    :type addresses: dict
+    :return: The (nic, mac address, ip address) tuples.
+    :rtype: list
+    """
+    nic_names = extract.split_cell(machine.nic_name)
+    mac_addresses = extract.split_cell(machine.mac_address)
+    if len(nic_names) != len(mac_addresses):
+        raise Exception(
+            f"Machine {machine.resource_name} has {len(nic_names)} nics "
+            f"but {len(mac_addresses)} mac addresses"
+        )
+    nics = []
+    for name, mac_address in zip(nic_names, mac_addresses):
+        if name not in nic_index:
+            raise Exception(
+                f"Machine {machine.resource_name} references unknown nic: {name}"
+            )
+        ip_address = (addresses or {}).get((machine.resource_name, name))
+        nics.append((nic_index[name], mac_address, ip_address))
+
+    return nics
+
+
+def generate_machine(machine, partitions, nics):
+    """
+    Generates the machine, block device and nic resource blocks of one machine.
+
+    :param machine: The machine row.
+    :type machine: NodeRecord
+    :param partitions: The partitions of the machine.
+    :type partitions: list
+    :param nics: The (nic, mac address, ip address) tuples of the machine.
+    :type nics: list
+    :return: The generated resource blocks.
+    :rtype: Iterator[Block]
+    """
+    yield generate_terraform_resource_machine(machine)
+    yield generate_block_device(machine, partitions)
+    for nic, mac_address, ip_address in nics:
+        yield from generate_nic(machine.resource_name, nic, mac_address, ip_address)
+
+
+class ReferencedRows:
+    """
+    Digests of the partition and nic rows the machines reference.
+
+    The partition_schema and nic_name cells repeat across the machines, so
+    each distinct cell is resolved and hashed once, and a machine whose
+    blocks are cached is fingerprinted without being resolved.
+
+    Args:
+        partition_index (dict): The partition rows indexed by resource name.
+        nic_index (dict): The nic rows indexed by resource name.
+    """
+
+    def __init__(self, partition_index, nic_index):
+        self.partition_index = partition_index
+        self.nic_index = nic_index
+        self.partition_digests = {}
+        self.nic_digests = {}
+
+    def partitions(self, machine):
+        """
+        Returns the digest of the partition rows of a machine.
+        """
+        digest = self.partition_digests.get(machine.partition_schema)
+        if digest is None:
+            digest = RenderCache.fingerprint(
+                [
+                    partition.values()
+                    for partition in resolve_partitions(machine, self.partition_index)
+                ]
+            )
+            self.partition_digests[machine.partition_schema] = digest
+        return digest
+
+    def nics(self, machine):
+        """
+        Returns the digest of the nic rows of a machine and the names of its nics.
+        """
+        entry = self.nic_digests.get(machine.nic_name)
+        if entry is None:
+            names = extract.split_cell(machine.nic_name)
+            for name in names:
+                if name not in self.nic_index:
+                    raise Exception(
+                        f"Machine {machine.resource_name} references unknown nic: {name}"
+                    )
+            entry = (
+                RenderCache.fingerprint([self.nic_index[name].values() for name in names]),
+                names,
+            )
+            self.nic_digests[machine.nic_name] = entry
+        return entry
+
+
+def machine_source(machine, rows, addresses=None):
+    """
+    Returns the text a machine's blocks are rendered from, used to fingerprint
+    them: its row, the digests of the partition and nic rows it references
+    and the ip addresses allocated to its nics.
+
+    :param machine: The machine row.
+    :type machine: NodeRecord
+    :param rows: The digests of the referenced partition and nic rows.
+    :type rows: ReferencedRows
+    :param addresses: The allocated ip addresses keyed by (machine name, nic name).
+    :type addresses: dict
+    :rtype: str
+    """
+    nics, nic_names = rows.nics(machine)
+    source = [*machine.values(), rows.partitions(machine), nics]
+    if addresses:
+        source.extend(
+            addresses.get((machine.resource_name, name)) or "" for name in nic_names
+        )
+    return "\x1f".join(source)
+
+
+def render_machine(machine, partitions, nics, render, separator):
+    """
+    Renders the resource blocks of one resolved machine.
+
+    :param render: The function rendering a block.
+    :type render: function
+    :param separator: The text written between two rendered blocks.
+    :type separator: str
+    :return: The resource blocks of the machine, separated, and their
+        resources, as render_blocks returns them.
+    :rtype: list
+    """
+    return render_blocks(
+        generate_machine(machine, partitions, nics), render, separator
     )
 
 
-def generate_terraform_node_script(machines_config, partitions_config, nics_config):
+def render_machines(resolved_machines, render, separator):
+    """
+    Renders a chunk of resolved machines, used by the worker processes.
+
+    :param resolved_machines: The (machine, partitions, nics) tuples to render.
+    :type resolved_machines: list
+    :return: What render_machine returns for each machine of the chunk.
+    :rtype: list
     """
-    Generates a Terraform script for creating resources based on the provided machines and partitions configurations.
+    return [
+        render_machine(*resolved, render, separator) for resolved in resolved_machines
+    ]
+
+
+def generate_terraform_node_script(
+    machines_config,
+    partitions_config,
+    nics_config,
+    network_config=None,
+    jobs=1,
+    cache=None,
+    output_format=hcl,
+    graph=None,
+    address_book=None,
+):
+    """
+    Generates the Terraform resource blocks for the provided machines, partitions and nics configurations.
+
+    The blocks are yielded machine by machine so the caller can write them out
+    without holding the whole script in memory. A machine whose row, partitions
+    and nics are unchanged since the cache was saved is not rendered again.
+    With more than one job, large inventories are rendered by a pool of worker
+    processes and the blocks are yielded back in the csv order, so the output
+    is the same as a serial run. Static nics without an ip address get one
+    allocated from the subnet pools of the network configuration, keeping the
+    address the book holds for them.
 
     :param machines_config: The path to the machines configuration CSV file.
     :type machines_config: str
     :param partitions_config: The path to the partitions configuration CSV file.
     :type partitions_config: str
-    :return: The generated Terraform script as a string.
-    :rtype: str
+    :param nics_config: The path to the nics configuration CSV file.
+    :type nics_config: str
+    :param network_config: The path to the network configuration CSV file.
+    :type network_config: str
+    :param jobs: The number of worker processes used to render the machines.
+    :type jobs: int
+    :param cache: The cache of the previously rendered blocks.
+    :type cache: RenderCache
+    :param output_format: The module rendering the blocks, hcl or tfjson.
+    :type output_format: module
+    :param graph: The graph the machine resources are added to.
+    :type graph: ResourceGraph
+    :param address_book: The addresses allocated by the previous runs.
+    :type address_book: AddressBook
+    :return: A generator yielding the Terraform resource blocks.
+    :rtype: Iterator[str]
     """
-    terraform_file = ""
+    if cache is None:
+        cache = RenderCache()
+    if graph is None:
+        graph = ResourceGraph()
+    render = output_format.render_block
+    separator = output_format.SEPARATOR
 
-    machines = extract.csv_to_object_list(extract.read_csv_data(machines_config))
-    partitions = extract.csv_to_object_list(extract.read_csv_data(partitions_config))
-    nics = extract.csv_to_object_list(extract.read_csv_data(nics_config))
-    for machine in machines:
-        terraform_file += generate_terraform_resource_machine(machine)
-        terraform_file += generate_block_device(
+    machines = extract.load_records(machines_config, extract.NodeRecord)
+    partition_index = extract.index_records(
+        extract.load_records(partitions_config, extract.PartitionRecord), "partition"
+    )
+    nic_index = extract.index_records(
+        extract.load_records(nics_config, extract.NicRecord), "nic"
+    )
+    addresses = {}
+    if network_config:
+        addresses = allocation.allocate_addresses(
+            extract.NetworkTable(extract.read_csv_data(network_config)).subnets,
+            machines,
+            nic_index,
+            address_book,
+        )
+
+    # Time each machine rendered in this process when tracing
+    render_one = tracing.timed(
+        "machine", lambda machine, *_: machine.resource_name, render_machine
+    )
+
+    # Only the machines missing from the cache are resolved
+    def resolve(machine):
+        return (
             machine,
-            [
-                part
-                for part in partitions
-                if part["resource_name"] in machine["partition_schema"].split(",")
-            ],
+            *resolve_machine(machine, partition_index, nic_index, addresses),
         )
-        mac_addresses = machine["mac_address"].split(",")
-        for (mac_address,nic) in zip(mac_addresses,nics):
-            if nic["resource_name"] in [
-                nic.strip() for nic in machine["nic_name"].split(",")
-            ]:
-                terraform_file += generate_nic(machine["resource_name"], nic, mac_address)
-    return terraform_file
+
+    rows = ReferencedRows(partition_index, nic_index)
+    if jobs <= 1 or len(machines) < PARALLEL_MIN_MACHINES:
+        for machine in machines:
+            yield graph.render(
+                cache,
+                f"maas_machine.{machine.resource_name}",
+                machine_source(machine, rows, addresses),
+                lambda machine: render_one(*resolve(machine), render, separator),
+                machine,
+            )
+        return
+
+    # Resolve every changed machine first so reference errors are raised before any work is sent out
+    blocks = []
+    misses = []
+    for machine in machines:
+        key = f"maas_machine.{machine.resource_name}"
+        fingerprint = cache.fingerprint(machine_source(machine, rows, addresses))
+        entry = cache.get(key, fingerprint)
+        if entry is None:
+            misses.append((len(blocks), key, fingerprint, resolve(machine)))
+            blocks.append(None)
+            continue
+        graph.add_entry(entry[1])
+        blocks.append(entry[0])
+
+    if len(misses) < PARALLEL_MIN_MACHINES:
+        rendered = [
+            render_one(*resolved, render, separator) for _, _, _, resolved in misses
+        ]
+    else:
+        chunk_size = -(-len(misses) // (jobs * CHUNKS_PER_JOB))
+        chunks = [
+            [resolved for _, _, _, resolved in misses[i : i + chunk_size]]
+            for i in range(0, len(misses), chunk_size)
+        ]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            rendered = [
+                block
+                for chunk in executor.map(
+                    functools.partial(
+                        render_machines, render=render, separator=separator
+                    ),
+                    chunks,
+                )
+                for block in chunk
+            ]
+
+    for (position, key, fingerprint, _), entry in zip(misses, rendered):
+        cache.put(key, fingerprint, entry)
+        graph.add_entry(entry[1])
+        blocks[position] = entry[0]
+
+    yield from blocks
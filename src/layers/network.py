@@ -1,47 +1,14 @@
 # Description: This file contains all the functions used to generate the terraform files
 from src import dataExtractionFunctions as extract
+from src import hcl
+from src.blocks import generate_terraform_resource
+from src.cache import RenderCache
+from src.graph import Reference
+from src.graph import ResourceGraph
+from src.graph import render_blocks
 
-
-# PROVIDER BLOCK
-def generate_terraform_provider(provider_name, provider_attributes):
-    # Define the basic template for the provider block
-    provider_template = """provider "{provider_name}" {{
-{attributes}
-}}\n\n"""
-
-    # Format the attributes
-    formatted_attributes = "\n".join(
-        f'  {key} = "{value}"' for key, value in provider_attributes.items()
-    )
-
-    # Combine the template and attributes to create the provider block
-    provider_block = provider_template.format(
-        provider_name=provider_name, attributes=formatted_attributes
-    )
-
-    return provider_block
-
-
-# RESOURCE BLOCKS
-def generate_terraform_resource(resource_type, resource_name, resource_attributes):
-    # Define the basic template for the resource block
-    resource_template = """resource "{resource_type}" "{resource_name}" {{
-{attributes}
-}}\n\n"""
-
-    # Format the attributes
-    formatted_attributes = "\n".join(
-        f'  {key} = "{value}"' for key, value in resource_attributes.items()
-    )
-
-    # Combine the template and attributes to create the resource block
-    resource_block = resource_template.format(
-        resource_type=resource_type,
-        resource_name=resource_name,
-        attributes=formatted_attributes,
-    )
-
-    return resource_block
+# Fabrics MAAS creates by itself, left out of the configuration
+UNMANAGED_FABRICS = ("default", "fabric-1")
 
 
 # FABRIC RESOURCE BLOCK
@@ -60,25 +27,17 @@ def generate_terraform_resource_space(space_name):
 def generate_terraform_resource_vlan(
     vlan_resource_name, vid, fabric_name, space_name, mtu=1500
 ):
-    # Define the basic template for the resource block
-    resource_template = """resource "maas_vlan" "{resource_name}" {{
-  fabric = maas_fabric.{fabric_name}.id
-  space = maas_space.{space_name}.id
-  vid = {vid}
-  name = "{resource_name}"
-  mtu = {mtu}
-}}\n\n"""
-
-    # Combine the template and attributes to create the resource block
-    resource_block = resource_template.format(
-        resource_name=vlan_resource_name,
-        vid=vid,
-        fabric_name=fabric_name,
-        space_name=space_name,
-        mtu=mtu,
-    )
+    body = [
+        ("fabric", Reference("maas_fabric", fabric_name, "id")),
+        ("space", Reference("maas_space", space_name, "id")),
+        ("vid", int(vid)),
+        ("name", vlan_resource_name),
+    ]
+    # Leave the mtu to MAAS when the cell is empty
+    if str(mtu).strip():
+        body.append(("mtu", int(mtu)))
 
-    return resource_block
+    return hcl.Block("resource", ["maas_vlan", vlan_resource_name], body)
 
 
 # SUBNET RESOURCE BLOCK
@@ -90,104 +49,113 @@ def generate_terraform_resource_subnet(
     fabric_name,
     vlan_name,
 ):
-    # Define the basic template for the resource block
-    resource_template = """resource "maas_subnet" "{resource_name}" {{
-  fabric = maas_fabric.{fabric_name}.id
-  vlan = maas_vlan.{vlan_name}.vid
-{attributes}
-{dns_servers}{ip_ranges}
-}}\n\n
-"""
-    # Format the attributes
-    formatted_attributes = "\n".join(
-        f'  {key} = "{value}"' for key, value in subnet_resource_attributes.items()
-    )
+    body = [
+        ("fabric", Reference("maas_fabric", fabric_name, "id")),
+        ("vlan", Reference("maas_vlan", vlan_name, "vid")),
+        *subnet_resource_attributes.items(),
+    ]
 
-    # Format dns_servers if array is not empty
+    # Add dns_servers if array is not empty
     if subnet_dns_servers:
-        formatted_dns_servers_list = "\n".join(
-            f'   "{value}",' for value in subnet_dns_servers
-        )
-        formatted_dns_servers = (
-            f"  dns_servers = [\n{formatted_dns_servers_list}\n  ]\n"
-        )
-    else:
-        formatted_dns_servers = ""
+        body.append(("dns_servers", list(subnet_dns_servers)))
 
-    # Format the ip ranges
-    formatted_ip_ranges = "\n".join(
+    # Add the ip ranges
+    body.extend(
         generate_ip_range(ip_range["type"], ip_range["start_ip"], ip_range["end_ip"])
         for ip_range in subnet_ip_ranges
     )
 
-    # Combine the template and attributes to create the resource block
-    resource_block = resource_template.format(
-        resource_name=subnet_resource_name,
-        fabric_name=fabric_name,
-        vlan_name=vlan_name,
-        attributes=formatted_attributes,
-        dns_servers=formatted_dns_servers,
-        ip_ranges=formatted_ip_ranges,
-    )
-
-    return resource_block
+    return hcl.Block("resource", ["maas_subnet", subnet_resource_name], body)
 
 
 def generate_ip_range(ip_range_type, start_ip, end_ip):
-    # Define the basic template for the resource block
-    ip_range_template = """  ip_ranges {{
-    type = "{ip_range_type}"
-    start_ip = "{start_ip}"
-    end_ip = "{end_ip}"
-  }}"""
-
-    # Combine the template and attributes to create the resource block
-    ip_range_block = ip_range_template.format(
-        ip_range_type=ip_range_type, start_ip=start_ip, end_ip=end_ip
+    return hcl.Block(
+        "ip_ranges",
+        body=[("type", ip_range_type), ("start_ip", start_ip), ("end_ip", end_ip)],
     )
 
-    return ip_range_block
 
+def network_resources(table):
+    """
+    Lists the network resources of a network table, in the order they are written.
 
-# Generate complete terraform script
-def generate_terraform_network_script(csv_file):
-    terraform_script = ""
-
-    # Extract data from csv file
-    data = extract.read_csv_data(csv_file)
-
+    :param table: The network table read from the csv file.
+    :type table: NetworkTable
+    :return: A generator yielding the address of each resource, the values it
+        is built from and a function building its block.
+    :rtype: Iterator[tuple]
+    """
     # Add fabric blocks
-    fabric_list = extract.extract_fabric_list(data)
-    for fabric in fabric_list:
-        if fabric == "default" or fabric == "fabric-1":
+    for fabric in table.fabrics:
+        if fabric in UNMANAGED_FABRICS:
             continue
-        terraform_script += generate_terraform_resource_fabric(fabric)
+        yield (
+            f"maas_fabric.{fabric}",
+            fabric,
+            lambda fabric=fabric: generate_terraform_resource_fabric(fabric),
+        )
 
     # Add space blocks
-    space_list = extract.extract_spaces_list(data)
-    for space in space_list:
-        terraform_script += generate_terraform_resource_space(space)
+    for space in table.spaces:
+        yield (
+            f"maas_space.{space}",
+            space,
+            lambda space=space: generate_terraform_resource_space(space),
+        )
 
     # Add vlan blocks
-    vlan_list = extract.extract_vlan_list(data)
-    for vlan in vlan_list:
-        terraform_script += generate_terraform_resource_vlan(
-            vlan["vlan_name"],
-            vlan["vlan_id"],
-            vlan["fabric_name"],
-            vlan["space_name"],
-            vlan["mtu"],
+    for vlan in table.vlans:
+        yield (
+            f"maas_vlan.{vlan['vlan_name']}",
+            vlan,
+            lambda vlan=vlan: generate_terraform_resource_vlan(
+                vlan["vlan_name"],
+                vlan["vlan_id"],
+                vlan["fabric_name"],
+                vlan["space_name"],
+                vlan["mtu"],
+            ),
+        )
+
+    # Add subnet blocks, the row number only naming the subnet in error
+    # messages, so inserting a row doesn't render the next subnets again
+    for subnet in table.subnets:
+        yield (
+            f"maas_subnet.{subnet['subnet_name']}",
+            {key: value for key, value in subnet.items() if key != "row"},
+            lambda subnet=subnet: generate_terraform_resource_subnet(
+                subnet["subnet_name"],
+                subnet["attributes"],
+                subnet["ip_ranges"],
+                "",
+                subnet["fabric_name"],
+                subnet["vlan_name"],
+            ),
         )
 
-    # Add subnet blocks
-    subnet_list = extract.extract_subnets_list(data)
-    for subnet in subnet_list:
-        terraform_script += generate_terraform_resource_subnet(
-            subnet["subnet_name"],
-            subnet["attributes"],
-            subnet["ip_ranges"],
-            "",
-            subnet["fabric_name"],
-            subnet["vlan_name"],
+
+# Generate complete terraform script, one resource block at a time
+def generate_terraform_network_script(
+    csv_file, cache=None, output_format=hcl, graph=None
+):
+    if cache is None:
+        cache = RenderCache()
+    if graph is None:
+        graph = ResourceGraph()
+    render = output_format.render_block
+
+    # Extract data from csv file
+    table = extract.NetworkTable(extract.read_csv_data(csv_file))
+
+    # The unmanaged fabrics already exist, the other resources may reference them
+    for fabric in table.fabrics:
+        if fabric in UNMANAGED_FABRICS:
+            graph.add_external(f"maas_fabric.{fabric}")
+
+    for address, source, make_block in network_resources(table):
+        yield graph.render(
+            cache,
+            address,
+            source,
+            lambda: render_blocks([make_block()], render, output_format.SEPARATOR),
         )
-    return terraform_script
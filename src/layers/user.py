@@ -1,35 +1,64 @@
 from src import dataExtractionFunctions as extract
+from src import hcl
+from src.cache import RenderCache
+from src.graph import ResourceGraph
+from src.graph import render_blocks
 
 
 def generate_maas_user(user):
     """
-    Generate the user resource template based on the given user information.
+    Generate the user resource block based on the given user information.
 
     Args:
-        user (dict): A dictionary containing the user information.
+        user (UserRecord): The user information.
 
     Returns:
-        str: The formatted user resource template.
+        Block: The user resource block.
 
     """
-    resource_template = """resource "maas_user" "{resource_name}" {{
-  name = "{resource_name}"
-  password = "{password}"
-  email = "{email}"
-  is_admin = {is_admin}
-}}\n\n
-"""
-    return resource_template.format(
-        resource_name=user["resource_name"],
-        password=user["password"],
-        email=user["email"],
-        is_admin=user["is_admin"] if user["is_admin"] else "false",
+    return hcl.Block(
+        "resource",
+        ["maas_user", user.resource_name],
+        [
+            ("name", user.resource_name),
+            ("password", user.password),
+            ("email", user.email),
+            ("is_admin", extract.parse_bool(user.is_admin)),
+        ],
     )
 
 
-def generate_terraform_user_script(user_file):
-    users = extract.csv_to_object_list(extract.read_csv_data(user_file))
-    terraform_file = ""
+def generate_terraform_user_script(
+    user_file, cache=None, output_format=hcl, graph=None
+):
+    """
+    Generates the user resource blocks from the users configuration CSV file.
+
+    :param user_file: The path to the users configuration CSV file.
+    :type user_file: str
+    :param cache: The cache of the previously rendered blocks.
+    :type cache: RenderCache
+    :param output_format: The module rendering the blocks, hcl or tfjson.
+    :type output_format: module
+    :param graph: The graph the user resources are added to.
+    :type graph: ResourceGraph
+    :return: A generator yielding one Terraform resource block per user.
+    :rtype: Iterator[str]
+    """
+    if cache is None:
+        cache = RenderCache()
+    if graph is None:
+        graph = ResourceGraph()
+
+    users = extract.load_records(user_file, extract.UserRecord)
     for user in users:
-        terraform_file += generate_maas_user(user)
-    return terraform_file
+        yield graph.render(
+            cache,
+            f"maas_user.{user.resource_name}",
+            user.values(),
+            lambda: render_blocks(
+                [generate_maas_user(user)],
+                output_format.render_block,
+                output_format.SEPARATOR,
+            ),
+        )
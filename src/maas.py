@@ -0,0 +1,151 @@
+# Description: Asynchronous client of the MAAS API over a pool of keep-alive connections
+import asyncio
+import http.client
+import json
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+API_PATH = "api/2.0/"
+# Statuses returned by a busy MAAS, retried after a pause
+RETRY_STATUSES = (429, 503)
+RETRIES = 3
+
+
+# Build the OAuth 1.0 PLAINTEXT header MAAS authenticates API keys with
+def authorization_header(api_key):
+    parts = api_key.split(":")
+    if len(parts) != 3:
+        raise Exception("Invalid MAAS API key, expected consumer:token:secret")
+    consumer_key, token_key, token_secret = (
+        urllib.parse.quote(part, safe="") for part in parts
+    )
+    return (
+        'OAuth oauth_version="1.0", oauth_signature_method="PLAINTEXT", '
+        f'oauth_consumer_key="{consumer_key}", oauth_token="{token_key}", '
+        f'oauth_signature="&{token_secret}", oauth_nonce="{uuid.uuid4().hex}", '
+        f'oauth_timestamp="{int(time.time())}"'
+    )
+
+
+class RateLimiter:
+    """
+    Spaces out the requests so no more than rate requests start each second.
+
+    Args:
+        rate (float): The maximum number of requests per second, 0 for no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_start = 0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class MaasClient:
+    """
+    Reads MAAS API endpoints concurrently.
+
+    Requests are sent over at most concurrency keep-alive connections,
+    reused between requests, from a pool of threads driven by asyncio. They
+    are rate limited, and retried when MAAS is busy or a connection drops.
+    Use it as an async context manager so the connections are closed.
+
+    Args:
+        api_url (str): The MAAS url, e.g. http://maas:5240/MAAS.
+        api_key (str): The MAAS API key.
+        concurrency (int): The maximum number of requests in flight.
+        rate (float): The maximum number of requests per second, 0 for no limit.
+        timeout (float): The timeout of each request in seconds.
+    """
+
+    def __init__(self, api_url, api_key, concurrency=8, rate=50, timeout=30):
+        url = urllib.parse.urlsplit(api_url)
+        if url.scheme not in ("http", "https") or not url.netloc:
+            raise Exception(f"Invalid MAAS API url: {api_url}")
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if url.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.host = url.netloc
+        self.base_path = url.path.rstrip("/") + "/" + API_PATH
+        self.api_key = api_key
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.pool = []
+        self.requests = 0
+        self.semaphore = None
+        self.executor = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+        for connection in self.pool:
+            connection.close()
+        self.pool = []
+
+    # Send a request on a connection, run in a worker thread
+    def send(self, connection, path):
+        connection.request(
+            "GET",
+            path,
+            headers={
+                "Authorization": authorization_header(self.api_key),
+                "Accept": "application/json",
+            },
+        )
+        response = connection.getresponse()
+        return response.status, response.getheader("Retry-After"), response.read()
+
+    async def get(self, path):
+        """
+        Returns the decoded JSON of an API endpoint, e.g. "fabrics/".
+        """
+        full_path = self.base_path + path
+        loop = asyncio.get_running_loop()
+        for attempt in range(RETRIES + 1):
+            await self.limiter.wait()
+            async with self.semaphore:
+                connection = (
+                    self.pool.pop()
+                    if self.pool
+                    else self.connection_class(self.host, timeout=self.timeout)
+                )
+                try:
+                    status, retry_after, body = await loop.run_in_executor(
+                        self.executor, self.send, connection, full_path
+                    )
+                except (OSError, http.client.HTTPException) as error:
+                    # Drop the connection, the server may have closed it
+                    connection.close()
+                    if attempt == RETRIES:
+                        raise Exception(f"GET {full_path} failed: {error}")
+                    continue
+                self.pool.append(connection)
+            self.requests += 1
+
+            if status in RETRY_STATUSES and attempt < RETRIES:
+                try:
+                    pause = float(retry_after)
+                except (TypeError, ValueError):
+                    pause = 2**attempt
+                await asyncio.sleep(pause)
+                continue
+            if status != 200:
+                raise Exception(f"GET {full_path} failed with status {status}")
+            return json.loads(body)
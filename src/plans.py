@@ -0,0 +1,263 @@
+# Description: Saved terraform plans and their machine readable summary
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+
+# Written in the terraform workspace by plan and removed once applied
+PLAN_FILE = "terramaas.tfplan"
+# Size of the chunks read from terraform show
+CHUNK_SIZE = 64 * 1024
+# A whole string, a string cut at the end of a chunk, or a delimiter of a JSON document
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\]:]')
+# Whitespace and commas between two items of an array
+ITEM_SEPARATOR = re.compile(r"[\s,]*")
+# Characters that can follow an item of an array
+ITEM_END = " \t\n\r,]"
+# Order of the actions in the summaries
+ACTIONS = ["create", "update", "replace", "delete", "read", "no-op"]
+
+
+def plan(terraform, cwd, options=(), output=None):
+    """
+    Runs terraform plan and saves the plan to PLAN_FILE in the workspace.
+
+    :param terraform: The path to the terraform executable.
+    :type terraform: str
+    :param cwd: The directory of the terraform workspace.
+    :type cwd: str
+    :param options: Extra plan options, such as -target.
+    :type options: list
+    :param output: The stream the plan is printed to, stdout by default.
+    :type output: file
+    :return: True if the plan has changes, False otherwise.
+    :rtype: bool
+    """
+    result = subprocess.run(
+        [
+            terraform,
+            "plan",
+            "-input=false",
+            "-detailed-exitcode",
+            f"-out={PLAN_FILE}",
+            *options,
+        ],
+        cwd=cwd,
+        stdout=output,
+    )
+    # -detailed-exitcode exits with 2 when there are changes and 0 when there are none
+    if result.returncode not in (0, 2):
+        raise Exception("terraform plan failed")
+    return result.returncode == 2
+
+
+def iter_array_items(chunks, key):
+    """
+    Yields the items of an array held by a key of the top level JSON object.
+
+    The document is read chunk by chunk and only the unread part of the
+    current chunk and the item being parsed are kept, so the memory used
+    does not grow with the document. Each item of the array, and each value
+    nested in the other top level values, is parsed at once with the json
+    module; values cut by the end of a chunk are skipped by matching their
+    strings and delimiters instead.
+
+    :param chunks: The text of the JSON document, in chunks.
+    :type chunks: Iterator[str]
+    :param key: The key of the array in the top level object.
+    :type key: str
+    :return: A generator yielding each item.
+    :rtype: Iterator
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    quoted_key = json.dumps(key)
+    buffer = ""
+    position = 0
+    depth = 0
+    # Last string read in the top level object and key of the value being read
+    last_string = None
+    current_key = None
+    in_array = False
+    while True:
+        if in_array:
+            position = ITEM_SEPARATOR.match(buffer, position).end()
+            if position < len(buffer) and buffer[position] == "]":
+                in_array = False
+                depth -= 1
+                position += 1
+                continue
+            if position < len(buffer):
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # The item is cut at the end of the chunk
+                    pass
+                else:
+                    # A number cut by the end of the chunk, such as "12" of
+                    # "12.5", decodes too, so the item must be followed by
+                    # the separator or the end of the array
+                    if end < len(buffer) and buffer[end] in ITEM_END:
+                        position = end
+                        yield item
+                        continue
+            keep = position
+        else:
+            match = TOKEN.search(buffer, position)
+            if match is not None and match.group() != '"':
+                token = match.group()
+                position = match.end()
+                if token[0] == '"':
+                    if depth == 1:
+                        last_string = token
+                elif token == ":":
+                    if depth == 1:
+                        current_key = last_string
+                elif token in "{[":
+                    in_array = depth == 1 and token == "[" and current_key == quoted_key
+                    if depth >= 1 and not in_array:
+                        # Skip the whole value at once when it is not cut by the chunk end
+                        try:
+                            position = decoder.raw_decode(buffer, match.start())[1]
+                            continue
+                        except json.JSONDecodeError:
+                            pass
+                    depth += 1
+                else:
+                    depth -= 1
+                continue
+            # Keep a string cut at the end of the chunk for the next one
+            keep = match.start() if match is not None else len(buffer)
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            if in_array:
+                raise ValueError(f"Truncated JSON document in the {key} array")
+            return
+        buffer = buffer[keep:] + chunk
+        position = 0
+
+
+# Read the chunks of a text stream
+def iter_chunks(stream):
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_resource_changes(terraform, cwd, plan_file=PLAN_FILE):
+    """
+    Yields the resource changes of a saved plan, read from terraform show -json.
+
+    The output of terraform show is parsed as it is read, with ijson when it
+    is installed and with iter_array_items otherwise, so huge plans are never
+    loaded in memory at once.
+
+    :param terraform: The path to the terraform executable.
+    :type terraform: str
+    :param cwd: The directory of the terraform workspace.
+    :type cwd: str
+    :param plan_file: The saved plan, relative to the workspace.
+    :type plan_file: str
+    :return: A generator yielding the resource changes.
+    :rtype: Iterator[dict]
+    """
+    process = subprocess.Popen(
+        [terraform, "show", "-json", plan_file], cwd=cwd, stdout=subprocess.PIPE
+    )
+    try:
+        try:
+            import ijson
+
+            yield from ijson.items(process.stdout, "resource_changes.item")
+        except ImportError:
+            stream = io.TextIOWrapper(process.stdout, encoding="utf-8")
+            yield from iter_array_items(iter_chunks(stream), "resource_changes")
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise Exception("terraform show failed")
+
+
+# Name the action of a resource change, a delete and a create being a replace
+def change_action(actions):
+    if "create" in actions and "delete" in actions:
+        return "replace"
+    return actions[0] if actions else "no-op"
+
+
+# Position of an action in the summaries, unknown actions coming last
+def action_order(action):
+    return ACTIONS.index(action) if action in ACTIONS else len(ACTIONS)
+
+
+def summarize(resource_changes):
+    """
+    Counts the resource changes of a plan by action and by resource type.
+
+    :param resource_changes: The resource changes of the plan.
+    :type resource_changes: Iterator[dict]
+    :return: The total count of each action and the counts of each resource type.
+    :rtype: dict
+    """
+    total = dict.fromkeys(ACTIONS, 0)
+    resource_types = {}
+    for change in resource_changes:
+        action = change_action(change["change"]["actions"])
+        counts = resource_types.setdefault(change["type"], {})
+        counts[action] = counts.get(action, 0) + 1
+        total[action] = total.get(action, 0) + 1
+    return {
+        "changes": any(count for action, count in total.items() if action != "no-op"),
+        "total": total,
+        "resource_types": {
+            resource_type: dict(
+                sorted(counts.items(), key=lambda count: action_order(count[0]))
+            )
+            for resource_type, counts in sorted(resource_types.items())
+        },
+    }
+
+
+# Describe the counts of a summary, e.g. "2 to create, 1 to update"
+def format_counts(counts):
+    return ", ".join(
+        f"{counts[action]} to {action}"
+        for action in counts
+        if counts[action] and action != "no-op"
+    )
+
+
+# Print a summary for the operator to review before applying
+def print_summary(summary, output=None):
+    # Looked up on each call, so a redirected stdout is followed
+    output = output or sys.stdout
+    print("Plan summary:", file=output)
+    for resource_type, counts in summary["resource_types"].items():
+        if format_counts(counts):
+            print(f"  {resource_type}: {format_counts(counts)}", file=output)
+    print(f"  Total: {format_counts(summary['total']) or 'no changes'}", file=output)
+
+
+def apply(
+    terraform, cwd, plan_file=PLAN_FILE, output=None, options=(), monitor=None
+):
+    """
+    Applies a saved plan, then removes it as it cannot be applied twice.
+    The apply output is written to output, stdout by default, and options
+    such as -parallelism are passed to terraform apply. With a monitor,
+    terraform writes its JSON UI stream, followed by the monitor.
+    """
+    command = [terraform, "apply", "-input=false", *options, plan_file]
+    if monitor is not None:
+        command.insert(3, "-json")
+        returncode = monitor.run(command, cwd, output)
+    else:
+        returncode = subprocess.run(command, cwd=cwd, stdout=output).returncode
+    if returncode != 0:
+        raise Exception("terraform apply failed")
+    os.remove(os.path.join(cwd, plan_file))
@@ -0,0 +1,303 @@
+# Description: Progress and latency of the resources applied by terraform, read from its JSON UI stream
+import asyncio
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Seconds between two refreshes of the progress line, on a terminal and in a log
+TERMINAL_INTERVAL = 0.5
+LOG_INTERVAL = 30
+# Longest line of the JSON UI stream, a diagnostic can quote a whole resource
+LINE_LIMIT = 16 * 1024 * 1024
+CLEAR_LINE = "\r\033[K"
+
+
+class ApplyMonitor:
+    """
+    Follows the resources applied or destroyed by terraform, from the
+    apply_start, apply_complete and apply_errored messages of its JSON UI
+    stream, and keeps the start and finish time of each resource.
+
+    A monitor can follow several terraform processes at the same time, such
+    as the shards applied in parallel, and sums them up in one progress line,
+    one Prometheus textfile and one JSON report.
+
+    Args:
+        live (bool): Whether the progress line is shown while terraform runs.
+        metrics_file (str): The Prometheus textfile written by finish, if any.
+        report_file (str): The JSON report written by finish, if any.
+        output (file): The stream of the progress line and the diagnostics.
+    """
+
+    def __init__(self, live=True, metrics_file=None, report_file=None, output=None):
+        self.live = live
+        self.metrics_file = metrics_file
+        self.report_file = report_file
+        self.output = output or sys.stderr
+        self.terminal = self.output.isatty()
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.running = {}
+        self.resources = []
+        # A log only gets a line once there is progress to tell
+        self.next_refresh = 0.0 if self.terminal else time.monotonic() + LOG_INTERVAL
+
+    def handle(self, message):
+        """
+        Records a message of the JSON UI stream, printing the errors.
+        """
+        kind = message.get("type")
+        if kind == "diagnostic":
+            diagnostic = message.get("diagnostic", {})
+            if diagnostic.get("severity") == "error":
+                address = diagnostic.get("address")
+                self.print(
+                    f"Error: {diagnostic.get('summary', '')}"
+                    + (f": {address}" if address else "")
+                )
+            return
+        if kind not in ("apply_start", "apply_complete", "apply_errored"):
+            return
+        hook = message.get("hook", {})
+        resource = hook.get("resource", {})
+        address = resource.get("addr")
+        if address is None:
+            return
+        now = time.time()
+        with self.lock:
+            if kind == "apply_start":
+                self.running[address] = (
+                    resource.get("resource_type", address.partition(".")[0]),
+                    hook.get("action", ""),
+                    now,
+                )
+                return
+            resource_type, action, start = self.running.pop(
+                address,
+                (resource.get("resource_type", ""), hook.get("action", ""), now),
+            )
+            self.resources.append(
+                {
+                    "address": address,
+                    "type": resource_type,
+                    "action": action,
+                    "status": "done" if kind == "apply_complete" else "failed",
+                    "start": round(start - self.origin, 3),
+                    "finish": round(now - self.origin, 3),
+                    "seconds": round(now - start, 3),
+                }
+            )
+
+    def counts(self):
+        """
+        Returns the done, running and failed resources of each resource type.
+        """
+        counts = {}
+        with self.lock:
+            for resource in self.resources:
+                type_counts = counts.setdefault(resource["type"], [0, 0, 0])
+                type_counts[0 if resource["status"] == "done" else 2] += 1
+            for resource_type, _, _ in self.running.values():
+                counts.setdefault(resource_type, [0, 0, 0])[1] += 1
+        return dict(sorted(counts.items()))
+
+    def progress_line(self):
+        parts = []
+        for resource_type, (done, running, failed) in self.counts().items():
+            part = f"{resource_type} {done} done"
+            if running:
+                part += f", {running} running"
+            if failed:
+                part += f", {failed} failed"
+            parts.append(part)
+        elapsed = time.time() - self.origin
+        return " | ".join(parts + [f"{elapsed:.0f}s"])
+
+    def refresh(self):
+        """
+        Shows the progress line, unless it was shown less than an interval ago
+        by the terraform process followed next to this one.
+        """
+        interval = TERMINAL_INTERVAL if self.terminal else LOG_INTERVAL
+        with self.lock:
+            now = time.monotonic()
+            if now < self.next_refresh:
+                return
+            self.next_refresh = now + interval
+        line = self.progress_line()
+        if self.terminal:
+            self.output.write(CLEAR_LINE + line)
+            self.output.flush()
+        else:
+            print(line, file=self.output, flush=True)
+
+    # Print a line above the progress line
+    def print(self, line):
+        with self.lock:
+            if self.terminal and self.live:
+                self.output.write(CLEAR_LINE)
+            print(line, file=self.output, flush=True)
+
+    def run(self, command, cwd, log=None):
+        """
+        Runs a terraform command with -json, following its messages as they
+        are written. Lines that are not JSON are written to log, stdout by default.
+
+        :param command: The terraform command, -json included.
+        :type command: list
+        :param cwd: The directory of the terraform workspace.
+        :type cwd: str
+        :param log: The stream the raw output is written to.
+        :type log: file
+        :return: The exit code of terraform.
+        :rtype: int
+        """
+        return asyncio.run(self.follow(command, cwd, log or sys.stdout))
+
+    async def follow(self, command, cwd, log):
+        process = await asyncio.create_subprocess_exec(
+            *command, cwd=cwd, stdout=asyncio.subprocess.PIPE, limit=LINE_LIMIT
+        )
+        ticker = asyncio.create_task(self.tick()) if self.live else None
+        try:
+            async for line in process.stdout:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    log.write(line.decode(errors="replace"))
+                    continue
+                if isinstance(message, dict):
+                    self.handle(message)
+            return await process.wait()
+        finally:
+            if ticker is not None:
+                ticker.cancel()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    async def tick(self):
+        while True:
+            self.refresh()
+            await asyncio.sleep(TERMINAL_INTERVAL if self.terminal else LOG_INTERVAL)
+
+    def latencies(self):
+        """
+        Sums up the latency of the resources of each type, failed ones included.
+
+        :return: The count, the sum, the quantiles and the cumulative bucket
+            counts of the latencies, keyed by resource type.
+        :rtype: dict
+        """
+        seconds = {}
+        for resource in self.resources:
+            seconds.setdefault(resource["type"], []).append(resource["seconds"])
+        summary = {}
+        for resource_type, values in sorted(seconds.items()):
+            values.sort()
+            summary[resource_type] = {
+                "count": len(values),
+                "sum": round(sum(values), 3),
+                "min": values[0],
+                "p50": quantile(values, 0.5),
+                "p90": quantile(values, 0.9),
+                "p99": quantile(values, 0.99),
+                "max": values[-1],
+                "buckets": {
+                    str(bound): bisect.bisect_right(values, bound)
+                    for bound in LATENCY_BUCKETS
+                },
+            }
+        return summary
+
+    def write_prometheus(self, path):
+        """
+        Writes the latency histograms and the resource counts in the Prometheus
+        text format, for the textfile collector of the node exporter.
+        """
+        latencies = self.latencies()
+        histogram = "terramaas_resource_apply_seconds"
+        lines = [
+            f"# HELP {histogram} Time terraform took to apply a resource.",
+            f"# TYPE {histogram} histogram",
+        ]
+        for resource_type, latency in latencies.items():
+            label = f'resource_type="{resource_type}"'
+            buckets = [*latency["buckets"].items(), ("+Inf", latency["count"])]
+            lines.extend(
+                f'{histogram}_bucket{{{label},le="{bound}"}} {count}'
+                for bound, count in buckets
+            )
+            lines.append(f"{histogram}_sum{{{label}}} {latency['sum']}")
+            lines.append(f"{histogram}_count{{{label}}} {latency['count']}")
+        lines.extend(
+            [
+                "# HELP terramaas_resources Resources applied by terraform, by status.",
+                "# TYPE terramaas_resources gauge",
+            ]
+        )
+        for resource_type, counts in self.counts().items():
+            for status, count in zip(("done", "running", "failed"), counts):
+                lines.append(
+                    f'terramaas_resources{{resource_type="{resource_type}",'
+                    f'status="{status}"}} {count}'
+                )
+        lines.extend(
+            [
+                "# HELP terramaas_apply_seconds Duration of the terraform run.",
+                "# TYPE terramaas_apply_seconds gauge",
+                f"terramaas_apply_seconds {time.time() - self.origin:.3f}",
+            ]
+        )
+        write_file(path, "\n".join(lines) + "\n")
+
+    def write_report(self, path):
+        """
+        Writes the latency histograms and the start and finish time of every
+        resource, in seconds from the start of the run, as JSON.
+        """
+        latencies = self.latencies()
+        report = {
+            "seconds": round(time.time() - self.origin, 3),
+            "resource_types": {
+                resource_type: {
+                    "done": done,
+                    "failed": failed,
+                    "latency": latencies.get(resource_type),
+                }
+                for resource_type, (done, _, failed) in self.counts().items()
+            },
+            "resources": sorted(self.resources, key=lambda resource: resource["start"]),
+        }
+        write_file(path, json.dumps(report, indent=2) + "\n")
+
+    def finish(self):
+        """
+        Ends the progress line with the final counts and writes the metrics files.
+        """
+        if self.live and (self.resources or self.running):
+            if self.terminal:
+                self.output.write(CLEAR_LINE)
+            print(self.progress_line(), file=self.output, flush=True)
+        if self.metrics_file:
+            self.write_prometheus(self.metrics_file)
+        if self.report_file:
+            self.write_report(self.report_file)
+
+
+# Value under which the given fraction of the sorted values falls
+def quantile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Replace a file in one step, so a collector never reads a partial file
+def write_file(path, content):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
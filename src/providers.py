@@ -0,0 +1,89 @@
+# Description: Terraform provider installation through a shared plugin cache
+import hashlib
+import json
+import os
+import subprocess
+
+LOCK_FILE = ".terraform.lock.hcl"
+# Written in the .terraform directory after a successful init
+INIT_STAMP = os.path.join(".terraform", "terramaas-init.json")
+PROVIDER_DIR = os.path.join(
+    ".terraform", "providers", "registry.terraform.io", "maas", "maas"
+)
+DEFAULT_PLUGIN_CACHE_DIR = os.path.join("~", ".terraform.d", "plugin-cache")
+
+
+# Resolve the shared plugin cache directory and make sure it exists
+def plugin_cache_dir(path=None):
+    path = path or os.environ.get("TF_PLUGIN_CACHE_DIR") or DEFAULT_PLUGIN_CACHE_DIR
+    path = os.path.abspath(os.path.expanduser(path))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# Fingerprint of the provider requirements and of the lock file of a workspace
+def init_fingerprint(cwd, terraform_block):
+    digest = hashlib.sha256(terraform_block.encode())
+    with open(os.path.join(cwd, LOCK_FILE), "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+# Check if the workspace was initialized with the same providers
+def init_is_current(cwd, terraform_block):
+    provider_dir = os.path.join(cwd, PROVIDER_DIR)
+    if not os.path.isfile(os.path.join(cwd, LOCK_FILE)):
+        return False
+    if not os.path.isdir(provider_dir) or not os.listdir(provider_dir):
+        return False
+    try:
+        with open(os.path.join(cwd, INIT_STAMP)) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return stamp.get("fingerprint") == init_fingerprint(cwd, terraform_block)
+
+
+def init(
+    terraform, cwd, terraform_block, plugin_cache=None, plugin_mirror=None, output=None
+):
+    """
+    Runs terraform init unless the workspace is already initialized.
+
+    Providers are downloaded once into the shared plugin cache, or installed
+    from a local filesystem mirror when one is given. init writes the
+    .terraform.lock.hcl file, and a stamp recording the provider requirements
+    and the lock file lets the next runs skip init while they are unchanged
+    and the provider is still installed.
+
+    :param terraform: The path to the terraform executable.
+    :type terraform: str
+    :param cwd: The directory of the terraform workspace.
+    :type cwd: str
+    :param terraform_block: The terraform block holding the required_providers.
+    :type terraform_block: str
+    :param plugin_cache: The shared plugin cache directory.
+    :type plugin_cache: str
+    :param plugin_mirror: A local filesystem mirror to install the providers from.
+    :type plugin_mirror: str
+    :param output: The stream the init output is written to, stdout by default.
+    :type output: file
+    :return: True if init was run, False if it was skipped.
+    :rtype: bool
+    """
+    if init_is_current(cwd, terraform_block):
+        return False
+
+    command = [terraform, "init", "-input=false"]
+    if plugin_mirror:
+        command.append(f"-plugin-dir={os.path.abspath(plugin_mirror)}")
+    env = dict(os.environ, TF_PLUGIN_CACHE_DIR=plugin_cache_dir(plugin_cache))
+
+    if subprocess.run(command, cwd=cwd, env=env, stdout=output).returncode != 0:
+        raise Exception("terraform init failed")
+
+    if os.path.isfile(os.path.join(cwd, LOCK_FILE)):
+        os.makedirs(os.path.dirname(os.path.join(cwd, INIT_STAMP)), exist_ok=True)
+        with open(os.path.join(cwd, INIT_STAMP), "w") as f:
+            json.dump({"fingerprint": init_fingerprint(cwd, terraform_block)}, f)
+    return True
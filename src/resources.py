@@ -0,0 +1,94 @@
+# Description: Index of the resource blocks of a generated terraform file
+import hashlib
+import json
+import os
+import re
+
+# A resource block, ending with the first closing brace at the start of a
+# line, the way terramaas and terraform fmt write the top level blocks
+RESOURCE_BLOCK = re.compile(
+    r'^[ \t]*resource\s+"([^"]+)"\s+"([^"]+)"\s*\{.*?^\}', re.MULTILINE | re.DOTALL
+)
+RESOURCE_REFERENCE = re.compile(r"\b(maas_\w+)\.([\w-]+)\.")
+# Size of the digests of the resource blocks recorded after an apply
+DIGEST_SIZE = 8
+
+
+# Normalize a resource block so formatting changes are not seen as changes
+def normalize_block(block):
+    return " ".join(block.split())
+
+
+# Index the resource blocks of a terraform file by address
+def index_resources(path):
+    if not os.path.isfile(path):
+        return {}
+    if path.endswith(".json"):
+        return index_json_resources(path)
+    with open(path) as f:
+        text = f.read()
+    return {
+        f"{match.group(1)}.{match.group(2)}": normalize_block(match.group(0))
+        for match in RESOURCE_BLOCK.finditer(text)
+    }
+
+
+# Index the resources of a terraform JSON configuration file by address
+def index_json_resources(path):
+    with open(path) as f:
+        try:
+            configuration = json.load(f)
+        except ValueError:
+            return {}
+    resources = configuration.get("resource", [])
+    if isinstance(resources, dict):
+        resources = [resources]
+    index = {}
+    for element in resources:
+        for kind, named in element.items():
+            for name, body in named.items():
+                index[f"{kind}.{name}"] = json.dumps(body, sort_keys=True)
+    return index
+
+
+# Extract the addresses of the resources referenced by a resource block
+def resource_references(block):
+    return {f"{kind}.{name}" for kind, name in RESOURCE_REFERENCE.findall(block)}
+
+
+# Digest of each resource block of an index, the form the applied resources are recorded in
+def digest_resources(index):
+    return {
+        address: hashlib.blake2b(block.encode(), digest_size=DIGEST_SIZE).hexdigest()
+        for address, block in index.items()
+    }
+
+
+# Addresses added, removed or modified between two digest indexes
+def changed_addresses(old_digests, new_digests):
+    changed = set(old_digests.keys() ^ new_digests.keys())
+    for address, digest in new_digests.items():
+        if address in old_digests and old_digests[address] != digest:
+            changed.add(address)
+    return changed
+
+
+def plan_targets(old_digests, new_resources):
+    """
+    Lists the resources to plan: the ones added, removed or modified since
+    the old digests were taken, and the resources that directly reference them.
+
+    :param old_digests: The digest index of the previous resources.
+    :type old_digests: dict
+    :param new_resources: The resource blocks of the script, keyed by address.
+    :type new_resources: dict
+    :return: The sorted addresses to target.
+    :rtype: list
+    """
+    changed = changed_addresses(old_digests, digest_resources(new_resources))
+    targets = set(changed)
+    if changed:
+        for address, block in new_resources.items():
+            if address not in targets and resource_references(block) & changed:
+                targets.add(address)
+    return sorted(targets)
@@ -0,0 +1,492 @@
+# Description: Terraform configuration split into root modules planned and applied separately
+import ipaddress
+import itertools
+import json
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from src import dataExtractionFunctions as extract
+from src import hcl
+from src import plans
+from src import providers
+from src.blocks import generate_terraform_provider
+from src.graph import Reference
+from src.graph import ResourceGraph
+
+# Written in the shards directory, listing the shards and their machines
+MANIFEST_FILE = "terramaas-shards.json"
+MANIFEST_VERSION = 1
+# Name of the generated file in each shard, without the extension of the output format
+SCRIPT_NAME = "terraform_script"
+# Log file of the terraform commands run in each shard
+SHARD_LOG = "terramaas.log"
+NETWORK_SHARD = "network"
+USERS_SHARD = "users"
+MACHINE_SHARD = "machines"
+# Shard key grouping the machines whose nics are on the same vlans, a rack
+# when each rack has its own vlan
+VLAN_KEY = "vlan"
+# Shard key grouping the machines whose power addresses are in the same subnet
+POWER_SUBNET_KEY = "power-subnet"
+POWER_SUBNET_PREFIX = 24
+# Resource types of the network shard referenced by the machine shards,
+# written as outputs of the network shard and read from its state
+NETWORK_OUTPUTS = ("maas_vlan", "maas_subnet")
+REMOTE_PREFIX = f"data.terraform_remote_state.{NETWORK_SHARD}.outputs."
+REMOTE_STATE_BLOCK = hcl.Block(
+    "data",
+    ["terraform_remote_state", NETWORK_SHARD],
+    [
+        ("backend", "local"),
+        ("config", {"path": f"../{NETWORK_SHARD}/terraform.tfstate"}),
+    ],
+)
+# Characters of a shard key that can't be part of a directory name
+UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_-]+")
+
+
+# Copy a block, reading its references to the network resources from the network shard state
+def remote_block(block):
+    body = []
+    for item in block.body:
+        if item.__class__ is tuple:
+            value = item[1]
+            if (
+                value.__class__ is Reference
+                and value.partition(".")[0] in NETWORK_OUTPUTS
+            ):
+                item = (item[0], hcl.Expression(REMOTE_PREFIX + value))
+        else:
+            item = remote_block(item)
+        body.append(item)
+    return hcl.Block(block.type, block.labels, body)
+
+
+class RemoteRenderer:
+    """
+    Renders the blocks of a machine shard, whose references to the network
+    resources go through the outputs of the network shard.
+
+    It is picklable, so the worker processes rendering the machines can use it.
+
+    Args:
+        render (function): The function rendering a block, hcl or tfjson render_block.
+    """
+
+    def __init__(self, render):
+        self.render = render
+
+    def __call__(self, block):
+        return self.render(remote_block(block))
+
+
+class RemoteFormat:
+    """
+    Output format of the machine shards, rendering like the wrapped format.
+
+    Args:
+        output_format (module): The module rendering the blocks, hcl or tfjson.
+    """
+
+    def __init__(self, output_format):
+        self.render_block = RemoteRenderer(output_format.render_block)
+        self.SEPARATOR = output_format.SEPARATOR
+
+
+# Value of a column of the node csv for each machine, read from the rows the machines come from
+def column_values(node_file, machines, column):
+    rows = extract.read_csv_data(node_file)
+    headers = [extract.normalize_header(header) for header in rows[0]] if rows else []
+    name = extract.normalize_header(column)
+    if name not in headers:
+        raise Exception(f"Column {column} not found in {node_file}")
+    position = headers.index(name)
+    return [
+        extract.normalize_value(row[position]) if position < len(row) else ""
+        for row in (rows[machine.row - 1] for machine in machines)
+    ]
+
+
+def machine_keys(machines, csv_files, key=None):
+    """
+    Returns the key grouping each machine with the machines sharing it.
+
+    :param machines: The machine rows.
+    :type machines: list
+    :param csv_files: The csv file paths, keyed by configuration name.
+    :type csv_files: dict
+    :param key: "vlan" for the vlans of the nics of the machine,
+        "power-subnet" for the subnet of its power address, a column of the
+        node csv, or None for a single group.
+    :type key: str
+    :return: The key of each machine, in the order of the machines.
+    :rtype: list
+    """
+    if key is None:
+        return [""] * len(machines)
+    if key == VLAN_KEY:
+        nic_index = extract.index_records(
+            extract.load_records(csv_files["nics-config"], extract.NicRecord), "nic"
+        )
+        keys = []
+        for machine in machines:
+            vlans = {
+                nic_index[name].vlan_id
+                for name in extract.split_cell(machine.nic_name)
+                if name in nic_index
+            }
+            keys.append("vlan-" + "-".join(sorted(vlans, key=int)))
+        return keys
+    if key == POWER_SUBNET_KEY:
+        return [power_subnet(machine.power_address) for machine in machines]
+    return column_values(csv_files["node-config"], machines, key)
+
+
+# Subnet of a power address, the address itself when it is a host name
+def power_subnet(address):
+    try:
+        interface = ipaddress.ip_interface(f"{address}/{POWER_SUBNET_PREFIX}")
+    except ValueError:
+        return address
+    return str(interface.network)
+
+
+def shard_names(machines, csv_files, shard_by=None, shard_size=None):
+    """
+    Assigns each machine to a machine shard.
+
+    Machines are grouped by the key of machine_keys, such as the vlans of
+    their nics or a rack column of the node csv, then each group is cut in
+    shards of at most shard_size machines, in csv order.
+
+    :param machines: The machine rows.
+    :type machines: list
+    :param csv_files: The csv file paths, keyed by configuration name.
+    :type csv_files: dict
+    :param shard_by: The key grouping the machines, None for a single group.
+    :type shard_by: str
+    :param shard_size: The maximum number of machines in a shard, None for no limit.
+    :type shard_size: int
+    :return: The shard name of each machine, in the order of the machines.
+    :rtype: list
+    """
+    keys = machine_keys(machines, csv_files, shard_by)
+    names = []
+    counts = {}
+    for key in keys:
+        name = MACHINE_SHARD
+        key = UNSAFE_NAME.sub("-", key).strip("-").lower()
+        if key:
+            name += f"-{key}"
+        if shard_size:
+            position = counts.get(name, 0)
+            counts[name] = position + 1
+            name += f"-{position // shard_size + 1}"
+        names.append(name)
+    return names
+
+
+# Join the blocks of a shard into a whole document
+def shard_document(output_format, header, blocks):
+    return (
+        output_format.open_document(header)
+        + output_format.SEPARATOR.join(blocks)
+        + output_format.close_document()
+    )
+
+
+def render_shards(
+    api_key,
+    api_url,
+    csv_files,
+    shard_by=None,
+    shard_size=None,
+    jobs=1,
+    cache=None,
+    output_format=hcl,
+    keep=(),
+    address_book=None,
+):
+    """
+    Renders the network, machine and user shards of the csv files.
+
+    Each shard is a root module with its own provider. The machine shards
+    read the vlans and subnets from the state of the network shard, through
+    a terraform_remote_state data source. The references of every shard
+    are checked together, as in a single script. The shards of keep left
+    without machines are rendered empty, so that applying them destroys
+    their resources.
+
+    :return: The shard documents and the machine names of each shard, keyed
+        by shard name, the network shard first and the users shard last.
+    :rtype: tuple
+    """
+    from src import generateFunctions as gf
+    from src.layers import machine as node
+    from src.layers import network as net
+    from src.layers import user
+
+    graph = ResourceGraph()
+    header = [
+        gf.TERRAFORM_BLOCK,
+        generate_terraform_provider(
+            "maas", {"api_version": "2.0", "api_key": api_key, "api_url": api_url}
+        ),
+    ]
+    documents = {}
+    machine_names = {}
+
+    blocks = list(
+        net.generate_terraform_network_script(
+            csv_files["network-config"], cache, output_format, graph
+        )
+    )
+    # The outputs list the vlans and subnets the network layer added to the graph
+    documents[NETWORK_SHARD] = shard_document(
+        output_format, header + graph.output_blocks(NETWORK_OUTPUTS), blocks
+    )
+    machine_names[NETWORK_SHARD] = []
+
+    # The machine layer yields the blocks of one machine at a time, in csv order
+    machines = extract.load_records(csv_files["node-config"], extract.NodeRecord)
+    shard_blocks = {}
+    rendered = node.generate_terraform_node_script(
+        csv_files["node-config"],
+        csv_files["partition-config"],
+        csv_files["nics-config"],
+        csv_files["network-config"],
+        jobs,
+        cache,
+        RemoteFormat(output_format),
+        graph,
+        address_book,
+    )
+    for machine, name, block in zip(
+        machines, shard_names(machines, csv_files, shard_by, shard_size), rendered
+    ):
+        shard_blocks.setdefault(name, []).append(block)
+        machine_names.setdefault(name, []).append(machine.resource_name)
+    for name, blocks in shard_blocks.items():
+        documents[name] = shard_document(
+            output_format, header + [REMOTE_STATE_BLOCK], blocks
+        )
+    for name in keep:
+        if name not in documents:
+            documents[name] = shard_document(output_format, header, [])
+            machine_names[name] = []
+
+    if "user-config" in csv_files:
+        blocks = list(
+            user.generate_terraform_user_script(
+                csv_files["user-config"], cache, output_format, graph
+            )
+        )
+        documents[USERS_SHARD] = shard_document(output_format, header, blocks)
+        machine_names[USERS_SHARD] = []
+
+    graph.check()
+    return documents, machine_names
+
+
+# Path of the generated file of a shard
+def shard_path(root, name, output_format):
+    return os.path.join(root, name, SCRIPT_NAME + output_format.EXTENSION)
+
+
+def load_manifest(root):
+    """
+    Returns the manifest of a shards directory, None if there is none.
+    """
+    path = os.path.join(root, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except ValueError as error:
+        raise Exception(f"Error reading {path}: {error}")
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise Exception(f"Unsupported shards manifest version in {path}")
+    return manifest
+
+
+def save_manifest(root, output_format, machine_names):
+    path = os.path.join(root, MANIFEST_FILE)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(
+            {
+                "version": MANIFEST_VERSION,
+                "extension": output_format.EXTENSION,
+                "shards": machine_names,
+            },
+            f,
+            indent=2,
+        )
+    os.replace(temporary_path, path)
+
+
+def moved_machines(manifest, machine_names):
+    """
+    Lists the machines assigned to another shard than in the manifest.
+
+    Terraform would create such a machine in its new shard while it still
+    exists in the state of the old one, so they are refused.
+
+    :return: The (machine, old shard, new shard) tuples.
+    :rtype: list
+    """
+    previous = {
+        machine: name
+        for name, machines in manifest["shards"].items()
+        for machine in machines
+    }
+    return [
+        (machine, previous[machine], name)
+        for name, machines in machine_names.items()
+        for machine in machines
+        if machine in previous and previous[machine] != name
+    ]
+
+
+def stages(names):
+    """
+    Splits the shards in the groups run one after the other: the network
+    shard, then the machine and user shards, which only depend on it.
+    """
+    return [
+        group
+        for group in (
+            [name for name in names if name == NETWORK_SHARD],
+            [name for name in names if name != NETWORK_SHARD],
+        )
+        if group
+    ]
+
+
+def run_parallel(function, root, names, workers):
+    """
+    Calls function(directory, log) for each shard, at most workers at a time,
+    with the shard directory and its log file.
+
+    :return: The result of each shard, keyed by shard name.
+    :rtype: dict
+    """
+
+    def run(name):
+        directory = os.path.join(root, name)
+        with open(os.path.join(directory, SHARD_LOG), "a") as log:
+            return function(directory, log)
+
+    results = {}
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {name: executor.submit(run, name) for name in names}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as error:
+                log_path = os.path.join(root, name, SHARD_LOG)
+                failures.append(f"{name}: {error}, see {log_path}")
+    if failures:
+        raise Exception("\n".join(failures))
+    return results
+
+
+def init_shards(
+    terraform, root, names, terraform_block, plugin_cache, plugin_mirror, workers
+):
+    return run_parallel(
+        lambda directory, log: providers.init(
+            terraform, directory, terraform_block, plugin_cache, plugin_mirror, log
+        ),
+        root,
+        names,
+        workers,
+    )
+
+
+def plan_shards(terraform, root, options, workers):
+    """
+    Saves a plan in each shard, with the plan options of each shard.
+
+    :param options: The plan options, such as -target, keyed by shard name.
+    :type options: dict
+    :return: The shards whose plan has changes.
+    :rtype: list
+    """
+    results = run_parallel(
+        lambda directory, log: plans.plan(
+            terraform, directory, options[os.path.basename(directory)], log
+        ),
+        root,
+        list(options),
+        workers,
+    )
+    for name, has_changes in results.items():
+        if not has_changes:
+            os.remove(os.path.join(root, name, plans.PLAN_FILE))
+    return [name for name, has_changes in results.items() if has_changes]
+
+
+# Summarize the saved plans of several shards together
+def summarize_shards(terraform, root, names):
+    return plans.summarize(
+        itertools.chain.from_iterable(
+            plans.iter_resource_changes(terraform, os.path.join(root, name))
+            for name in names
+        )
+    )
+
+
+def apply_shards(terraform, root, names, workers, monitor=None):
+    run_parallel(
+        lambda directory, log: plans.apply(
+            terraform, directory, plans.PLAN_FILE, log, monitor=monitor
+        ),
+        root,
+        names,
+        workers,
+    )
+
+
+# Remove the saved plans of shards that are not applied
+def discard_plans(root, names):
+    for name in names:
+        path = os.path.join(root, name, plans.PLAN_FILE)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def destroy_shards(terraform, root, names, workers, monitor=None):
+    """
+    Destroys the resources of the shards, the machine and user shards in
+    parallel first, then the network shard they reference, and removes the
+    manifest once every shard is destroyed.
+    """
+    for group in reversed(stages(names)):
+        run_parallel(
+            lambda directory, log: destroy_shard(terraform, directory, log, monitor),
+            root,
+            [
+                name
+                for name in group
+                if os.path.isfile(os.path.join(root, name, "terraform.tfstate"))
+            ],
+            workers,
+        )
+    # The shards directory can be created again
+    os.remove(os.path.join(root, MANIFEST_FILE))
+
+
+def destroy_shard(terraform, directory, log, monitor=None):
+    command = [terraform, "destroy", "-input=false", "-auto-approve"]
+    if monitor is not None:
+        returncode = monitor.run(command + ["-json"], directory, log)
+    else:
+        returncode = subprocess.run(
+            command, cwd=directory, stdout=log, stderr=subprocess.STDOUT
+        ).returncode
+    if returncode != 0:
+        raise Exception("terraform destroy failed")
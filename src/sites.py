@@ -0,0 +1,209 @@
+# Description: Runs create or update on every site of a manifest, concurrently
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Log file written in each site directory
+SITE_LOG = "terramaas.log"
+# Manifest keys of a site and the command options they are passed as
+SITE_OPTIONS = {
+    "network-config": "--network-config",
+    "partition-config": "--partition-config",
+    "node-config": "--node-config",
+    "nics-config": "--nics-config",
+    "user-config": "--user-config",
+    "api-config": "--api-config",
+    "api-key": "--api-key",
+    "api-url": "--api-url",
+}
+REQUIRED_KEYS = [
+    "name",
+    "network-config",
+    "partition-config",
+    "node-config",
+    "nics-config",
+]
+# Keys holding paths, resolved from the site directory
+PATH_KEYS = [
+    "network-config",
+    "partition-config",
+    "node-config",
+    "nics-config",
+    "user-config",
+    "api-config",
+]
+# Directory the src package is imported from by the site processes
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_manifest(path):
+    """
+    Loads the sites of a manifest file.
+
+    The manifest holds a list of sites, each with a name, a working
+    directory relative to the manifest, and its csv files and API
+    configuration, relative to the site directory:
+
+        sites:
+          - name: region-a
+            directory: region-a
+            network-config: network.csv
+            partition-config: partitions.csv
+            node-config: nodes.csv
+            nics-config: nics.csv
+            api-config: key.yaml
+            options: ["--full"]
+
+    :param path: The path to the manifest file.
+    :type path: str
+    :return: The sites, with absolute paths.
+    :rtype: list
+    """
+    import yaml
+
+    try:
+        with open(path) as f:
+            manifest = yaml.load(f, Loader=yaml.SafeLoader)
+    except (OSError, yaml.YAMLError) as error:
+        raise Exception(f"Error reading manifest {path}: {error}")
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("sites"), list):
+        raise Exception(f"Manifest {path} must hold a list of sites")
+
+    base = os.path.dirname(os.path.abspath(path))
+    sites = []
+    names = set()
+    for number, site in enumerate(manifest["sites"], start=1):
+        if not isinstance(site, dict):
+            raise Exception(f"Site {number} of the manifest is not a mapping")
+        missing = [key for key in REQUIRED_KEYS if not site.get(key)]
+        if missing:
+            raise Exception(
+                f"Site {number} of the manifest misses: {', '.join(missing)}"
+            )
+        name = str(site["name"])
+        if name in names:
+            raise Exception(f"Duplicate site name in the manifest: {name}")
+        names.add(name)
+        has_api_key = site.get("api-key") and site.get("api-url")
+        if not site.get("api-config") and not has_api_key:
+            raise Exception(f"Site {name} needs api-config or api-key and api-url")
+        unknown = set(site) - set(SITE_OPTIONS) - {"name", "directory", "options"}
+        if unknown:
+            raise Exception(
+                f"Site {name} has unknown keys: {', '.join(sorted(unknown))}"
+            )
+
+        directory = os.path.join(base, str(site.get("directory", name)))
+        resolved = {"name": name, "directory": directory}
+        for key in SITE_OPTIONS:
+            if site.get(key):
+                value = str(site[key])
+                if key in PATH_KEYS:
+                    value = os.path.join(directory, value)
+                resolved[key] = value
+        resolved["options"] = [str(option) for option in site.get("options") or []]
+        sites.append(resolved)
+    return sites
+
+
+# Build the command line running a command on one site
+def site_command(site, command, options):
+    arguments = [sys.executable, "-m", "src", command]
+    for key, option in SITE_OPTIONS.items():
+        if key in site:
+            arguments.extend([option, site[key]])
+    return arguments + list(options) + site["options"]
+
+
+# Last line of a log, telling why a site failed
+def last_line(path):
+    try:
+        with open(path, errors="replace") as f:
+            lines = [line.strip() for line in f if line.strip()]
+    except OSError:
+        return ""
+    return lines[-1] if lines else ""
+
+
+def run_site(site, command, options):
+    """
+    Runs a command on one site in its own process, logging its output to the site directory.
+
+    :param site: The site, as returned by load_manifest.
+    :type site: dict
+    :param command: The command to run, create or update.
+    :type command: str
+    :param options: The options passed to the command of every site.
+    :type options: list
+    :return: The site name, whether it succeeded, the elapsed seconds and the log path or the error.
+    :rtype: tuple
+    """
+    start = time.perf_counter()
+    directory = site["directory"]
+    if not os.path.isdir(directory):
+        return site["name"], False, 0.0, f"Directory not found: {directory}"
+    log_path = os.path.join(directory, SITE_LOG)
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [PACKAGE_ROOT, environment.get("PYTHONPATH")])
+    )
+    with open(log_path, "w") as log:
+        # No site can be prompted, its input is closed
+        result = subprocess.run(
+            site_command(site, command, options),
+            cwd=directory,
+            env=environment,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        return site["name"], False, elapsed, f"{log_path}: {last_line(log_path)}"
+    return site["name"], True, elapsed, log_path
+
+
+def run_sites(sites, command, options, workers):
+    """
+    Runs a command on every site, at most workers at a time.
+
+    A failing site does not stop the others. Each site is reported on stderr
+    as it finishes.
+
+    :return: The result of run_site for each site, in manifest order.
+    :rtype: list
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(run_site, site, command, options): site["name"]
+            for site in sites
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as error:
+                results[name] = (name, False, 0.0, str(error))
+            _, succeeded, elapsed, _ = results[name]
+            print(
+                f"{name}: {'ok' if succeeded else 'failed'} in {elapsed:.1f}s",
+                file=sys.stderr,
+            )
+    return [results[site["name"]] for site in sites]
+
+
+def format_results(results):
+    """
+    Formats the consolidated table of the site results.
+    """
+    width = max([len("Site")] + [len(name) for name, _, _, _ in results])
+    lines = [f"{'Site':<{width}}  {'Status':<6}  {'Time':>8}  Log"]
+    for name, succeeded, elapsed, detail in results:
+        status = "ok" if succeeded else "failed"
+        lines.append(f"{name:<{width}}  {status:<6}  {elapsed:7.1f}s  {detail}")
+    failed = sum(1 for result in results if not result[1])
+    lines.append(f"{len(results)} sites: {len(results) - failed} ok, {failed} failed")
+    return "\n".join(lines)
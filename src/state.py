@@ -0,0 +1,276 @@
+# Description: Offline comparison of the rendered resources with a terraform state file
+import io
+import json
+import re
+from src import plans
+
+STATE_FILE = "terraform.tfstate"
+# An attribute value made of a single reference to another resource attribute
+REFERENCE = re.compile(r"^\$\{([A-Za-z_][\w-]*\.[\w-]+)\.(\w+)\}$")
+# The same reference, as a string of the rendered JSON configuration
+QUOTED_REFERENCE = re.compile(r'"\$\{([A-Za-z_][\w-]*\.[\w-]+)\.(\w+)\}"')
+# Serial and lineage of a state, written before its resources
+SERIAL = re.compile(rb'"serial":\s*(\d+)')
+LINEAGE = re.compile(rb'"lineage":\s*"([^"]*)"')
+# Size of the head of a state file read for its serial and lineage
+STATE_HEAD_SIZE = 4096
+# Attributes whose values are never printed
+SENSITIVE_ATTRIBUTES = ("password", "power_parameters")
+
+
+class Unknown:
+    """
+    Value of a reference to a resource missing from the state, only known once it is created.
+    """
+
+    def __str__(self):
+        return "(known after apply)"
+
+
+UNKNOWN = Unknown()
+
+
+def state_version(path):
+    """
+    Returns the serial and the lineage of a state file, None if there is none.
+
+    Terraform writes them at the top of the file, so only its head is read
+    whatever the size of the state.
+
+    :param path: The path to the terraform.tfstate file.
+    :type path: str
+    :return: The [serial, lineage] of the state.
+    :rtype: list
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(STATE_HEAD_SIZE)
+    except FileNotFoundError:
+        return None
+    serial = SERIAL.search(head)
+    lineage = LINEAGE.search(head)
+    if serial is None or lineage is None:
+        try:
+            with open(path) as f:
+                content = json.load(f)
+        except ValueError:
+            return None
+        return [content.get("serial"), content.get("lineage")]
+    return [int(serial.group(1)), lineage.group(1).decode()]
+
+
+def iter_state_resources(path):
+    """
+    Yields the address and the attributes of each managed resource instance of a state file.
+
+    The file is parsed as it is read, with ijson when it is installed and
+    with plans.iter_array_items otherwise, so only one resource is held in
+    memory at a time whatever the size of the state.
+
+    :param path: The path to the terraform.tfstate file.
+    :type path: str
+    :return: A generator yielding (address, attributes) tuples.
+    :rtype: Iterator[tuple]
+    """
+    with open(path, "rb") as f:
+        try:
+            import ijson
+
+            resources = ijson.items(f, "resources.item")
+        except ImportError:
+            stream = io.TextIOWrapper(f, encoding="utf-8")
+            resources = plans.iter_array_items(plans.iter_chunks(stream), "resources")
+
+        for resource in resources:
+            # Data sources are read again on every run
+            if resource.get("mode") != "managed":
+                continue
+            address = f"{resource['type']}.{resource['name']}"
+            if resource.get("module"):
+                address = f"{resource['module']}.{address}"
+            for instance in resource.get("instances", []):
+                key = ""
+                if "index_key" in instance:
+                    key = f"[{json.dumps(instance['index_key'])}]"
+                yield address + key, instance.get("attributes") or {}
+
+
+def desired_resources(csv_files, cache=None, address_book=None):
+    """
+    Renders the resources of the csv files and indexes their attributes by address.
+
+    :param csv_files: The csv file paths, keyed by configuration name.
+    :type csv_files: dict
+    :param cache: The cache of the previously rendered JSON blocks.
+    :type cache: RenderCache
+    :param address_book: The addresses allocated to the static nics.
+    :type address_book: AddressBook
+    :return: The attributes of each resource, keyed by address, references being
+        "${address.attribute}", and the set of (address, attribute) referenced.
+    :rtype: tuple
+    """
+    from src import generateFunctions as gf
+    from src import tfjson
+
+    text = "".join(
+        gf.generate_terraform_script(
+            "",
+            "",
+            csv_files,
+            cache=cache,
+            output_format=tfjson,
+            address_book=address_book,
+        )
+    )
+    # Scanning the text is much faster than walking the parsed values
+    references = set(QUOTED_REFERENCE.findall(text))
+    resources = {}
+    for block in json.loads(text).get("resource", []):
+        for resource_type, named in block.items():
+            for name, attributes in named.items():
+                resources[f"{resource_type}.{name}"] = attributes
+    return resources, references
+
+
+# The (address, attribute) a value references, None for a literal value
+def parse_reference(value):
+    if isinstance(value, str) and value.startswith("${"):
+        match = REFERENCE.match(value)
+        if match:
+            return match.group(1), match.group(2)
+    return None
+
+
+# Replace the references of a value with the attributes found in the state
+def resolve(value, current):
+    reference = parse_reference(value)
+    if reference is not None:
+        address, attribute = reference
+        if address not in current:
+            return UNKNOWN
+        return current[address].get(attribute)
+    if isinstance(value, dict):
+        return {name: resolve(item, current) for name, item in value.items()}
+    if isinstance(value, list):
+        return [resolve(item, current) for item in value]
+    return value
+
+
+def same_value(desired, actual, current):
+    """
+    Tells whether a configured value matches the value stored in the state.
+
+    References are replaced with the attributes of the referenced resources
+    in current. Only the keys set in the configuration are compared, as the
+    state also holds the computed ones. Nested blocks, stored as lists in
+    the state, are matched whatever their order, and numbers match their
+    string form.
+    """
+    if desired == actual:
+        return True
+    if isinstance(desired, str) and desired.startswith("${"):
+        desired = resolve(desired, current)
+        if desired is UNKNOWN:
+            return False
+        if desired == actual:
+            return True
+    if isinstance(desired, dict):
+        # A single nested block is a list of one object in the state
+        if isinstance(actual, list) and len(actual) == 1:
+            actual = actual[0]
+        return isinstance(actual, dict) and all(
+            same_value(item, actual.get(name), current)
+            for name, item in desired.items()
+        )
+    if isinstance(desired, list):
+        if not isinstance(actual, list) or len(actual) != len(desired):
+            return False
+        unmatched = list(actual)
+        for item in desired:
+            for index, candidate in enumerate(unmatched):
+                if same_value(item, candidate, current):
+                    del unmatched[index]
+                    break
+            else:
+                return False
+        return True
+    if isinstance(desired, bool) or isinstance(actual, bool):
+        return desired == actual
+    if actual is None:
+        return desired == ""
+    return str(desired) == str(actual)
+
+
+def diff_state(desired, references, state_resources):
+    """
+    Compares the rendered resources with the resources of the state.
+
+    Only the attributes set in the configuration, and those referenced by
+    other resources, are kept from each state resource, so the memory used
+    depends on the configuration and not on the state.
+
+    :param desired: The attributes of the rendered resources, keyed by address.
+    :type desired: dict
+    :param references: The (address, attribute) pairs the resources reference.
+    :type references: set
+    :param state_resources: The (address, attributes) tuples of the state.
+    :type state_resources: Iterator[tuple]
+    :return: The ("+", "~" or "-", address, [(attribute, before, after)]) changes.
+    :rtype: list
+    """
+    kept = {address: list(attributes) for address, attributes in desired.items()}
+    for address, attribute in references:
+        kept.setdefault(address, []).append(attribute)
+
+    current = {}
+    removed = []
+    for address, attributes in state_resources:
+        if address not in desired:
+            removed.append(address)
+        if address in kept:
+            current[address] = {name: attributes.get(name) for name in kept[address]}
+
+    changes = []
+    for address, attributes in desired.items():
+        if address not in current:
+            changes.append(("+", address, []))
+            continue
+        before = current[address]
+        changed = [
+            (name, before[name], resolve(value, current))
+            for name, value in attributes.items()
+            if not same_value(value, before[name], current)
+        ]
+        if changed:
+            changes.append(("~", address, changed))
+    changes.extend(("-", address, []) for address in removed)
+    return changes
+
+
+# Format a value of the diff, hiding the sensitive ones
+def format_value(name, value):
+    if value is UNKNOWN:
+        return str(UNKNOWN)
+    if name in SENSITIVE_ATTRIBUTES:
+        return "(sensitive value)"
+    return json.dumps(value, default=str)
+
+
+def format_diff(changes):
+    """
+    Formats the changes the way terraform plan lists them, with a summary line.
+    """
+    lines = []
+    for symbol, address, attributes in changes:
+        lines.append(f"{symbol} {address}")
+        lines.extend(
+            f"    {name}: {format_value(name, before)} -> {format_value(name, after)}"
+            for name, before, after in attributes
+        )
+    counts = {symbol: 0 for symbol in "+~-"}
+    for symbol, _, _ in changes:
+        counts[symbol] += 1
+    lines.append(
+        f"Diff: {counts['+']} to add, {counts['~']} to change, {counts['-']} to destroy."
+    )
+    return "\n".join(lines)
@@ -0,0 +1,84 @@
+# Description: Emitter of the terraform JSON configuration syntax
+from src import hcl
+
+try:
+    import orjson
+
+    def dumps(value):
+        return orjson.dumps(value).decode()
+
+except ImportError:
+    import json
+
+    def dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+EXTENSION = ".tf.json"
+
+
+# Escape the template sequences of a string literal
+def escape(value):
+    return value.replace("${", "$${").replace("%{", "%%{")
+
+
+# Convert an attribute value into its JSON value
+def convert_value(value):
+    if isinstance(value, hcl.Expression):
+        return "${" + value + "}"
+    if isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [convert_value(item) for item in value]
+    if isinstance(value, dict):
+        return {name: convert_value(item) for name, item in value.items()}
+    return escape(str(value))
+
+
+# Group blocks by type, repeated blocks of a type being written as an array
+def group_blocks(blocks, converted):
+    for block in blocks:
+        converted.setdefault(block.type, []).append(convert_labels(block))
+    for block_type, group in converted.items():
+        if len(group) == 1:
+            converted[block_type] = group[0]
+    return converted
+
+
+# Convert a block body into a JSON object
+def convert_body(body):
+    converted = {}
+    blocks = []
+    for item in body:
+        if isinstance(item, hcl.Block):
+            blocks.append(item)
+        else:
+            name, value = item
+            converted[name] = convert_value(value)
+    return {**converted, **group_blocks(blocks, {})}
+
+
+# Nest the body of a block under its labels
+def convert_labels(block):
+    converted = convert_body(block.body)
+    for label in reversed(block.labels):
+        converted = {label: converted}
+    return converted
+
+
+# Render a resource block as an element of the resource array
+def render_block(block):
+    return dumps(convert_labels(block))
+
+
+# Written between two resource blocks
+SEPARATOR = ",\n"
+
+
+# Start of the document, holding the settings and provider blocks
+def open_document(blocks):
+    return dumps(group_blocks(blocks, {}))[:-1] + ',"resource":[\n'
+
+
+def close_document():
+    return "\n]}\n"
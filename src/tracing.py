@@ -0,0 +1,193 @@
+# Description: Lightweight spans timing the phases of a run
+#
+# Tracing is off unless start() is called, and every helper then returns
+# immediately, so the instrumented code pays a function call at most.
+import contextlib
+import os
+import sys
+import time
+
+# Number of slowest machines listed in the summary
+SLOWEST_MACHINES = 10
+# Returned by span() when tracing is off
+NULL_SPAN = contextlib.nullcontext({})
+
+# The active tracer, None when tracing is off
+tracer = None
+
+
+class Tracer:
+    """
+    Records the spans of a run as (name, category, start, duration, args) events.
+    Times are in nanoseconds from time.perf_counter_ns.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, name, category="phase", **args):
+        start = time.perf_counter_ns()
+        try:
+            # The caller can add arguments, such as counts, to the yielded dict
+            yield args
+        finally:
+            self.events.append(
+                (name, category, start, time.perf_counter_ns() - start, args)
+            )
+
+    def iterate(self, name, iterable, unit="items", category="layer"):
+        """
+        Yields the items of an iterable, recording the time spent producing them.
+
+        The event spans from the first to the last item and its busy time
+        leaves out the time the consumer spent between two items.
+        """
+        iterator = iter(iterable)
+        first = time.perf_counter_ns()
+        busy = 0
+        count = 0
+        while True:
+            start = time.perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                busy += time.perf_counter_ns() - start
+                break
+            busy += time.perf_counter_ns() - start
+            count += 1
+            yield item
+        self.events.append(
+            (
+                name,
+                category,
+                first,
+                time.perf_counter_ns() - first,
+                {"busy_ms": busy / 1e6, unit: count},
+            )
+        )
+
+    def timed(self, category, label, function):
+        """
+        Wraps a function to record an event named by label(*args) for each call.
+        """
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.events.append(
+                    (label(*args), category, start, time.perf_counter_ns() - start, {})
+                )
+
+        return wrapper
+
+    # Events in start order with their nesting depth, hiding the given categories
+    def nested_events(self, hidden=()):
+        stack = []
+        for event in sorted(self.events, key=lambda event: (event[2], -event[3])):
+            if event[1] in hidden:
+                continue
+            while stack and event[2] >= stack[-1][2] + stack[-1][3]:
+                stack.pop()
+            yield len(stack), event
+            stack.append(event)
+
+    def summary(self):
+        lines = ["Timings:"]
+        for depth, (name, category, _, duration, args) in self.nested_events(
+            hidden=("machine",)
+        ):
+            busy = args.get("busy_ms", duration / 1e6)
+            details = ", ".join(
+                f"{key} {value}" for key, value in args.items() if key != "busy_ms"
+            )
+            lines.append(
+                f"{'  ' * (depth + 1)}{name:<{40 - 2 * depth}} {busy:10.1f} ms"
+                + (f"  {details}" if details else "")
+            )
+
+        machines = sorted(
+            (event for event in self.events if event[1] == "machine"),
+            key=lambda event: event[3],
+            reverse=True,
+        )
+        if machines:
+            lines.append(f"Slowest machines to render, out of {len(machines)}:")
+            lines.extend(
+                f"  {name:<40} {duration / 1e6:10.1f} ms"
+                for name, _, _, duration, _ in machines[:SLOWEST_MACHINES]
+            )
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path):
+        """
+        Writes the events in the Chrome trace event format, loadable in
+        chrome://tracing or Perfetto.
+        """
+        import json
+
+        origin = min((event[2] for event in self.events), default=0)
+        process = os.getpid()
+        trace = {
+            "displayTimeUnit": "ms",
+            "traceEvents": [
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - origin) / 1000,
+                    "dur": duration / 1000,
+                    "pid": process,
+                    "tid": process,
+                    "args": args,
+                }
+                for name, category, start, duration, args in self.events
+            ],
+        }
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+
+# Turn tracing on for the rest of the run
+def start():
+    global tracer
+    tracer = Tracer()
+
+
+# Turn tracing off, printing the summary and writing the trace file if asked
+def stop(timings=False, trace_file=None):
+    global tracer
+    if tracer is None:
+        return
+    finished, tracer = tracer, None
+    if timings:
+        print(finished.summary(), file=sys.stderr)
+    if trace_file:
+        finished.write_chrome_trace(trace_file)
+
+
+def enabled():
+    return tracer is not None
+
+
+# Time a block of code
+def span(name, category="phase", **args):
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, category, **args)
+
+
+# Time the production of the items of an iterable, counted in the given unit
+def iterate(name, iterable, unit="items", category="layer"):
+    if tracer is None:
+        return iterable
+    return tracer.iterate(name, iterable, unit, category)
+
+
+# Time each call of a function, naming the events with label(*args)
+def timed(category, label, function):
+    if tracer is None:
+        return function
+    return tracer.timed(category, label, function)
@@ -0,0 +1,304 @@
+# Description: Validation of the network and nics configurations before running terraform
+import ipaddress
+import os
+import socket
+from src import dataExtractionFunctions as extract
+
+
+class ValidationError:
+    """
+    A mistake found in a csv file, with the row it was found on.
+
+    Args:
+        csv_file (str): The csv file holding the row.
+        row (int): The csv row number, starting at 1 for the first line.
+        message (str): The description of the mistake.
+    """
+
+    __slots__ = ("csv_file", "row", "message")
+
+    def __init__(self, csv_file, row, message):
+        self.csv_file = csv_file
+        self.row = row
+        self.message = message
+
+    def __str__(self):
+        return f"{os.path.basename(self.csv_file)}:{self.row}: {self.message}"
+
+
+# Convert an ip address into its (version, integer) pair, None if it is invalid
+def parse_ip(value):
+    value = value.strip()
+    for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+        try:
+            return version, int.from_bytes(socket.inet_pton(family, value), "big")
+        except OSError:
+            continue
+    return None
+
+
+# Convert a cidr into its (version, first address, last address), None if it is invalid
+def parse_cidr(value):
+    try:
+        network = ipaddress.ip_network(value.strip(), strict=False)
+    except ValueError:
+        return None
+    return (
+        network.version,
+        int(network.network_address),
+        int(network.broadcast_address),
+    )
+
+
+def find_overlaps(intervals):
+    """
+    Finds the overlapping intervals with a sort and a single sweep.
+
+    Each interval is compared with the interval reaching the furthest among
+    the ones starting before it, which finds every interval overlapping
+    another one in O(n log n).
+
+    :param intervals: The (version, start, end, label) intervals, bounds included.
+    :type intervals: list
+    :return: The (label, overlapped label) pairs.
+    :rtype: list
+    """
+    overlaps = []
+    furthest = None
+    for interval in sorted(intervals, key=lambda interval: interval[:3]):
+        if (
+            furthest is not None
+            and furthest[0] == interval[0]
+            and interval[1] <= furthest[2]
+        ):
+            overlaps.append((interval[3], furthest[3]))
+        if furthest is None or furthest[0] != interval[0] or interval[2] > furthest[2]:
+            furthest = interval
+    return overlaps
+
+
+# Validate the cidr, gateway and ip ranges of the subnets
+def validate_subnets(network_file, subnets):
+    errors = []
+    networks = []
+    for subnet in subnets:
+        row = subnet["row"]
+        name = subnet["subnet_name"]
+        cidr = parse_cidr(subnet["attributes"]["cidr"])
+        if cidr is None:
+            errors.append(
+                ValidationError(
+                    network_file,
+                    row,
+                    f"subnet {name} has an invalid CIDR: {subnet['attributes']['cidr']!r}",
+                )
+            )
+            continue
+        version, first, last = cidr
+        networks.append((version, first, last, subnet))
+
+        gateway_cell = subnet["attributes"]["gateway_ip"]
+        if gateway_cell:
+            gateway = parse_ip(gateway_cell)
+            if gateway is None:
+                errors.append(
+                    ValidationError(
+                        network_file,
+                        row,
+                        f"subnet {name} has an invalid gateway: {gateway_cell!r}",
+                    )
+                )
+            elif gateway[0] != version or not first <= gateway[1] <= last:
+                errors.append(
+                    ValidationError(
+                        network_file,
+                        row,
+                        f"subnet {name} gateway {gateway_cell} is outside {subnet['attributes']['cidr']}",
+                    )
+                )
+
+        ranges = []
+        for ip_range in subnet["ip_ranges"]:
+            if ip_range is None:
+                errors.append(
+                    ValidationError(
+                        network_file,
+                        row,
+                        f"subnet {name} has an ip range not written as start-end",
+                    )
+                )
+                continue
+            label = f"{ip_range['type']} range {ip_range['start_ip']}-{ip_range['end_ip']}"
+            start = parse_ip(ip_range["start_ip"])
+            end = parse_ip(ip_range["end_ip"])
+            if start is None or end is None:
+                errors.append(
+                    ValidationError(
+                        network_file, row, f"subnet {name} has an invalid {label}"
+                    )
+                )
+            elif start[1] > end[1]:
+                errors.append(
+                    ValidationError(
+                        network_file, row, f"subnet {name} {label} ends before it starts"
+                    )
+                )
+            elif (
+                start[0] != version
+                or end[0] != version
+                or start[1] < first
+                or end[1] > last
+            ):
+                errors.append(
+                    ValidationError(
+                        network_file,
+                        row,
+                        f"subnet {name} {label} is outside {subnet['attributes']['cidr']}",
+                    )
+                )
+            else:
+                ranges.append((version, start[1], end[1], label))
+
+        for label, other in find_overlaps(ranges):
+            errors.append(
+                ValidationError(
+                    network_file, row, f"subnet {name} {label} overlaps {other}"
+                )
+            )
+
+    for subnet, other in find_overlaps(networks):
+        errors.append(
+            ValidationError(
+                network_file,
+                subnet["row"],
+                f"subnet {subnet['subnet_name']} {subnet['attributes']['cidr']} "
+                f"overlaps subnet {other['subnet_name']} {other['attributes']['cidr']} "
+                f"on row {other['row']}",
+            )
+        )
+
+    return errors
+
+
+# Validate the static ip addresses of the machine nics
+def validate_nics(nics_file, subnets, machines, nics):
+    errors = []
+    # Subnets with an invalid cidr, already reported, are indexed as None so
+    # their nics are only checked for invalid and duplicate addresses
+    subnet_index = {}
+    for subnet in subnets:
+        cidr = parse_cidr(subnet["attributes"]["cidr"])
+        subnet_index[subnet["subnet_name"]] = None
+        if cidr is not None:
+            dynamic_ranges = []
+            for ip_range in subnet["ip_ranges"]:
+                if ip_range is None or ip_range["type"] != "dynamic":
+                    continue
+                start = parse_ip(ip_range["start_ip"])
+                end = parse_ip(ip_range["end_ip"])
+                if start is not None and end is not None:
+                    dynamic_ranges.append((start[1], end[1]))
+            subnet_index[subnet["subnet_name"]] = (cidr, dynamic_ranges)
+
+    # Machines using each nic row, a static address being shared by all of them
+    users = {}
+    for machine in machines:
+        for name in extract.split_cell(machine.nic_name):
+            users.setdefault(name, []).append(machine.resource_name)
+
+    addresses = []
+    for nic in nics:
+        if nic.subnet_name not in subnet_index:
+            errors.append(
+                ValidationError(
+                    nics_file,
+                    nic.row,
+                    f"nic {nic.resource_name} references unknown subnet {nic.subnet_name!r}",
+                )
+            )
+            continue
+        if nic.mode.upper() != "STATIC" or not nic.ip_address:
+            continue
+
+        address = parse_ip(nic.ip_address)
+        if address is None:
+            errors.append(
+                ValidationError(
+                    nics_file,
+                    nic.row,
+                    f"nic {nic.resource_name} has an invalid ip address: {nic.ip_address!r}",
+                )
+            )
+            continue
+        subnet = subnet_index[nic.subnet_name]
+        if subnet is not None:
+            (version, first, last), dynamic_ranges = subnet
+            if address[0] != version or not first <= address[1] <= last:
+                errors.append(
+                    ValidationError(
+                        nics_file,
+                        nic.row,
+                        f"nic {nic.resource_name} ip address {nic.ip_address} is outside subnet {nic.subnet_name}",
+                    )
+                )
+                continue
+            if any(start <= address[1] <= end for start, end in dynamic_ranges):
+                errors.append(
+                    ValidationError(
+                        nics_file,
+                        nic.row,
+                        f"nic {nic.resource_name} ip address {nic.ip_address} is inside the dynamic range of subnet {nic.subnet_name}",
+                    )
+                )
+        for machine_name in users.get(nic.resource_name, [None]):
+            addresses.append((address, nic, machine_name))
+
+    # Sort the addresses so duplicates end up next to each other
+    addresses.sort(key=lambda entry: entry[0])
+    for previous, current in zip(addresses, addresses[1:]):
+        if previous[0] != current[0]:
+            continue
+        (_, nic, machine_name), (_, other, other_machine) = current, previous
+        errors.append(
+            ValidationError(
+                nics_file,
+                nic.row,
+                f"ip address {nic.ip_address} of nic {nic.resource_name}"
+                + (f" on machine {machine_name}" if machine_name else "")
+                + f" is also used by nic {other.resource_name}"
+                + (f" on machine {other_machine}" if other_machine else "")
+                + f" on row {other.row}",
+            )
+        )
+
+    return errors
+
+
+def validate(csv_files):
+    """
+    Validates the network, machines and nics csv files before terraform is run.
+
+    Addresses are compared as integers: subnets and ip ranges are checked
+    for overlaps with sorted sweeps and duplicate static addresses are found
+    by sorting them, so the checks stay O(n log n).
+
+    :param csv_files: The csv file paths, keyed by configuration name.
+    :type csv_files: dict
+    :return: Every mistake found, in csv order.
+    :rtype: list
+    """
+    network_file = csv_files["network-config"]
+    subnets = extract.NetworkTable(extract.read_csv_data(network_file)).subnets
+    errors = validate_subnets(network_file, subnets)
+
+    nics_file = csv_files["nics-config"]
+    errors.extend(
+        validate_nics(
+            nics_file,
+            subnets,
+            extract.load_records(csv_files["node-config"], extract.NodeRecord),
+            extract.load_records(nics_file, extract.NicRecord),
+        )
+    )
+    errors.sort(key=lambda error: (error.csv_file, error.row))
+    return errors
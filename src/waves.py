@@ -0,0 +1,302 @@
+# Description: Apply of the machines in waves, once the network layer is applied
+import os
+import sys
+import time
+from src import dataExtractionFunctions as extract
+from src import plans
+from src import resources
+from src import shards
+from src import tracing
+
+# Wave key cutting the machines in waves of the same size, in csv order
+COUNT_KEY = "count"
+MACHINE_PREFIX = "maas_machine."
+# Latency per machine of a wave, relative to the first wave, over which the
+# next waves are halved and under which they grow by GROWTH
+SLOW_LATENCY = 2.0
+FAST_LATENCY = 1.2
+GROWTH = 1.5
+# Largest adaptive wave, relative to the configured wave size
+MAX_GROWTH = 4
+# Failed waves applied again, smaller and with less parallelism, before giving up
+WAVE_RETRIES = 2
+
+
+class WaveSchedule:
+    """
+    How the changed machines of a plan are cut in waves.
+
+    Args:
+        wave_by (str): "count", or a key of shards.machine_keys grouping the
+            machines, such as "vlan", "power-subnet" or a rack column.
+        size (int): The number of machines of a wave, None for whole groups.
+        parallelism (int): The -parallelism of terraform apply in each wave.
+        adaptive (bool): Whether the size of the waves follows their errors and latency.
+        csv_files (dict): The csv file paths, keyed by configuration name.
+        script_path (str): The generated terraform script.
+    """
+
+    def __init__(self, wave_by, size, parallelism, adaptive, csv_files, script_path):
+        if wave_by == COUNT_KEY and not size:
+            raise Exception("Waves by count need a wave size")
+        self.wave_by = wave_by
+        self.size = size
+        self.parallelism = parallelism
+        self.adaptive = adaptive
+        self.csv_files = csv_files
+        self.script_path = script_path
+
+
+class WaveRejected(Exception):
+    """
+    The plan of a wave changes resources missing from the approved plan.
+    Applying the wave again can't help, so it is never retried.
+    """
+
+
+def group_changes(addresses, index):
+    """
+    Splits the changed addresses of a plan between the machines they belong to.
+
+    A resource belongs to the machine it is, or to the machine it references,
+    such as the block devices and the nics of a machine.
+
+    :param addresses: The addresses of the changed resources.
+    :type addresses: Iterable[str]
+    :param index: The resource blocks of the script, keyed by address.
+    :type index: dict
+    :return: The addresses of the other resources of the script, the
+        addresses of each machine keyed by machine address, and the
+        addresses of the resources removed from the script.
+    :rtype: tuple
+    """
+    layer = []
+    machines = {}
+    removed = []
+    for address in addresses:
+        if address not in index:
+            removed.append(address)
+            continue
+        if address.startswith(MACHINE_PREFIX):
+            owner = address
+        else:
+            references = sorted(resources.resource_references(index[address]))
+            owner = next(
+                (
+                    reference
+                    for reference in references
+                    if reference.startswith(MACHINE_PREFIX)
+                ),
+                None,
+            )
+        if owner is None:
+            layer.append(address)
+        else:
+            machines.setdefault(owner, []).append(address)
+    return layer, machines, removed
+
+
+# Group the changed machines by wave key, keeping the csv order
+def machine_groups(schedule, changed):
+    machines = extract.load_records(
+        schedule.csv_files["node-config"], extract.NodeRecord
+    )
+    key = None if schedule.wave_by == COUNT_KEY else schedule.wave_by
+    groups = {}
+    for machine, machine_key in zip(
+        machines, shards.machine_keys(machines, schedule.csv_files, key)
+    ):
+        address = MACHINE_PREFIX + machine.resource_name
+        if address in changed:
+            groups.setdefault(machine_key, []).append(address)
+    return list(groups.values())
+
+
+def apply_wave(
+    terraform, cwd, label, targets, parallelism, approved, yes, monitor=None
+):
+    """
+    Plans the targeted resources, checks the plan only changes approved
+    resources and, unless yes, prompts for it, then applies it with the
+    given parallelism, followed by the monitor if one is given.
+
+    The state may have changed since the whole plan was approved, so the
+    plan of each wave is checked again before it is applied.
+
+    :param approved: The addresses of the changed resources of the approved plan.
+    :type approved: set
+    :param yes: Whether the wave is applied without prompting.
+    :type yes: bool
+    :return: The time spent applying, in seconds, None if the wave was not confirmed.
+    :rtype: float
+    """
+    with tracing.span(label, resources=len(targets), parallelism=parallelism):
+        if not plans.plan(terraform, cwd, [f"-target={target}" for target in targets]):
+            os.remove(os.path.join(cwd, plans.PLAN_FILE))
+            return 0.0
+
+        unexpected = []
+
+        def check(resource_changes):
+            for change in resource_changes:
+                if (
+                    plans.change_action(change["change"]["actions"]) != "no-op"
+                    and change["address"] not in approved
+                ):
+                    unexpected.append(change["address"])
+                yield change
+
+        summary = plans.summarize(check(plans.iter_resource_changes(terraform, cwd)))
+        title = label[0].upper() + label[1:]
+        if unexpected:
+            os.remove(os.path.join(cwd, plans.PLAN_FILE))
+            raise WaveRejected(
+                f"{title} changes resources that were not approved, "
+                "the previous waves are applied:\n" + "\n".join(unexpected)
+            )
+        if not yes:
+            print(f"{title}:")
+            plans.print_summary(summary)
+            user_input = input("Do you want to apply the changes? (yes/no): ")
+            if user_input.lower() != "yes":
+                os.remove(os.path.join(cwd, plans.PLAN_FILE))
+                return None
+        start = time.perf_counter()
+        plans.apply(
+            terraform,
+            cwd,
+            plans.PLAN_FILE,
+            options=[f"-parallelism={parallelism}"],
+            monitor=monitor,
+        )
+        return time.perf_counter() - start
+
+
+def apply_waves(terraform, cwd, addresses, schedule, yes=False, monitor=None):
+    """
+    Applies the changes of a plan in waves: the network layer and the other
+    resources that belong to no machine first, then the machines wave by
+    wave, then the removal of the resources missing from the script. A wave
+    only starts once the previous one succeeded, and is only applied when
+    its own plan changes none but the resources of the approved plan.
+
+    With adaptive waves, a failed wave is applied again with half its size
+    and parallelism, up to WAVE_RETRIES times in a row. A wave whose latency
+    per machine is over SLOW_LATENCY times the one of the first wave halves
+    the next waves, and one under FAST_LATENCY times grows them by GROWTH, up
+    to MAX_GROWTH times the configured size. The parallelism goes back up to
+    the configured one after each successful wave.
+
+    :param terraform: The path to the terraform executable.
+    :type terraform: str
+    :param cwd: The directory of the terraform workspace.
+    :type cwd: str
+    :param addresses: The addresses of the changed resources of the plan.
+    :type addresses: Iterable[str]
+    :param schedule: How the machines are cut in waves.
+    :type schedule: WaveSchedule
+    :param yes: Whether the waves are applied without prompting for each one.
+    :type yes: bool
+    :param monitor: The monitor following the applied resources, if any.
+    :type monitor: ApplyMonitor
+    :return: True if every wave was applied, False if one was not confirmed.
+    :rtype: bool
+    """
+    approved = set(addresses)
+    layer, machines, removed = group_changes(
+        approved, resources.index_resources(schedule.script_path)
+    )
+    if layer:
+        elapsed = apply_wave(
+            terraform,
+            cwd,
+            "network layer",
+            layer,
+            schedule.parallelism,
+            approved,
+            yes,
+            monitor,
+        )
+        if elapsed is None:
+            return False
+
+    number = 0
+    baseline = None
+    # Without a wave size, each group is a wave until a wave is halved
+    size = schedule.size
+    parallelism = schedule.parallelism
+    failures = 0
+    for group in machine_groups(schedule, machines):
+        pending = group
+        while pending:
+            wave = pending[: size or len(pending)]
+            number += 1
+            targets = [address for machine in wave for address in machines[machine]]
+            try:
+                elapsed = apply_wave(
+                    terraform,
+                    cwd,
+                    f"wave {number}",
+                    targets,
+                    parallelism,
+                    approved,
+                    yes,
+                    monitor,
+                )
+            except WaveRejected:
+                raise
+            except Exception as error:
+                failures += 1
+                if not schedule.adaptive or failures > WAVE_RETRIES:
+                    raise Exception(
+                        f"Wave {number} of {len(wave)} machines failed, "
+                        f"the previous waves are applied: {error}"
+                    )
+                size = max(1, len(wave) // 2)
+                parallelism = max(1, parallelism // 2)
+                print(
+                    f"Wave {number} failed, retrying with {size} machines "
+                    f"and parallelism {parallelism}",
+                    file=sys.stderr,
+                )
+                continue
+            if elapsed is None:
+                return False
+
+            failures = 0
+            pending = pending[len(wave) :]
+            print(
+                f"Wave {number}: {len(wave)} machines applied in {elapsed:.1f}s "
+                f"with parallelism {parallelism}",
+                file=sys.stderr,
+            )
+            if not schedule.adaptive:
+                continue
+            parallelism = schedule.parallelism
+            # The last wave of a group is cut short, its latency is left out
+            if not elapsed or (size and len(wave) < size):
+                continue
+            latency = elapsed / len(wave)
+            if baseline is None:
+                baseline = latency
+            elif latency > baseline * SLOW_LATENCY:
+                size = max(1, len(wave) // 2)
+            elif latency < baseline * FAST_LATENCY and schedule.size:
+                size = min(
+                    max(size + 1, int(size * GROWTH)), schedule.size * MAX_GROWTH
+                )
+
+    if removed:
+        elapsed = apply_wave(
+            terraform,
+            cwd,
+            "removed resources",
+            removed,
+            schedule.parallelism,
+            approved,
+            yes,
+            monitor,
+        )
+        if elapsed is None:
+            return False
+    return True
@@ -0,0 +1,72 @@
+# Description: Stand-in MAAS API server answering canned JSON over http.server
+import json
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+API_PREFIX = "/MAAS/api/2.0/"
+
+
+class MaasStub:
+    """
+    Serves the given endpoints on a local port until the context is left.
+
+    Args:
+        responses (dict): The decoded JSON of each endpoint, keyed by the
+            path after the API prefix, e.g. "fabrics/".
+        busy (int): The number of first requests answered 503, to exercise
+            the retries.
+    """
+
+    def __init__(self, responses, busy=0):
+        self.responses = responses
+        self.busy = busy
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/MAAS"
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests.append((self.path, self.headers["Authorization"]))
+                    busy = len(stub.requests) <= stub.busy
+                path = self.path[len(API_PREFIX) :]
+                if busy:
+                    self.answer(503, b"", {"Retry-After": "0"})
+                elif not self.path.startswith(API_PREFIX) or path not in stub.responses:
+                    self.answer(404, b"")
+                else:
+                    self.answer(200, json.dumps(stub.responses[path]).encode())
+
+            def answer(self, status, body, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
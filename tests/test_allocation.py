@@ -0,0 +1,86 @@
+# Description: Tests of the allocation of the static ip addresses
+from src import allocation
+from src import dataExtractionFunctions as extract
+
+SUBNET = {
+    "subnet_name": "Rack-0",
+    "attributes": {"cidr": "10.0.0.0/20", "gateway_ip": "10.0.0.1"},
+    "ip_ranges": [
+        {"type": "dynamic", "start_ip": "10.0.0.2", "end_ip": "10.0.0.20"},
+        {"type": "reserved", "start_ip": "10.0.0.21", "end_ip": "10.0.0.30"},
+    ],
+}
+NIC_INDEX = {
+    "data": extract.NicRecord(["data", "100", "", "STATIC", "", "true", "Rack-0"])
+}
+
+
+# Machine rows with a single static nic
+def machines(names):
+    return [
+        extract.NodeRecord(
+            [name, "ipmi", "", "", "", "/dev/sda", "data", "52:00:00:00:00:00", ""]
+        )
+        for name in names
+    ]
+
+
+def test_added_rows_keep_existing_addresses():
+    book = allocation.AddressBook()
+    existing = [f"node{number:04d}" for number in range(3000)]
+    before = allocation.allocate_addresses([SUBNET], machines(existing), NIC_INDEX, book)
+
+    # New rows before, between and after the existing ones
+    added = [f"extra{number:02d}" for number in range(10)]
+    names = added[:4] + existing[:1500] + added[4:7] + existing[1500:] + added[7:]
+    after = allocation.allocate_addresses([SUBNET], machines(names), NIC_INDEX, book)
+
+    assert {key: after[key] for key in before} == before
+    assert len(set(after.values())) == len(after) == 3010
+
+
+def test_removed_rows_keep_other_addresses():
+    book = allocation.AddressBook()
+    existing = [f"node{number:04d}" for number in range(500)]
+    before = allocation.allocate_addresses([SUBNET], machines(existing), NIC_INDEX, book)
+
+    after = allocation.allocate_addresses(
+        [SUBNET], machines(existing[::2]), NIC_INDEX, book
+    )
+
+    assert after == {key: before[key] for key in after}
+    assert set(book.addresses) == {f"{name}/data" for name in existing[::2]}
+
+
+def test_saved_book_keeps_addresses(tmp_path):
+    path = str(tmp_path / allocation.ADDRESSES_FILE)
+    existing = [f"node{number:04d}" for number in range(100)]
+    book = allocation.AddressBook(path)
+    before = allocation.allocate_addresses([SUBNET], machines(existing), NIC_INDEX, book)
+    book.save()
+
+    names = ["extra"] + existing
+    after = allocation.allocate_addresses(
+        [SUBNET], machines(names), NIC_INDEX, allocation.AddressBook(path)
+    )
+
+    assert {key: after[key] for key in before} == before
+
+
+def test_taken_address_is_allocated_again():
+    book = allocation.AddressBook()
+    before = allocation.allocate_addresses(
+        [SUBNET], machines(["node0000"]), NIC_INDEX, book
+    )
+    address = before["node0000", "data"]
+
+    # The address is now typed in the nics configuration for another nic
+    nic_index = dict(NIC_INDEX)
+    nic_index["fixed"] = extract.NicRecord(
+        ["fixed", "100", "", "STATIC", address, "false", "Rack-0"]
+    )
+    after = allocation.allocate_addresses(
+        [SUBNET], machines(["node0000"]), nic_index, book
+    )
+
+    assert after["node0000", "data"] != address
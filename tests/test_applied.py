@@ -0,0 +1,317 @@
+# Description: Tests of the fingerprints of the last successful apply
+import json
+import os
+import sys
+import pytest
+from benchmarks import inventory
+from src import applied
+from src import commands
+from src import resources
+from src import state
+from src.__main__ import main
+
+SCRIPT = """resource "maas_fabric" "fabric-0" {
+  name = "fabric-0"
+}
+
+resource "maas_vlan" "vlan-100" {
+  fabric = maas_fabric.fabric-0.id
+  vid    = 100
+}
+"""
+SETTINGS = ["key", "http://maas:5240/MAAS", "hcl", None, None]
+JSON_SETTINGS = ["key", "http://maas:5240/MAAS", "json", None, None]
+# Stand-in for terraform: init installs the provider, plan always has changes
+# and apply writes the state with the next serial, unless FAKE_APPLY_FAILS is set
+FAKE_TERRAFORM = """#!{python}
+import json
+import os
+import sys
+
+command = sys.argv[1]
+with open(os.environ["FAKE_TERRAFORM_LOG"], "a") as log:
+    log.write(" ".join(sys.argv[1:]) + "\\n")
+if command == "init":
+    os.makedirs(".terraform/providers/registry.terraform.io/maas/maas/1.0")
+    with open(".terraform.lock.hcl", "w") as f:
+        f.write("lock")
+elif command == "plan":
+    out = [option for option in sys.argv if option.startswith("-out=")][0]
+    with open(out[len("-out="):], "w") as f:
+        f.write("plan")
+    sys.exit(2)
+elif command == "show":
+    change = {{"address": "maas_fabric.fabric-0", "type": "maas_fabric"}}
+    change["change"] = {{"actions": ["update"]}}
+    print(json.dumps({{"resource_changes": [change]}}))
+elif command == "apply":
+    if os.environ.get("FAKE_APPLY_FAILS"):
+        sys.exit(1)
+    serial = 0
+    if os.path.isfile("terraform.tfstate"):
+        with open("terraform.tfstate") as f:
+            serial = json.load(f)["serial"]
+    content = {{"serial": serial + 1, "lineage": "lineage-0", "resources": []}}
+    with open("terraform.tfstate", "w") as f:
+        json.dump(content, f)
+"""
+
+
+@pytest.fixture
+def csv_files(tmp_path):
+    return inventory.generate_inventory(str(tmp_path / "inventory"), 3)
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    script = tmp_path / "terraform_script.tf"
+    script.write_text(SCRIPT)
+    (tmp_path / state.STATE_FILE).write_text(
+        json.dumps({"version": 4, "serial": 3, "lineage": "lineage-0"})
+    )
+    return [(str(script), str(tmp_path / state.STATE_FILE))]
+
+
+# Change the serial of the state, as terraform does on every write
+def bump_serial(state_path):
+    with open(state_path) as f:
+        content = json.load(f)
+    content["serial"] += 1
+    with open(state_path, "w") as f:
+        json.dump(content, f)
+
+
+def test_input_fingerprint(csv_files):
+    inputs = applied.input_fingerprint(csv_files, SETTINGS)
+    assert applied.input_fingerprint(dict(csv_files), list(SETTINGS)) == inputs
+
+    # Only the content of the csv files counts, not their modification time
+    os.utime(csv_files["node-config"], (0, 0))
+    assert applied.input_fingerprint(csv_files, SETTINGS) == inputs
+
+    assert applied.input_fingerprint(csv_files, JSON_SETTINGS) != inputs
+    without_users = {
+        name: path for name, path in csv_files.items() if name != "user-config"
+    }
+    assert applied.input_fingerprint(without_users, SETTINGS) != inputs
+    with open(csv_files["nics-config"], "a") as f:
+        f.write("data-r9,109,None,STATIC,,true,Rack-9\n")
+    assert applied.input_fingerprint(csv_files, SETTINGS) != inputs
+
+
+def test_workspace_fingerprint(workspace, tmp_path):
+    [(script, state_path)] = workspace
+
+    assert applied.workspace_fingerprint(workspace) == [
+        [applied.file_digest(script), [3, "lineage-0"]]
+    ]
+    # A workspace not applied yet has no state
+    os.remove(state_path)
+    assert applied.workspace_fingerprint(workspace) == [
+        [applied.file_digest(script), None]
+    ]
+    assert applied.file_digest(str(tmp_path / "missing.tf")) is None
+
+
+def test_is_current(csv_files, workspace, tmp_path):
+    path = str(tmp_path / "terraform_script.tf.applied")
+    inputs = applied.input_fingerprint(csv_files, SETTINGS)
+    assert not applied.is_current(path, inputs, workspace)
+
+    applied.record(path, inputs, workspace)
+    assert applied.is_current(path, inputs, workspace)
+
+    # A csv file edited or a setting changed
+    with open(csv_files["node-config"], "a") as f:
+        f.write("\n")
+    assert not applied.is_current(
+        path, applied.input_fingerprint(csv_files, SETTINGS), workspace
+    )
+    assert not applied.is_current(
+        path, applied.input_fingerprint(csv_files, JSON_SETTINGS), workspace
+    )
+
+    # The state written by another run
+    [(script, state_path)] = workspace
+    applied.record(path, inputs, workspace)
+    bump_serial(state_path)
+    assert not applied.is_current(path, inputs, workspace)
+
+    # The script edited by hand
+    applied.record(path, inputs, workspace)
+    with open(script, "a") as f:
+        f.write("\n# edited\n")
+    assert not applied.is_current(path, inputs, workspace)
+
+
+def test_record_keeps_the_resources_of_each_script(workspace, tmp_path):
+    path = str(tmp_path / "terraform_script.tf.applied")
+    [(script, _)] = workspace
+    digests = resources.digest_resources(resources.index_resources(script))
+    assert set(digests) == {"maas_fabric.fabric-0", "maas_vlan.vlan-100"}
+
+    applied.record(path, "inputs", workspace)
+    assert applied.load(path)["resources"] == {"terraform_script.tf": digests}
+
+    # The given digests are recorded without indexing the script again
+    other = str(tmp_path / "other.tf")
+    applied.record(path, "inputs", workspace, {script: {"maas_fabric.fabric-0": "0"}})
+    assert applied.applied_resources(path, [script, other]) == {
+        script: {"maas_fabric.fabric-0": "0"},
+        other: None,
+    }
+
+
+def test_record_resources_and_discard(workspace, tmp_path):
+    path = str(tmp_path / "shards.applied")
+    network = str(tmp_path / "network" / "terraform_script.tf")
+    machines = str(tmp_path / "machines" / "terraform_script.tf")
+
+    # Nothing recorded yet
+    applied.discard(path)
+    assert not os.path.exists(path)
+    assert applied.applied_resources(path, [network]) == {network: None}
+
+    applied.record_resources(path, {network: {"maas_vlan.vlan-100": "1"}})
+    applied.record_resources(path, {machines: {"maas_machine.node0": "2"}})
+    assert applied.load(path) == {
+        "resources": {
+            applied.script_key(path, network): {"maas_vlan.vlan-100": "1"},
+            applied.script_key(path, machines): {"maas_machine.node0": "2"},
+        }
+    }
+    assert applied.script_key(path, network) == os.path.join(
+        "network", "terraform_script.tf"
+    )
+    # Recording the resources never makes the workspaces current
+    assert not applied.is_current(path, None, [])
+
+    applied.record(path, "inputs", workspace)
+    assert applied.is_current(path, "inputs", workspace)
+    resources_before = applied.load(path)["resources"]
+
+    applied.discard(path)
+    assert not applied.is_current(path, "inputs", workspace)
+    assert applied.load(path) == {"resources": resources_before}
+
+
+def test_load_ignores_an_invalid_file(tmp_path):
+    path = tmp_path / "terraform_script.tf.applied"
+    path.write_text("{truncated")
+    assert applied.load(str(path)) == {}
+    path.write_text("[]")
+    assert applied.load(str(path)) == {}
+
+
+@pytest.fixture
+def terraform(tmp_path, monkeypatch):
+    directory = tmp_path / "bin"
+    directory.mkdir()
+    path = directory / "terraform"
+    path.write_text(FAKE_TERRAFORM.format(python=sys.executable))
+    path.chmod(0o755)
+    log = tmp_path / "terraform.log"
+    log.write_text("")
+    monkeypatch.setattr(commands, "terraform_path", lambda: str(path))
+    monkeypatch.setenv("FAKE_TERRAFORM_LOG", str(log))
+    monkeypatch.setenv("TF_PLUGIN_CACHE_DIR", str(tmp_path / "plugin-cache"))
+    return log
+
+
+# Run a terramaas command in the workspace, returning the terraform commands it ran
+def run(monkeypatch, terraform, command, csv_files):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "terramaas",
+            command,
+            "-n",
+            csv_files["network-config"],
+            "-p",
+            csv_files["partition-config"],
+            "-b",
+            csv_files["node-config"],
+            "-i",
+            csv_files["nics-config"],
+            "--api-key",
+            "key",
+            "--api-url",
+            "http://maas:5240/MAAS",
+            "--yes",
+        ],
+    )
+    terraform.write_text("")
+    main()
+    return [line.split()[0] for line in terraform.read_text().splitlines()]
+
+
+@pytest.fixture
+def run_directory(tmp_path, monkeypatch):
+    directory = tmp_path / "workspace"
+    directory.mkdir()
+    monkeypatch.chdir(directory)
+    return directory
+
+
+def test_fingerprints_are_recorded_after_a_successful_apply(
+    csv_files, terraform, run_directory, monkeypatch
+):
+    path = str(run_directory / ("terraform_script.tf" + applied.APPLIED_SUFFIX))
+
+    assert run(monkeypatch, terraform, "create", csv_files) == [
+        "init",
+        "plan",
+        "show",
+        "apply",
+    ]
+    assert "inputs" in applied.load(path)
+
+    # Nothing changed since the apply, terraform isn't run
+    assert run(monkeypatch, terraform, "update", csv_files) == []
+
+    # A state written by another run makes update render the script again
+    cache = run_directory / ("terraform_script.tf" + commands.CACHE_SUFFIX)
+    cache.unlink()
+    bump_serial(str(run_directory / state.STATE_FILE))
+    run(monkeypatch, terraform, "update", csv_files)
+    assert cache.is_file()
+
+
+def test_fingerprints_are_not_recorded_after_a_failed_create(
+    csv_files, terraform, run_directory, monkeypatch
+):
+    monkeypatch.setenv("FAKE_APPLY_FAILS", "1")
+    with pytest.raises(Exception, match="terraform apply failed"):
+        run(monkeypatch, terraform, "create", csv_files)
+
+    path = run_directory / ("terraform_script.tf" + applied.APPLIED_SUFFIX)
+    assert not path.exists()
+
+
+def test_failed_update_keeps_the_resources_of_the_last_apply(
+    csv_files, terraform, run_directory, monkeypatch
+):
+    path = str(run_directory / ("terraform_script.tf" + applied.APPLIED_SUFFIX))
+    run(monkeypatch, terraform, "create", csv_files)
+    recorded = applied.load(path)
+
+    with open(csv_files["node-config"]) as f:
+        nodes = f.read()
+    with open(csv_files["node-config"], "w") as f:
+        f.write(nodes.replace("Password1+", "Password1-"))
+    monkeypatch.setenv("FAKE_APPLY_FAILS", "1")
+    with pytest.raises(Exception, match="terraform apply failed"):
+        run(monkeypatch, terraform, "update", csv_files)
+    assert applied.load(path) == {"resources": recorded["resources"]}
+
+    # The next update plans the changed machine again, then records the fingerprints
+    monkeypatch.delenv("FAKE_APPLY_FAILS")
+    assert run(monkeypatch, terraform, "update", csv_files) == [
+        "plan",
+        "show",
+        "apply",
+    ]
+    assert "-target=maas_machine.node000001" in terraform.read_text()
+    assert applied.load(path)["inputs"] != recorded["inputs"]
+    assert run(monkeypatch, terraform, "update", csv_files) == []
@@ -0,0 +1,36 @@
+# Description: Tests of the render cache kept in memory across renders
+import pytest
+from src.cache import RenderCache
+
+
+# Render the given resources, each block being its own key
+def render(cache, keys):
+    return [cache.render(key, key, lambda key=key: [key]) for key in keys]
+
+
+def test_next_render_evicts_deleted_resources(tmp_path):
+    path = str(tmp_path / "main.tf.cache")
+    cache = RenderCache(path)
+    with cache.next_render():
+        render(cache, ["a", "b", "c"])
+    with cache.next_render():
+        render(cache, ["a", "c"])
+
+    assert set(cache.entries) == {"a", "c"}
+    cache.save()
+    assert set(RenderCache(path).entries) == {"a", "c"}
+
+
+def test_failed_render_keeps_previous_entries(tmp_path):
+    path = str(tmp_path / "main.tf.cache")
+    cache = RenderCache(path)
+    with cache.next_render():
+        render(cache, ["a", "b"])
+    with pytest.raises(ValueError):
+        with cache.next_render():
+            render(cache, ["a"])
+            raise ValueError("invalid csv row")
+
+    assert set(cache.entries) == {"a", "b"}
+    cache.save()
+    assert set(RenderCache(path).entries) == {"a", "b"}
@@ -0,0 +1,182 @@
+# Description: Tests of the drift scan against a stand-in MAAS API server
+import asyncio
+import copy
+from src import drift
+from tests.maas_stub import MaasStub
+
+API_KEY = "consumer:token:secret"
+NETWORK_CSV = """Network Plan,,,,,,,
+,CIDR,Gateway,MTU,Dynamic Range,Reserved Range,VLAN,Fabric
+PXE,10.0.0.0/24,10.0.0.1,1500,10.0.0.10-10.0.0.99,,0,fabric-1
+Rack 0,10.1.0.0/24,10.1.0.1,9000,,10.1.0.2-10.1.0.9,100,fabric-0
+"""
+NODES_CSV = """Resource Name,Power type,Power pass,Power address,pxe mac address,id path,nic name,mac address,partition schema
+node0,ipmi,pass,172.16.0.1,52:00:00:00:00:00,/dev/sda,"pxe,data","52:00:00:00:00:00,52:01:00:00:00:00",/
+"""
+NICS_CSV = """Resource Name,vlan id,tags,mode,Ip address,Default Gateway,Subnet Name
+pxe,0,None,DHCP,,false,PXE
+data,100,"data,rack",STATIC,10.1.0.10,true,Rack-0
+"""
+USERS_CSV = """Resource Name,name,Password,Email,is admin
+alice,alice,secret,alice@maas.local,true
+"""
+# The MAAS inventory the csv files above describe
+RESPONSES = {
+    "fabrics/": [{"id": 1, "name": "fabric-1"}, {"id": 2, "name": "fabric-0"}],
+    "fabrics/1/vlans/": [
+        {"vid": 0, "fabric": "fabric-1", "mtu": 1500, "space": "PXE-space"}
+    ],
+    "fabrics/2/vlans/": [
+        {"vid": 0, "fabric": "fabric-0", "mtu": 1500, "space": None},
+        {"vid": 100, "fabric": "fabric-0", "mtu": 9000, "space": "Rack-0-space"},
+    ],
+    "spaces/": [{"name": "PXE-space"}, {"name": "Rack-0-space"}],
+    "subnets/": [
+        {
+            "cidr": "10.0.0.0/24",
+            "gateway_ip": "10.0.0.1",
+            "vlan": {"vid": 0, "fabric": "fabric-1"},
+        },
+        {
+            "cidr": "10.1.0.0/24",
+            "gateway_ip": "10.1.0.1",
+            "vlan": {"vid": 100, "fabric": "fabric-0"},
+        },
+    ],
+    "ipranges/": [
+        {
+            "type": "dynamic",
+            "start_ip": "10.0.0.10",
+            "end_ip": "10.0.0.99",
+            "subnet": {"cidr": "10.0.0.0/24"},
+        },
+        {
+            "type": "reserved",
+            "start_ip": "10.1.0.2",
+            "end_ip": "10.1.0.9",
+            "subnet": {"cidr": "10.1.0.0/24"},
+        },
+    ],
+    "machines/": [
+        {
+            "system_id": "abc123",
+            "hostname": "node0",
+            "power_type": "ipmi",
+            "boot_interface": {"mac_address": "52:00:00:00:00:00"},
+        }
+    ],
+    "nodes/abc123/interfaces/": [
+        {
+            "name": "pxe",
+            "type": "physical",
+            "mac_address": "52:00:00:00:00:00",
+            "vlan": {"vid": 0},
+            "tags": [],
+            "links": [{"mode": "dhcp", "subnet": {"cidr": "10.0.0.0/24"}}],
+        },
+        {
+            "name": "data",
+            "type": "physical",
+            "mac_address": "52:01:00:00:00:00",
+            "vlan": {"vid": 100},
+            "tags": ["rack", "data"],
+            "links": [
+                {
+                    "mode": "static",
+                    "ip_address": "10.1.0.10",
+                    "subnet": {"cidr": "10.1.0.0/24"},
+                }
+            ],
+        },
+    ],
+    "users/": [
+        {"username": "alice", "email": "alice@maas.local", "is_superuser": True},
+        {"username": "MAAS", "email": "", "is_superuser": True},
+    ],
+}
+
+
+# Write the csv files to a directory and return their paths
+def csv_files(directory):
+    paths = {}
+    for name, content in (
+        ("network-config", NETWORK_CSV),
+        ("node-config", NODES_CSV),
+        ("nics-config", NICS_CSV),
+        ("user-config", USERS_CSV),
+    ):
+        path = directory / f"{name}.csv"
+        path.write_text(content)
+        paths[name] = str(path)
+    return paths
+
+
+def scan(paths, responses, busy=0):
+    with MaasStub(responses, busy) as maas:
+        differences, requests, _ = asyncio.run(
+            drift.scan(paths, maas.url, API_KEY, concurrency=4, rate=0)
+        )
+    assert all(header.startswith("OAuth ") for _, header in maas.requests)
+    return differences, requests, [path for path, _ in maas.requests]
+
+
+def test_no_drift(tmp_path):
+    differences, requests, paths = scan(csv_files(tmp_path), RESPONSES, busy=2)
+
+    assert differences == []
+    # Every endpoint is read once, plus the two busy answers retried
+    assert requests == len(RESPONSES) + 2
+    assert len(set(paths)) == len(RESPONSES)
+
+
+def test_csv_objects_missing_in_maas(tmp_path):
+    responses = copy.deepcopy(RESPONSES)
+    responses["machines/"] = []
+    responses["spaces/"].pop()
+    responses["users/"].pop(0)
+    responses["subnets/"][1]["gateway_ip"] = "10.1.0.254"
+
+    differences, _, _ = scan(csv_files(tmp_path), responses)
+
+    assert differences == [
+        "space Rack-0-space: missing in MAAS",
+        "subnet Rack-0 (10.1.0.0/24): gateway_ip is '10.1.0.254' in MAAS, "
+        "'10.1.0.1' in the csv",
+        "machine node0 (52:00:00:00:00:00): missing in MAAS",
+        "user alice: missing in MAAS",
+    ]
+
+
+def test_maas_objects_missing_in_csv(tmp_path):
+    responses = copy.deepcopy(RESPONSES)
+    responses["fabrics/"].append({"id": 3, "name": "fabric-lab"})
+    responses["fabrics/3/vlans/"] = [{"vid": 0, "fabric": "fabric-lab"}]
+    responses["fabrics/2/vlans/"].append({"vid": 200, "fabric": "fabric-0"})
+    responses["spaces/"].append({"name": "lab"})
+    responses["subnets/"].append({"cidr": "10.9.0.0/24"})
+    responses["machines/"].append(
+        {
+            "system_id": "def456",
+            "hostname": "spare",
+            "boot_interface": {"mac_address": "52:00:00:00:00:FF"},
+        }
+    )
+    responses["nodes/abc123/interfaces/"].append(
+        {"name": "eth9", "type": "physical", "mac_address": "52:02:00:00:00:00"}
+    )
+    responses["users/"].append({"username": "bob"})
+
+    differences, _, paths = scan(csv_files(tmp_path), responses)
+
+    assert differences == [
+        "space lab: not in the csv",
+        "fabric fabric-lab: not in the csv",
+        "vlan 200 on fabric fabric-0: not in the csv",
+        "subnet 10.9.0.0/24: not in the csv",
+        "machine node0 (52:00:00:00:00:00) interface eth9 (52:02:00:00:00:00): "
+        "not in the csv",
+        "machine spare (52:00:00:00:00:ff): not in the csv",
+        "user bob: not in the csv",
+    ]
+    # The interfaces of the undeclared machine are not read
+    assert "/MAAS/api/2.0/nodes/def456/interfaces/" not in paths
@@ -0,0 +1,79 @@
+# Description: Tests of the resource graph checking the references between resources
+import pytest
+from src import hcl
+from src.blocks import generate_terraform_resource
+from src.cache import RenderCache
+from src.graph import Reference
+from src.graph import Resource
+from src.graph import ResourceGraph
+from src.graph import render_blocks
+
+
+def vlan(name, fabric):
+    return hcl.Block(
+        "resource",
+        ["maas_vlan", name],
+        [("fabric", Reference("maas_fabric", fabric, "id")), ("vid", 100)],
+    )
+
+
+# Render blocks through the cache, as the layers do
+def render(graph, cache, key, blocks):
+    return graph.render(
+        cache, key, key, lambda: render_blocks(blocks, hcl.render_block, "\n")
+    )
+
+
+def test_cached_entries_keep_their_resources():
+    cache = RenderCache()
+    blocks = [
+        generate_terraform_resource("maas_fabric", "fabric-0", {"name": "fabric-0"}),
+        vlan("vlan-100", "fabric-0"),
+    ]
+    render(ResourceGraph(), cache, "network", blocks)
+
+    # The second render reuses the entry without generating its blocks
+    graph = ResourceGraph()
+    render(graph, cache, "network", [])
+
+    assert list(graph.resources.values()) == [
+        Resource("maas_fabric", "fabric-0", ()),
+        Resource("maas_vlan", "vlan-100", ("maas_fabric.fabric-0",)),
+    ]
+    graph.check()
+
+
+def test_check_lists_dangling_references_and_duplicates():
+    graph = ResourceGraph()
+    graph.add_external("maas_fabric.fabric-1")
+    graph.add_entry(render_blocks([vlan("vlan-100", "fabric-1")], str, "")[1])
+    graph.add_entry(render_blocks([vlan("vlan-200", "fabric-2")], str, "")[1])
+    graph.add_entry(render_blocks([vlan("vlan-200", "fabric-2")], str, "")[1])
+
+    with pytest.raises(Exception) as error:
+        graph.check()
+    assert str(error.value).splitlines() == [
+        "Invalid configuration:",
+        "maas_vlan.vlan-200 is defined 2 times",
+        "maas_vlan.vlan-200: maas_fabric.fabric-2 is referenced but not defined",
+    ]
+
+
+def test_output_blocks_list_resources_by_type():
+    graph = ResourceGraph()
+    graph.add(Resource("maas_fabric", "fabric-0", ()))
+    graph.add(Resource("maas_vlan", "vlan-100", ("maas_fabric.fabric-0",)))
+    graph.add(Resource("maas_vlan", "vlan-200", ("maas_fabric.fabric-0",)))
+
+    (output,) = graph.output_blocks(["maas_vlan"])
+
+    assert output.labels == ["maas_vlan"]
+    assert output.body == [
+        (
+            "value",
+            {
+                "vlan-100": hcl.Expression("maas_vlan.vlan-100"),
+                "vlan-200": hcl.Expression("maas_vlan.vlan-200"),
+            },
+        )
+    ]
@@ -0,0 +1,178 @@
+# Description: Tests of the streaming JSON reader and of the plan summaries
+import decimal
+import io
+import json
+import pytest
+from src import plans
+
+ITEMS = [
+    {
+        "address": "maas_machine.node0",
+        "type": "maas_machine",
+        "change": {
+            "actions": ["create"],
+            "after": {
+                "name": 'node "0" ]} [{',
+                "nested": {"list": [1, [2, {"key": None}]], "flag": True},
+            },
+        },
+    },
+    12345,
+    -1.5e3,
+    'a "quoted" string with ] and } and \\ inside',
+    True,
+    None,
+    [],
+    {},
+    {"unicode": "café ☃", "escaped": "\\\"\n\t"},
+]
+DOCUMENT = {
+    "format_version": "1.2",
+    # Values holding the key, or an array under the same key deeper in the document
+    "variables": {"name": {"value": "resource_changes"}},
+    "planned_values": {"root_module": {"resources": [{"resource_changes": [1, 2]}]}},
+    "note": 'a "resource_changes": [ string ] } {',
+    "resource_changes": ITEMS,
+    "prior_state": {"values": [1, {"a": "]"}], "serial": 12345678},
+}
+
+
+# Split a text in chunks of the given size
+def chunked(text, size):
+    return [text[start : start + size] for start in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_iter_array_items_matches_json_loads(size, indent):
+    text = json.dumps(DOCUMENT, indent=indent)
+
+    items = list(plans.iter_array_items(chunked(text, size), "resource_changes"))
+
+    assert items == json.loads(text)["resource_changes"]
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+@pytest.mark.parametrize(
+    "text",
+    [
+        '{"resource_changes": []}',
+        '{"resource_changes":[ ]}',
+        '{"format_version": "1.2"}',
+        "{}",
+    ],
+)
+def test_iter_array_items_without_items(size, text):
+    assert list(plans.iter_array_items(chunked(text, size), "resource_changes")) == []
+
+
+@pytest.mark.parametrize("size", [1, 7])
+def test_iter_array_items_raises_on_truncated_document(size):
+    text = json.dumps(DOCUMENT)
+    text = text[: text.index("prior_state") - 40]
+
+    with pytest.raises(ValueError):
+        list(plans.iter_array_items(chunked(text, size), "resource_changes"))
+
+
+def test_iter_chunks_reads_the_whole_stream():
+    text = json.dumps(DOCUMENT) * 10
+    chunks = list(plans.iter_chunks(io.StringIO(text)))
+    assert "".join(chunks) == text
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+def test_iter_array_items_matches_ijson(size):
+    ijson = pytest.importorskip("ijson")
+    text = json.dumps(DOCUMENT)
+
+    expected = list(ijson.items(io.BytesIO(text.encode()), "resource_changes.item"))
+    # ijson reads the non integer numbers as decimals
+    items = [
+        json.loads(json.dumps(item), parse_float=decimal.Decimal)
+        for item in plans.iter_array_items(chunked(text, size), "resource_changes")
+    ]
+
+    assert items == expected
+
+
+@pytest.mark.parametrize(
+    "actions, action",
+    [
+        (["create"], "create"),
+        (["update"], "update"),
+        (["delete"], "delete"),
+        (["delete", "create"], "replace"),
+        (["create", "delete"], "replace"),
+        (["no-op"], "no-op"),
+        (["read"], "read"),
+        ([], "no-op"),
+    ],
+)
+def test_change_action(actions, action):
+    assert plans.change_action(actions) == action
+
+
+def change(resource_type, *actions):
+    return {"type": resource_type, "change": {"actions": list(actions)}}
+
+
+def test_summarize_counts_by_action_and_type():
+    summary = plans.summarize(
+        [
+            change("maas_machine", "create"),
+            change("maas_machine", "create"),
+            change("maas_machine", "delete", "create"),
+            change("maas_vlan", "update"),
+            change("maas_vlan", "no-op"),
+            change("maas_subnet", "delete"),
+            change("maas_fabric", "no-op"),
+        ]
+    )
+
+    assert summary == {
+        "changes": True,
+        "total": {
+            "create": 2,
+            "update": 1,
+            "replace": 1,
+            "delete": 1,
+            "read": 0,
+            "no-op": 2,
+        },
+        "resource_types": {
+            "maas_fabric": {"no-op": 1},
+            "maas_machine": {"create": 2, "replace": 1},
+            "maas_subnet": {"delete": 1},
+            "maas_vlan": {"update": 1, "no-op": 1},
+        },
+    }
+
+
+def test_summarize_without_changes():
+    summary = plans.summarize([change("maas_vlan", "no-op")])
+
+    assert not summary["changes"]
+    output = io.StringIO()
+    plans.print_summary(summary, output)
+    assert output.getvalue() == "Plan summary:\n  Total: no changes\n"
+
+
+def test_print_summary_lists_the_changed_types():
+    output = io.StringIO()
+    plans.print_summary(
+        plans.summarize(
+            [
+                change("maas_machine", "create"),
+                change("maas_machine", "delete", "create"),
+                change("maas_vlan", "no-op"),
+            ]
+        ),
+        output,
+    )
+
+    assert output.getvalue() == (
+        "Plan summary:\n"
+        "  maas_machine: 1 to create, 1 to replace\n"
+        "  Total: 1 to create, 1 to replace\n"
+    )
@@ -0,0 +1,276 @@
+# Description: Tests of the apply monitor following the JSON UI stream of terraform
+import io
+import json
+import sys
+import pytest
+from src import progress
+
+
+def resource(address, action="create"):
+    resource_type, _, name = address.partition(".")
+    return {
+        "resource": {
+            "addr": address,
+            "module": "",
+            "resource": address,
+            "implied_provider": "maas",
+            "resource_type": resource_type,
+            "resource_name": name,
+            "resource_key": None,
+        },
+        "action": action,
+    }
+
+
+def message(kind, address, **hook):
+    return {
+        "@level": "info",
+        "@module": "terraform.ui",
+        "hook": {**resource(address), **hook},
+        "type": kind,
+    }
+
+
+# Time of each message of the log, in seconds from the start of the monitor
+LOG = [
+    (0.0, {"@level": "info", "terraform": "1.6.0", "type": "version", "ui": "1.2"}),
+    (1.0, message("apply_start", "maas_fabric.fabric-0")),
+    (1.0, message("apply_start", "maas_machine.node0")),
+    (1.2, message("apply_complete", "maas_fabric.fabric-0", id_value="1")),
+    (1.5, message("apply_start", "maas_machine.node1")),
+    (4.0, message("apply_complete", "maas_machine.node0", id_value="abc")),
+    (
+        41.5,
+        {
+            "@level": "error",
+            "diagnostic": {
+                "severity": "error",
+                "summary": "context deadline exceeded",
+                "address": "maas_machine.node1",
+            },
+            "type": "diagnostic",
+        },
+    ),
+    (41.5, message("apply_errored", "maas_machine.node1")),
+    (42.0, message("apply_start", "maas_machine.node2")),
+    (
+        42.0,
+        {
+            "@level": "warn",
+            "diagnostic": {"severity": "warning", "summary": "deprecated"},
+            "type": "diagnostic",
+        },
+    ),
+    (42.0, {"changes": {"add": 2, "remove": 0}, "type": "change_summary"}),
+]
+FINISH = 50.0
+
+METRICS = """\
+# HELP terramaas_resource_apply_seconds Time terraform took to apply a resource.
+# TYPE terramaas_resource_apply_seconds histogram
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="0.5"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="1"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="2.5"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="5"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="10"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="30"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="60"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="120"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="300"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="600"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_fabric",le="+Inf"} 1
+terramaas_resource_apply_seconds_sum{resource_type="maas_fabric"} 0.2
+terramaas_resource_apply_seconds_count{resource_type="maas_fabric"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="0.5"} 0
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="1"} 0
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="2.5"} 0
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="5"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="10"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="30"} 1
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="60"} 2
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="120"} 2
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="300"} 2
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="600"} 2
+terramaas_resource_apply_seconds_bucket{resource_type="maas_machine",le="+Inf"} 2
+terramaas_resource_apply_seconds_sum{resource_type="maas_machine"} 43.0
+terramaas_resource_apply_seconds_count{resource_type="maas_machine"} 2
+# HELP terramaas_resources Resources applied by terraform, by status.
+# TYPE terramaas_resources gauge
+terramaas_resources{resource_type="maas_fabric",status="done"} 1
+terramaas_resources{resource_type="maas_fabric",status="running"} 0
+terramaas_resources{resource_type="maas_fabric",status="failed"} 0
+terramaas_resources{resource_type="maas_machine",status="done"} 1
+terramaas_resources{resource_type="maas_machine",status="running"} 1
+terramaas_resources{resource_type="maas_machine",status="failed"} 1
+# HELP terramaas_apply_seconds Duration of the terraform run.
+# TYPE terramaas_apply_seconds gauge
+terramaas_apply_seconds 50.000
+"""
+
+
+class Clock:
+    """
+    Stands in for time.time, at the given number of seconds from the start.
+    """
+
+    START = 1_700_000_000.0
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def __call__(self):
+        return self.START + self.seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(progress.time, "time", clock)
+    return clock
+
+
+def test_monitor_writes_the_metrics_and_the_report(clock, tmp_path):
+    output = io.StringIO()
+    metrics_file = str(tmp_path / "terramaas.prom")
+    report_file = str(tmp_path / "report.json")
+    monitor = progress.ApplyMonitor(True, metrics_file, report_file, output)
+
+    for seconds, line in LOG:
+        clock.seconds = seconds
+        monitor.handle(line)
+    clock.seconds = FINISH
+    monitor.finish()
+
+    # Only the errors are printed, then the final counts
+    assert output.getvalue().splitlines() == [
+        "Error: context deadline exceeded: maas_machine.node1",
+        "maas_fabric 1 done | maas_machine 1 done, 1 running, 1 failed | 50s",
+    ]
+    with open(metrics_file) as f:
+        assert f.read() == METRICS
+    assert not (tmp_path / "terramaas.prom.tmp").exists()
+
+    with open(report_file) as f:
+        report = json.load(f)
+    assert report["seconds"] == FINISH
+    assert report["resource_types"] == {
+        "maas_fabric": {
+            "done": 1,
+            "failed": 0,
+            "latency": {
+                "count": 1,
+                "sum": 0.2,
+                "min": 0.2,
+                "p50": 0.2,
+                "p90": 0.2,
+                "p99": 0.2,
+                "max": 0.2,
+                "buckets": {str(bound): 1 for bound in progress.LATENCY_BUCKETS},
+            },
+        },
+        "maas_machine": {
+            "done": 1,
+            "failed": 1,
+            "latency": {
+                "count": 2,
+                "sum": 43.0,
+                "min": 3.0,
+                "p50": 40.0,
+                "p90": 40.0,
+                "p99": 40.0,
+                "max": 40.0,
+                "buckets": {
+                    "0.5": 0,
+                    "1": 0,
+                    "2.5": 0,
+                    "5": 1,
+                    "10": 1,
+                    "30": 1,
+                    "60": 2,
+                    "120": 2,
+                    "300": 2,
+                    "600": 2,
+                },
+            },
+        },
+    }
+    # The resources still running are left out
+    assert report["resources"] == [
+        {
+            "address": "maas_fabric.fabric-0",
+            "type": "maas_fabric",
+            "action": "create",
+            "status": "done",
+            "start": 1.0,
+            "finish": 1.2,
+            "seconds": 0.2,
+        },
+        {
+            "address": "maas_machine.node0",
+            "type": "maas_machine",
+            "action": "create",
+            "status": "done",
+            "start": 1.0,
+            "finish": 4.0,
+            "seconds": 3.0,
+        },
+        {
+            "address": "maas_machine.node1",
+            "type": "maas_machine",
+            "action": "create",
+            "status": "failed",
+            "start": 1.5,
+            "finish": 41.5,
+            "seconds": 40.0,
+        },
+    ]
+
+
+def test_monitor_follows_the_output_of_terraform(tmp_path):
+    log_file = tmp_path / "apply.log"
+    log_file.write_text(
+        "Terraform will perform the following actions:\n"
+        + "".join(json.dumps(line) + "\n" for _, line in LOG)
+        + "not json either\n"
+    )
+    # Writes the log as terraform apply -json would, then fails
+    command = [
+        sys.executable,
+        "-c",
+        "import sys; sys.stdout.write(open(sys.argv[1]).read()); sys.exit(1)",
+        str(log_file),
+    ]
+    output = io.StringIO()
+    log = io.StringIO()
+    metrics_file = str(tmp_path / "terramaas.prom")
+    monitor = progress.ApplyMonitor(False, metrics_file, output=output)
+
+    assert monitor.run(command, str(tmp_path), log) == 1
+    monitor.finish()
+
+    assert log.getvalue() == (
+        "Terraform will perform the following actions:\nnot json either\n"
+    )
+    assert output.getvalue() == "Error: context deadline exceeded: maas_machine.node1\n"
+    assert monitor.counts() == {"maas_fabric": [1, 0, 0], "maas_machine": [1, 1, 1]}
+    with open(metrics_file) as f:
+        metrics = f.read().splitlines()
+    assert (
+        'terramaas_resources{resource_type="maas_machine",status="failed"} 1'
+        in metrics
+    )
+    assert (
+        'terramaas_resource_apply_seconds_count{resource_type="maas_machine"} 2'
+        in metrics
+    )
+
+
+def test_monitor_without_resources_writes_empty_metrics(tmp_path):
+    report_file = tmp_path / "report.json"
+    monitor = progress.ApplyMonitor(True, report_file=str(report_file))
+
+    monitor.finish()
+
+    report = json.loads(report_file.read_text())
+    assert report["resource_types"] == {}
+    assert report["resources"] == []
@@ -0,0 +1,204 @@
+# Description: Tests of the network, machine and user shards of a synthetic inventory
+import json
+import re
+import pytest
+from benchmarks import inventory
+from src import shards
+from src import tfjson
+
+# Three racks of 40, 40 and 20 machines, each rack with its own vlan
+MACHINES = 100
+# A reference to a network resource that isn't read from the network shard state
+LOCAL_NETWORK_REFERENCE = re.compile(r"(?<![\w.])maas_(?:vlan|subnet)\.")
+
+
+@pytest.fixture(scope="module")
+def csv_files(tmp_path_factory):
+    return inventory.generate_inventory(
+        str(tmp_path_factory.mktemp("inventory")), MACHINES
+    )
+
+
+# Number of machines of each shard
+def shard_sizes(machine_names):
+    return {name: len(machines) for name, machines in machine_names.items()}
+
+
+@pytest.mark.parametrize("output_format", [shards.hcl, tfjson])
+def test_machine_shards_read_the_network_from_its_state(csv_files, output_format):
+    documents, machine_names = shards.render_shards(
+        "key", "http://maas:5240/MAAS", csv_files, output_format=output_format
+    )
+
+    assert list(documents) == [shards.NETWORK_SHARD, "machines", shards.USERS_SHARD]
+    assert shard_sizes(machine_names) == {
+        shards.NETWORK_SHARD: 0,
+        "machines": MACHINES,
+        shards.USERS_SHARD: 0,
+    }
+    machines = documents["machines"]
+    assert "terraform_remote_state" in machines
+    assert shards.REMOTE_PREFIX + "maas_subnet.Rack-0.id" in machines
+    assert shards.REMOTE_PREFIX + "maas_vlan.vlan-0.vid" in machines
+    assert not LOCAL_NETWORK_REFERENCE.search(machines)
+    # The machine resources reference each other directly
+    assert "maas_machine.node000000.id" in machines
+    # The network shard outputs the whole vlans and subnets the machines read
+    network = documents[shards.NETWORK_SHARD]
+    assert "terraform_remote_state" not in network
+    for address in ["maas_vlan.vlan-0", "maas_vlan.vlan-102", "maas_subnet.Rack-2"]:
+        assert re.search(rf"{address}(?![\w.-])", network)
+
+
+@pytest.mark.parametrize(
+    "shard_by, shard_size, sizes",
+    [
+        (
+            shards.VLAN_KEY,
+            None,
+            {
+                "machines-vlan-0-100": 40,
+                "machines-vlan-0-101": 40,
+                "machines-vlan-0-102": 20,
+            },
+        ),
+        (
+            None,
+            30,
+            {"machines-1": 30, "machines-2": 30, "machines-3": 30, "machines-4": 10},
+        ),
+        (
+            shards.VLAN_KEY,
+            30,
+            {
+                "machines-vlan-0-100-1": 30,
+                "machines-vlan-0-100-2": 10,
+                "machines-vlan-0-101-1": 30,
+                "machines-vlan-0-101-2": 10,
+                "machines-vlan-0-102-1": 20,
+            },
+        ),
+        (shards.POWER_SUBNET_KEY, None, {"machines-172-16-0-0-24": 100}),
+        # A column of the node csv
+        ("Power type", None, {"machines-ipmi": 100}),
+    ],
+)
+def test_shard_names(csv_files, shard_by, shard_size, sizes):
+    documents, machine_names = shards.render_shards(
+        "key", "http://maas:5240/MAAS", csv_files, shard_by, shard_size
+    )
+
+    assert shard_sizes(machine_names) == {
+        shards.NETWORK_SHARD: 0,
+        **sizes,
+        shards.USERS_SHARD: 0,
+    }
+    assert list(documents) == list(machine_names)
+    # Every machine is in exactly one shard, in csv order
+    machines = [name for names in machine_names.values() for name in names]
+    assert machines == [f"node{machine:06d}" for machine in range(MACHINES)]
+
+
+def test_unknown_shard_column(csv_files):
+    with pytest.raises(Exception, match="Column rack not found"):
+        shards.render_shards("key", "http://maas:5240/MAAS", csv_files, "rack")
+
+
+def test_kept_shards_without_machines_are_rendered_empty(csv_files):
+    documents, machine_names = shards.render_shards(
+        "key", "http://maas:5240/MAAS", csv_files, keep=["machines-old"]
+    )
+
+    assert machine_names["machines-old"] == []
+    assert "maas_machine" not in documents["machines-old"]
+
+
+@pytest.mark.parametrize(
+    "names, groups",
+    [
+        (
+            ["machines-1", shards.USERS_SHARD, shards.NETWORK_SHARD, "machines-2"],
+            [
+                [shards.NETWORK_SHARD],
+                ["machines-1", shards.USERS_SHARD, "machines-2"],
+            ],
+        ),
+        ([shards.NETWORK_SHARD], [[shards.NETWORK_SHARD]]),
+        (["machines-1", shards.USERS_SHARD], [["machines-1", shards.USERS_SHARD]]),
+        ([], []),
+    ],
+)
+def test_stages_run_the_network_shard_first(names, groups):
+    assert shards.stages(names) == groups
+
+
+def test_moved_machines():
+    manifest = {
+        "shards": {
+            shards.NETWORK_SHARD: [],
+            "machines-1": ["node0", "node1"],
+            "machines-2": ["node2"],
+        }
+    }
+
+    moved = shards.moved_machines(
+        manifest,
+        {
+            shards.NETWORK_SHARD: [],
+            "machines-1": ["node0"],
+            "machines-2": ["node1", "node2", "node3"],
+        },
+    )
+
+    assert moved == [("node1", "machines-1", "machines-2")]
+
+
+def test_manifest_round_trip(tmp_path):
+    root = str(tmp_path)
+    assert shards.load_manifest(root) is None
+
+    machine_names = {shards.NETWORK_SHARD: [], "machines": ["node0", "node1"]}
+    shards.save_manifest(root, tfjson, machine_names)
+
+    assert shards.load_manifest(root) == {
+        "version": shards.MANIFEST_VERSION,
+        "extension": tfjson.EXTENSION,
+        "shards": machine_names,
+    }
+    assert sorted(path.name for path in tmp_path.iterdir()) == [shards.MANIFEST_FILE]
+
+
+def test_resharding_moves_the_machines_of_a_saved_manifest(csv_files, tmp_path):
+    root = str(tmp_path)
+    _, machine_names = shards.render_shards(
+        "key", "http://maas:5240/MAAS", csv_files, shard_by=shards.VLAN_KEY
+    )
+    shards.save_manifest(root, shards.hcl, machine_names)
+    manifest = shards.load_manifest(root)
+
+    _, same = shards.render_shards(
+        "key", "http://maas:5240/MAAS", csv_files, shard_by=shards.VLAN_KEY
+    )
+    _, resized = shards.render_shards(
+        "key", "http://maas:5240/MAAS", csv_files, shard_size=50
+    )
+
+    assert shards.moved_machines(manifest, same) == []
+    moved = shards.moved_machines(manifest, resized)
+    assert len(moved) == MACHINES
+    assert moved[0] == ("node000000", "machines-vlan-0-100", "machines-1")
+    assert moved[-1] == ("node000099", "machines-vlan-0-102", "machines-2")
+
+
+@pytest.mark.parametrize(
+    "content, message",
+    [
+        ("{not json", "Error reading"),
+        (json.dumps({"version": 0, "shards": {}}), "Unsupported shards manifest"),
+    ],
+)
+def test_invalid_manifest(tmp_path, content, message):
+    (tmp_path / shards.MANIFEST_FILE).write_text(content)
+
+    with pytest.raises(Exception, match=message):
+        shards.load_manifest(str(tmp_path))
@@ -0,0 +1,172 @@
+# Description: Tests of the offline comparison of the rendered resources with a state
+import json
+import pytest
+from src import state
+
+FABRIC = "maas_fabric.fabric-0"
+VLAN = "maas_vlan.vlan-100"
+MACHINE = "maas_machine.node0"
+
+
+# State resources as iter_state_resources yields them
+def state_resources(resources):
+    return iter(list(resources.items()))
+
+
+@pytest.mark.parametrize(
+    "value, resolved",
+    [
+        ("${maas_fabric.fabric-0.id}", "7"),
+        ("${maas_fabric.fabric-1.id}", state.UNKNOWN),
+        ({"fabric": "${maas_fabric.fabric-0.id}"}, {"fabric": "7"}),
+        (["${maas_fabric.fabric-0.name}", 100], ["fabric-0", 100]),
+        # Only a value made of a single reference is resolved
+        ("id ${maas_fabric.fabric-0.id}", "id ${maas_fabric.fabric-0.id}"),
+        (100, 100),
+    ],
+)
+def test_resolve(value, resolved):
+    current = {FABRIC: {"id": "7", "name": "fabric-0"}}
+    assert state.resolve(value, current) == resolved
+
+
+def test_diff_state_lists_added_changed_and_removed_resources():
+    desired = {
+        FABRIC: {"name": "fabric-0"},
+        VLAN: {"fabric": "${maas_fabric.fabric-0.id}", "vid": 100, "mtu": 9000},
+        "maas_vlan.vlan-200": {"fabric": "${maas_fabric.fabric-0.id}", "vid": 200},
+    }
+    references = {(FABRIC, "id")}
+    current = {
+        FABRIC: {"id": "7", "name": "fabric-0", "computed": "ignored"},
+        VLAN: {"id": "9", "fabric": "7", "vid": 100, "mtu": 1500},
+        "maas_vlan.vlan-300": {"id": "11", "fabric": "7", "vid": 300},
+    }
+
+    changes = state.diff_state(desired, references, state_resources(current))
+
+    assert changes == [
+        ("~", VLAN, [("mtu", 1500, 9000)]),
+        ("+", "maas_vlan.vlan-200", []),
+        ("-", "maas_vlan.vlan-300", []),
+    ]
+
+
+def test_diff_state_matches_the_state_forms_of_the_values():
+    desired = {
+        MACHINE: {
+            "power_type": "ipmi",
+            "pxe_mac_address": "52:00:00:00:00:00",
+            "zone": "",
+            "tags": ["b", "a"],
+            "power_parameters": {"power_address": "172.16.0.1"},
+        },
+        "maas_block_device.node0-sda": {"size_gigabytes": 100},
+    }
+    current = {
+        MACHINE: {
+            "power_type": "ipmi",
+            "pxe_mac_address": "52:00:00:00:00:00",
+            "zone": None,
+            "tags": ["a", "b"],
+            # A single nested block is a list of one object in the state
+            "power_parameters": [
+                {"power_address": "172.16.0.1", "power_user": "computed"}
+            ],
+        },
+        "maas_block_device.node0-sda": {"size_gigabytes": "100"},
+    }
+
+    assert state.diff_state(desired, set(), state_resources(current)) == []
+
+
+def test_diff_state_shows_references_to_missing_resources_as_unknown():
+    desired = {
+        VLAN: {"fabric": "${maas_fabric.fabric-0.id}", "vid": 100},
+        FABRIC: {"name": "fabric-0"},
+    }
+    current = {VLAN: {"fabric": "7", "vid": 100}}
+
+    changes = state.diff_state(desired, {(FABRIC, "id")}, state_resources(current))
+
+    assert changes == [
+        ("~", VLAN, [("fabric", "7", state.UNKNOWN)]),
+        ("+", FABRIC, []),
+    ]
+    assert state.format_diff(changes).splitlines() == [
+        f"~ {VLAN}",
+        '    fabric: "7" -> (known after apply)',
+        f"+ {FABRIC}",
+        "Diff: 1 to add, 1 to change, 0 to destroy.",
+    ]
+
+
+def test_format_diff_hides_sensitive_values():
+    changes = [
+        (
+            "~",
+            MACHINE,
+            [
+                ("power_parameters", {"power_pass": "old"}, {"power_pass": "new"}),
+                ("hostname", "node0", "node-0"),
+            ],
+        ),
+        ("~", "maas_user.admin", [("password", "old", "new")]),
+        ("-", "maas_machine.node1", []),
+    ]
+
+    text = state.format_diff(changes)
+
+    assert text.splitlines() == [
+        f"~ {MACHINE}",
+        "    power_parameters: (sensitive value) -> (sensitive value)",
+        '    hostname: "node0" -> "node-0"',
+        "~ maas_user.admin",
+        "    password: (sensitive value) -> (sensitive value)",
+        "- maas_machine.node1",
+        "Diff: 0 to add, 2 to change, 1 to destroy.",
+    ]
+    assert "old" not in text and "new" not in text
+
+
+def test_iter_state_resources_reads_the_managed_instances(tmp_path):
+    path = tmp_path / state.STATE_FILE
+    path.write_text(
+        json.dumps(
+            {
+                "version": 4,
+                "serial": 3,
+                "lineage": "lineage-0",
+                "resources": [
+                    {
+                        "mode": "managed",
+                        "type": "maas_fabric",
+                        "name": "fabric-0",
+                        "instances": [{"attributes": {"id": "7"}}],
+                    },
+                    {
+                        "mode": "data",
+                        "type": "maas_fabric",
+                        "name": "default",
+                        "instances": [{"attributes": {"id": "0"}}],
+                    },
+                    {
+                        "mode": "managed",
+                        "type": "maas_vlan",
+                        "name": "vlan",
+                        "instances": [
+                            {"index_key": 0, "attributes": {"vid": 100}},
+                            {"index_key": "b", "attributes": {"vid": 200}},
+                        ],
+                    },
+                ],
+            }
+        )
+    )
+
+    assert list(state.iter_state_resources(str(path))) == [
+        (FABRIC, {"id": "7"}),
+        ("maas_vlan.vlan[0]", {"vid": 100}),
+        ('maas_vlan.vlan["b"]', {"vid": 200}),
+    ]
+    assert state.state_version(str(path)) == [3, "lineage-0"]
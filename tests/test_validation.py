@@ -0,0 +1,316 @@
+# Description: Tests of the validation of the network and nics configurations
+import pytest
+from src import dataExtractionFunctions as extract
+from src import validation
+
+NETWORK_FILE = "/inventory/network.csv"
+NICS_FILE = "/inventory/nics.csv"
+
+
+# Subnet as the network table extracts it, ranges written as "start-end"
+def subnet(name, cidr, gateway="", ranges=(), row=3):
+    return {
+        "subnet_name": name,
+        "attributes": {"cidr": cidr, "gateway_ip": gateway},
+        "ip_ranges": [
+            extract.extract_ip_range(ip_range, ip_range_type)
+            for ip_range_type, ip_range in ranges
+        ],
+        "row": row,
+    }
+
+
+def nic(name, subnet_name, ip_address="", mode="STATIC", row=2):
+    return extract.NicRecord(
+        [name, "100", "", mode, ip_address, "false", subnet_name], row
+    )
+
+
+def machine(name, nic_names):
+    return extract.NodeRecord(
+        [name, "ipmi", "", "", "", "/dev/sda", nic_names, "", ""], 2
+    )
+
+
+@pytest.mark.parametrize(
+    "intervals, overlaps",
+    [
+        ([], []),
+        ([(4, 0, 9, "a"), (4, 10, 19, "b")], []),
+        ([(4, 0, 10, "a"), (4, 10, 19, "b")], [("b", "a")]),
+        # An interval inside a long one is found after a shorter one
+        (
+            [(4, 0, 100, "a"), (4, 5, 6, "b"), (4, 50, 60, "c")],
+            [("b", "a"), ("c", "a")],
+        ),
+        # The same integers in different ip versions don't overlap
+        ([(4, 0, 10, "a"), (6, 5, 15, "b")], []),
+        ([(6, 0, 2**64, "a"), (6, 2**63, 2**63, "b")], [("b", "a")]),
+    ],
+)
+def test_find_overlaps(intervals, overlaps):
+    assert validation.find_overlaps(intervals) == overlaps
+
+
+@pytest.mark.parametrize(
+    "subnets, messages",
+    [
+        ([subnet("Rack-0", "10.128.0.0/24", "10.128.0.1")], []),
+        (
+            [subnet("Rack-0", "10.128.0.0/33")],
+            ["network.csv:3: subnet Rack-0 has an invalid CIDR: '10.128.0.0/33'"],
+        ),
+        (
+            [subnet("Rack-0", "10.128.0.0/24", "10.128.0.300")],
+            ["network.csv:3: subnet Rack-0 has an invalid gateway: '10.128.0.300'"],
+        ),
+        (
+            [subnet("Rack-0", "10.128.0.0/24", "10.129.0.1")],
+            [
+                "network.csv:3: subnet Rack-0 gateway 10.129.0.1 is outside "
+                "10.128.0.0/24"
+            ],
+        ),
+        (
+            [subnet("Rack-0", "10.128.0.0/24", ranges=[("dynamic", "10.128.0.2")])],
+            ["network.csv:3: subnet Rack-0 has an ip range not written as start-end"],
+        ),
+        (
+            [subnet("Rack-0", "10.128.0.0/24", ranges=[("dynamic", "10.128.0.x-1")])],
+            [
+                "network.csv:3: subnet Rack-0 has an invalid "
+                "dynamic range 10.128.0.x-1"
+            ],
+        ),
+        (
+            [
+                subnet(
+                    "Rack-0",
+                    "10.128.0.0/24",
+                    ranges=[("reserved", "10.0.0.9-10.0.0.2")],
+                )
+            ],
+            [
+                "network.csv:3: subnet Rack-0 reserved range "
+                "10.0.0.9-10.0.0.2 ends before it starts"
+            ],
+        ),
+        (
+            [
+                subnet(
+                    "Rack-0", "10.128.0.0/24", ranges=[("dynamic", "10.1.0.2-10.1.0.9")]
+                )
+            ],
+            [
+                "network.csv:3: subnet Rack-0 dynamic range "
+                "10.1.0.2-10.1.0.9 is outside 10.128.0.0/24"
+            ],
+        ),
+        (
+            [
+                subnet(
+                    "Rack-0",
+                    "10.128.0.0/24",
+                    ranges=[
+                        ("dynamic", "10.128.0.2-10.128.0.20"),
+                        ("reserved", "10.128.0.20-10.128.0.30"),
+                    ],
+                )
+            ],
+            [
+                "network.csv:3: subnet Rack-0 reserved range 10.128.0.20-10.128.0.30 "
+                "overlaps dynamic range 10.128.0.2-10.128.0.20"
+            ],
+        ),
+        (
+            [
+                subnet("Rack-0", "10.128.0.0/16", row=3),
+                subnet("Rack-1", "10.128.4.0/24", row=4),
+            ],
+            [
+                "network.csv:4: subnet Rack-1 10.128.4.0/24 overlaps "
+                "subnet Rack-0 10.128.0.0/16 on row 3"
+            ],
+        ),
+        (
+            [
+                subnet("V6-0", "fd00::/48", "fd00::1", row=3),
+                subnet("V6-1", "fd00:0:0:1::/64", "fd00::1:0:0:0:1", row=4),
+            ],
+            [
+                "network.csv:4: subnet V6-1 fd00:0:0:1::/64 overlaps "
+                "subnet V6-0 fd00::/48 on row 3"
+            ],
+        ),
+        (
+            [subnet("V6-0", "fd00::/64", "10.0.0.1")],
+            ["network.csv:3: subnet V6-0 gateway 10.0.0.1 is outside fd00::/64"],
+        ),
+        (
+            [subnet("V6-0", "fd00::/64", ranges=[("dynamic", "fd00::10-fd01::1")])],
+            [
+                "network.csv:3: subnet V6-0 dynamic range "
+                "fd00::10-fd01::1 is outside fd00::/64"
+            ],
+        ),
+        # An ipv4 and an ipv6 subnet covering the same integers don't overlap
+        ([subnet("Rack-0", "0.0.0.0/8", row=3), subnet("V6-0", "::/104", row=4)], []),
+    ],
+)
+def test_validate_subnets(subnets, messages):
+    errors = validation.validate_subnets(NETWORK_FILE, subnets)
+    assert [str(error) for error in errors] == messages
+
+
+SUBNETS = [
+    subnet(
+        "Rack-0",
+        "10.128.0.0/24",
+        ranges=[("dynamic", "10.128.0.2-10.128.0.20")],
+    ),
+    subnet("V6-0", "fd00::/64", ranges=[("dynamic", "fd00::2-fd00::ff")]),
+]
+
+
+@pytest.mark.parametrize(
+    "subnets, machines, nics, messages",
+    [
+        (SUBNETS, [], [nic("data", "Rack-0", "10.128.0.100")], []),
+        (SUBNETS, [], [nic("data", "Rack-0", mode="DHCP")], []),
+        (
+            SUBNETS,
+            [],
+            [nic("data", "Rack-9", "10.128.0.100")],
+            ["nics.csv:2: nic data references unknown subnet 'Rack-9'"],
+        ),
+        (
+            SUBNETS,
+            [],
+            [nic("data", "Rack-0", "10.128.0.256")],
+            ["nics.csv:2: nic data has an invalid ip address: '10.128.0.256'"],
+        ),
+        (
+            SUBNETS,
+            [],
+            [nic("data", "Rack-0", "10.129.0.100")],
+            ["nics.csv:2: nic data ip address 10.129.0.100 is outside subnet Rack-0"],
+        ),
+        (
+            SUBNETS,
+            [],
+            [nic("data", "Rack-0", "10.128.0.10")],
+            [
+                "nics.csv:2: nic data ip address 10.128.0.10 is inside the "
+                "dynamic range of subnet Rack-0"
+            ],
+        ),
+        (
+            SUBNETS,
+            [],
+            [nic("data", "V6-0", "fd00::10")],
+            [
+                "nics.csv:2: nic data ip address fd00::10 is inside the "
+                "dynamic range of subnet V6-0"
+            ],
+        ),
+        (
+            SUBNETS,
+            [],
+            [nic("data", "V6-0", "10.128.0.100")],
+            ["nics.csv:2: nic data ip address 10.128.0.100 is outside subnet V6-0"],
+        ),
+        (
+            SUBNETS,
+            [],
+            [
+                nic("data-a", "Rack-0", "10.128.0.100", row=2),
+                nic("data-b", "Rack-0", "10.128.0.100", row=3),
+            ],
+            [
+                "nics.csv:3: ip address 10.128.0.100 of nic data-b is also used "
+                "by nic data-a on row 2"
+            ],
+        ),
+        (
+            SUBNETS,
+            [],
+            [
+                nic("data-a", "V6-0", "fd00::1:1", row=2),
+                nic("data-b", "V6-0", "FD00::1:1", row=3),
+            ],
+            [
+                "nics.csv:3: ip address FD00::1:1 of nic data-b is also used "
+                "by nic data-a on row 2"
+            ],
+        ),
+        # A static address on a nic row shared by two machines is used twice
+        (
+            SUBNETS,
+            [machine("node0", "data"), machine("node1", "data")],
+            [nic("data", "Rack-0", "10.128.0.100")],
+            [
+                "nics.csv:2: ip address 10.128.0.100 of nic data on machine node1 "
+                "is also used by nic data on machine node0 on row 2"
+            ],
+        ),
+        # The nics of a subnet with an invalid cidr aren't reported as unknown
+        (
+            [subnet("Rack-0", "10.128.0.0/33")],
+            [],
+            [
+                nic("data", "Rack-0", "10.129.0.100"),
+                nic("pxe", "Rack-0", mode="DHCP"),
+            ],
+            [],
+        ),
+        (
+            [subnet("Rack-0", "10.128.0.0/33")],
+            [],
+            [
+                nic("data-a", "Rack-0", "10.128.0.100", row=2),
+                nic("data-b", "Rack-0", "10.128.0.100", row=3),
+            ],
+            [
+                "nics.csv:3: ip address 10.128.0.100 of nic data-b is also used "
+                "by nic data-a on row 2"
+            ],
+        ),
+    ],
+)
+def test_validate_nics(subnets, machines, nics, messages):
+    errors = validation.validate_nics(NICS_FILE, subnets, machines, nics)
+    assert [str(error) for error in errors] == messages
+
+
+def test_invalid_cidr_is_reported_once(tmp_path):
+    network = tmp_path / "network.csv"
+    network.write_text(
+        "Network Plan,,,,,,,\n"
+        ",CIDR,Gateway,MTU,Dynamic Range,Reserved Range,VLAN,Fabric\n"
+        "Rack 0,10.128.0.0/33,10.128.0.1,9000,,,100,fabric-0\n"
+    )
+    nodes = tmp_path / "nodes.csv"
+    nodes.write_text(
+        "Resource Name,Power type,Power pass,Power address,pxe mac address,"
+        "id path,nic name,mac address,partition schema\n"
+        "node0,ipmi,pass,172.16.0.1,52:00:00:00:00:00,/dev/sda,data-r0,"
+        "52:00:00:00:00:00,/\n"
+    )
+    nics = tmp_path / "nics.csv"
+    nics.write_text(
+        "Resource Name,vlan id,tags,mode,Ip address,Default Gateway,Subnet Name\n"
+        "pxe,0,None,DHCP,,false,Rack-0\n"
+        "data-r0,100,None,STATIC,,true,Rack-0\n"
+    )
+
+    errors = validation.validate(
+        {
+            "network-config": str(network),
+            "node-config": str(nodes),
+            "nics-config": str(nics),
+        }
+    )
+
+    assert [str(error) for error in errors] == [
+        "network.csv:3: subnet Rack-0 has an invalid CIDR: '10.128.0.0/33'"
+    ]
@@ -0,0 +1,343 @@
+# Description: Tests of the apply of the machines in waves
+import pytest
+from benchmarks import inventory
+from src import generateFunctions as gf
+from src import plans
+from src import waves
+
+# Eight racks, the last one of 20 machines, with power addresses in two /24
+MACHINES = 300
+INDEX = {
+    "maas_fabric.fabric-0": 'resource "maas_fabric" "fabric-0" {}',
+    "maas_subnet.PXE": "fabric = maas_fabric.fabric-0.id",
+    "maas_machine.node0": "power_type = ipmi",
+    "maas_block_device.node0-sda": "machine = maas_machine.node0.id",
+    "maas_network_interface_link.node0-pxe": (
+        "machine = maas_machine.node0.id\n"
+        "network_interface = maas_network_interface_physical.node0-pxe.id\n"
+        "subnet = maas_subnet.PXE.id"
+    ),
+    "maas_machine.node1": "power_type = ipmi",
+    "maas_block_device.node1-sda": "machine = maas_machine.node1.id",
+    "maas_user.alice": "password = secret",
+}
+
+
+def machine(number):
+    return f"{waves.MACHINE_PREFIX}node{number:06d}"
+
+
+@pytest.fixture(scope="module")
+def csv_files(tmp_path_factory):
+    return inventory.generate_inventory(
+        str(tmp_path_factory.mktemp("inventory")), MACHINES
+    )
+
+
+@pytest.fixture(scope="module")
+def script_path(csv_files, tmp_path_factory):
+    path = tmp_path_factory.mktemp("workspace") / "terraform_script.tf"
+    path.write_text("".join(gf.generate_terraform_script("key", "url", csv_files)))
+    return str(path)
+
+
+def schedule(csv_files, script_path, wave_by, size, adaptive=False):
+    return waves.WaveSchedule(wave_by, size, 8, adaptive, csv_files, script_path)
+
+
+def test_group_changes():
+    layer, machines, removed = waves.group_changes(
+        [
+            "maas_fabric.fabric-0",
+            "maas_block_device.node0-sda",
+            "maas_network_interface_link.node0-pxe",
+            "maas_machine.node0",
+            "maas_block_device.node1-sda",
+            "maas_user.alice",
+            "maas_machine.gone",
+        ],
+        INDEX,
+    )
+
+    assert layer == ["maas_fabric.fabric-0", "maas_user.alice"]
+    assert machines == {
+        "maas_machine.node0": [
+            "maas_block_device.node0-sda",
+            "maas_network_interface_link.node0-pxe",
+            "maas_machine.node0",
+        ],
+        # A machine left unchanged, whose block device changed
+        "maas_machine.node1": ["maas_block_device.node1-sda"],
+    }
+    assert removed == ["maas_machine.gone"]
+
+
+def test_wave_by_count_needs_a_size(csv_files, script_path):
+    with pytest.raises(Exception, match="need a wave size"):
+        schedule(csv_files, script_path, waves.COUNT_KEY, None)
+
+
+@pytest.mark.parametrize(
+    "wave_by, groups",
+    [
+        # The changed machines in csv order, whatever the order of the plan
+        (waves.COUNT_KEY, [[0, 39, 40, 250, 260, 299]]),
+        # Each rack of 40 machines has its own vlan
+        ("vlan", [[0, 39], [40], [250, 260], [299]]),
+        # The power addresses start at 172.16.0.0
+        ("power-subnet", [[0, 39, 40, 250], [260, 299]]),
+        ("Power type", [[0, 39, 40, 250, 260, 299]]),
+    ],
+)
+def test_machine_groups(csv_files, script_path, wave_by, groups):
+    changed = {machine(number) for number in [299, 260, 250, 40, 39, 0]}
+
+    assert waves.machine_groups(
+        schedule(csv_files, script_path, wave_by, 10), changed
+    ) == [[machine(number) for number in group] for group in groups]
+
+
+class FakeWaves:
+    """
+    Stands in for apply_wave, recording each wave and timing it with the
+    latency per machine given for its number.
+
+    Args:
+        latencies (dict): The seconds per machine of each wave number, an
+            exception to raise it instead, 1 for the waves not listed.
+    """
+
+    def __init__(self, latencies=None):
+        self.latencies = latencies or {}
+        self.waves = []
+
+    def __call__(
+        self, terraform, cwd, label, targets, parallelism, approved, yes, monitor=None
+    ):
+        assert set(targets) <= approved
+        machines = [
+            target for target in targets if target.startswith(waves.MACHINE_PREFIX)
+        ]
+        self.waves.append((label, len(machines), parallelism))
+        number = int(label.split()[-1]) if label.startswith("wave") else 0
+        latency = self.latencies.get(number, 1.0)
+        if isinstance(latency, Exception):
+            raise latency
+        return latency and latency * len(machines)
+
+    # The number of machines and the parallelism of the machine waves
+    def machine_waves(self):
+        return [wave[1:] for wave in self.waves if wave[0].startswith("wave")]
+
+
+# Apply the machines of the given numbers with their block devices in waves
+def apply_waves(monkeypatch, schedule, fake, numbers, removed=()):
+    monkeypatch.setattr(waves, "apply_wave", fake)
+    addresses = ["maas_fabric.fabric-0", *removed]
+    for number in numbers:
+        addresses.append(machine(number))
+        addresses.append(f"maas_block_device.node{number:06d}-block-device")
+    return waves.apply_waves("terraform", "/workspace", addresses, schedule, True)
+
+
+def test_apply_waves_applies_the_layer_then_the_machines(
+    csv_files, script_path, monkeypatch
+):
+    fake = FakeWaves()
+
+    assert apply_waves(
+        monkeypatch,
+        schedule(csv_files, script_path, waves.COUNT_KEY, 10),
+        fake,
+        range(25),
+        removed=["maas_machine.gone"],
+    )
+
+    assert fake.waves == [
+        ("network layer", 0, 8),
+        ("wave 1", 10, 8),
+        ("wave 2", 10, 8),
+        ("wave 3", 5, 8),
+        ("removed resources", 1, 8),
+    ]
+
+
+def test_apply_waves_stops_at_the_first_failed_wave(
+    csv_files, script_path, monkeypatch
+):
+    fake = FakeWaves({2: Exception("terraform apply failed")})
+
+    with pytest.raises(Exception, match="Wave 2 of 10 machines failed"):
+        apply_waves(
+            monkeypatch,
+            schedule(csv_files, script_path, waves.COUNT_KEY, 10),
+            fake,
+            range(40),
+        )
+    assert fake.machine_waves() == [(10, 8), (10, 8)]
+
+
+def test_adaptive_waves_retry_a_failed_wave_halved(
+    csv_files, script_path, monkeypatch
+):
+    fake = FakeWaves({2: Exception("terraform apply failed")})
+
+    apply_waves(
+        monkeypatch,
+        schedule(csv_files, script_path, waves.COUNT_KEY, 10, adaptive=True),
+        fake,
+        range(30),
+    )
+
+    # The parallelism goes back up once the retried wave succeeds, and the
+    # waves grow again while they are as fast as the first one
+    assert fake.machine_waves() == [(10, 8), (10, 8), (5, 4), (7, 8), (8, 8)]
+
+
+def test_adaptive_waves_give_up_after_the_retries(csv_files, script_path, monkeypatch):
+    error = Exception("terraform apply failed")
+    fake = FakeWaves({2: error, 3: error, 4: error})
+
+    with pytest.raises(Exception, match="Wave 4 of 2 machines failed"):
+        apply_waves(
+            monkeypatch,
+            schedule(csv_files, script_path, waves.COUNT_KEY, 10, adaptive=True),
+            fake,
+            range(30),
+        )
+    assert fake.machine_waves() == [(10, 8), (10, 8), (5, 4), (2, 2)]
+
+
+def test_adaptive_waves_halve_after_a_slow_wave(csv_files, script_path, monkeypatch):
+    fake = FakeWaves({2: 3.0})
+
+    apply_waves(
+        monkeypatch,
+        schedule(csv_files, script_path, waves.COUNT_KEY, 10, adaptive=True),
+        fake,
+        range(30),
+    )
+
+    assert fake.machine_waves() == [(10, 8), (10, 8), (5, 8), (5, 8)]
+
+
+def test_adaptive_waves_grow_while_they_are_fast(csv_files, script_path, monkeypatch):
+    fake = FakeWaves({number: 0.5 for number in range(2, 10)})
+
+    apply_waves(
+        monkeypatch,
+        schedule(csv_files, script_path, waves.COUNT_KEY, 10, adaptive=True),
+        fake,
+        range(200),
+    )
+
+    # Up to MAX_GROWTH times the configured size
+    sizes = [size for size, _ in fake.machine_waves()]
+    assert sizes == [10, 10, 15, 22, 33, 40, 40, 30]
+
+
+def test_rejected_wave_is_not_retried(csv_files, script_path, monkeypatch):
+    fake = FakeWaves({1: waves.WaveRejected("Wave 1 changes resources")})
+
+    with pytest.raises(waves.WaveRejected):
+        apply_waves(
+            monkeypatch,
+            schedule(csv_files, script_path, waves.COUNT_KEY, 10, adaptive=True),
+            fake,
+            range(30),
+        )
+    assert fake.machine_waves() == [(10, 8)]
+
+
+def test_apply_waves_stops_when_a_wave_is_not_confirmed(
+    csv_files, script_path, monkeypatch
+):
+    fake = FakeWaves({2: None})
+
+    assert not apply_waves(
+        monkeypatch,
+        schedule(csv_files, script_path, waves.COUNT_KEY, 10),
+        fake,
+        range(30),
+        removed=["maas_machine.gone"],
+    )
+    assert fake.machine_waves() == [(10, 8), (10, 8)]
+
+
+class FakeTerraform:
+    """
+    Stands in for the plan, show and apply of a wave, the plan changing the
+    given resources.
+    """
+
+    def __init__(self, monkeypatch, tmp_path, changes):
+        self.applied = []
+        self.plan_file = tmp_path / plans.PLAN_FILE
+        monkeypatch.setattr(plans, "plan", self.plan)
+        monkeypatch.setattr(
+            plans,
+            "iter_resource_changes",
+            lambda terraform, cwd: iter(
+                {
+                    "address": address,
+                    "type": address.split(".")[0],
+                    "change": {"actions": actions},
+                }
+                for address, actions in changes
+            ),
+        )
+        monkeypatch.setattr(plans, "apply", self.apply)
+
+    def plan(self, terraform, cwd, options):
+        self.plan_file.write_text("plan")
+        return True
+
+    def apply(self, terraform, cwd, plan_file, options, monitor):
+        self.applied.append(options)
+        self.plan_file.unlink()
+
+
+def test_apply_wave_checks_the_plan_of_the_wave(monkeypatch, tmp_path):
+    approved = {"maas_machine.node0", "maas_block_device.node0-sda"}
+    terraform = FakeTerraform(
+        monkeypatch,
+        tmp_path,
+        [
+            ("maas_machine.node0", ["create"]),
+            ("maas_block_device.node0-sda", ["create"]),
+            # Unchanged dependencies of the targets are fine
+            ("maas_subnet.PXE", ["no-op"]),
+            ("maas_machine.node1", ["delete", "create"]),
+        ],
+    )
+
+    with pytest.raises(waves.WaveRejected, match="Wave 1 changes resources") as error:
+        waves.apply_wave(
+            "terraform", str(tmp_path), "wave 1", sorted(approved), 8, approved, True
+        )
+
+    assert str(error.value).splitlines()[1:] == ["maas_machine.node1"]
+    assert terraform.applied == []
+    assert not terraform.plan_file.exists()
+
+
+@pytest.mark.parametrize("answer, applied", [("yes", True), ("no", False)])
+def test_apply_wave_prompts_without_yes(monkeypatch, tmp_path, capsys, answer, applied):
+    approved = {"maas_machine.node0"}
+    changes = [("maas_machine.node0", ["create"])]
+    terraform = FakeTerraform(monkeypatch, tmp_path, changes)
+    monkeypatch.setattr("builtins.input", lambda prompt: answer)
+
+    elapsed = waves.apply_wave(
+        "terraform", str(tmp_path), "wave 3", sorted(approved), 8, approved, False
+    )
+
+    assert (elapsed is not None) == applied
+    assert terraform.applied == ([["-parallelism=8"]] if applied else [])
+    assert not terraform.plan_file.exists()
+    assert capsys.readouterr().out == (
+        "Wave 3:\n"
+        "Plan summary:\n"
+        "  maas_machine: 1 to create\n"
+        "  Total: 1 to create\n"
+    )